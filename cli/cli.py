@@ -10,7 +10,7 @@
     :license: BSD 3-Clause, see LICENSE for more details.
 """
 
-__version__ = "0.3.0"
+__version__ = "0.4.0"
 __author__ = "staugur <me@tcw.im>"
 
 import argparse
@@ -18,7 +18,7 @@ from json import loads, dumps
 from base64 import b64encode
 from sys import version_info, platform
 from os import getenv, system
-from os.path import abspath, basename, isfile
+from os.path import abspath, basename, isfile, getsize
 
 PY2 = version_info[0] == 2
 
@@ -32,6 +32,12 @@ else:
     from urllib.parse import urlencode
 
 allowed_style = ("default", "typora", "line")
+#: 大于此尺寸(字节)的图片使用分块上传
+CHUNKED_THRESHOLD = 4 * 1024 * 1024
+#: 分块上传失败时的重试次数，重试时从服务端已接收的位置续传
+CHUNKED_RETRIES = 3
+#: 其他图片使用批量模式上传，每次请求的图片总尺寸(字节)上限
+BATCH_MAX_SIZE = 8 * 1024 * 1024
 
 
 def style_type(value):
@@ -103,6 +109,83 @@ def copy_parse_result(copy_type, result):
     return contents
 
 
+def request_api(api, token, data, params=None, content_type=None):
+    """请求上传接口，data是字典（表单）或二进制（请求体）"""
+    if params:
+        api = "{}?{}".format(api, urlencode(params))
+    if isinstance(data, dict):
+        data = urlencode(data).encode("utf-8")
+    headers = {
+        "Authorization": "LinkToken {}".format(token),
+        "User-Agent": "picbed-cli/{}".format(__version__),
+    }
+    if content_type:
+        headers["Content-Type"] = content_type
+    res = urllib2.urlopen(urllib2.Request(api, data=data, headers=headers))
+    return loads(res.read())
+
+
+def chunked_upload(api, token, filepath, form):
+    """分块上传大图片，form是完成上传时提交的表单（album、title等）"""
+    size = getsize(filepath)
+    res = request_api(
+        api, token, dict(filename=form["filename"], size=size),
+        dict(Action="chunkInit"),
+    )
+    if res.get("code") != 0:
+        return res
+    upload_id = res["upload_id"]
+    chunk_size = res["chunk_size"]
+    offset = 0
+    tries = 0
+    with open(filepath, "rb") as fp:
+        while offset < size:
+            fp.seek(offset)
+            try:
+                res = request_api(
+                    api, token, fp.read(chunk_size),
+                    dict(Action="chunkPut", upload_id=upload_id,
+                         offset=offset),
+                    "application/octet-stream",
+                )
+                if res.get("code") != 0:
+                    return res
+            except IOError:
+                #: 网络错误时查询已接收的字节数，从此处续传
+                tries += 1
+                if tries > CHUNKED_RETRIES:
+                    raise
+                res = request_api(
+                    api, token, b"",
+                    dict(Action="chunkStatus", upload_id=upload_id),
+                )
+                if res.get("code") != 0:
+                    return res
+            else:
+                tries = 0
+            offset = res["received"]
+    return request_api(
+        api, token, form, dict(Action="chunkComplete", upload_id=upload_id)
+    )
+
+
+def batch_upload(api, token, items):
+    """批量上传（NDJSON，每行一张图片），items是(图片路径, 表单)列表，
+    返回按顺序的每张图片的上传结果"""
+    lines = []
+    for filepath, form in items:
+        with open(filepath, "rb") as fp:
+            form = dict(form, picbed=b64encode(fp.read()).decode("utf-8"))
+        lines.append(dumps(form))
+    res = request_api(
+        api, token, "\n".join(lines).encode("utf-8"), dict(Action="batch"),
+        "application/x-ndjson",
+    )
+    if res.get("code") == 0:
+        return res["data"]
+    return [res] * len(items)
+
+
 def main(parser):
     args = parser.parse_args()
     api = args.picbed_url
@@ -126,30 +209,38 @@ def main(parser):
     copy = args.copy
     files = args.file
     result = []
+    #: 批量上传的图片：(结果位置, 图片路径, 表单, 尺寸)
+    pending = []
     for f in files:
         filepath = abspath(f)
         filename = basename(filepath)
         if isfile(filepath):
-            with open(filepath, "rb") as fp:
-                stream = fp.read()
-            req = urllib2.Request(
-                api,
-                data=urlencode(dict(
-                    picbed=b64encode(stream),
-                    filename=filename,
-                    album=album,
-                    title=title,
-                    expire=expire,
-                    origin="cli/{}".format(__version__),
-                )).encode("utf-8"),
-                headers={
-                    "Authorization": "LinkToken {}".format(token),
-                    "User-Agent": "picbed-cli/{}".format(__version__),
-                },
+            form = dict(
+                filename=filename,
+                album=album,
+                title=title,
+                expire=expire,
+                origin="cli/{}".format(__version__),
             )
-            res = urllib2.urlopen(req)
-            res = loads(res.read())
-            result.append(res)
+            size = getsize(filepath)
+            if size > CHUNKED_THRESHOLD:
+                result.append(chunked_upload(api, token, filepath, form))
+            else:
+                result.append(None)
+                pending.append((len(result) - 1, filepath, form, size))
+    start = 0
+    while start < len(pending):
+        end = start + 1
+        size = pending[start][3]
+        while end < len(pending) and \
+                size + pending[end][3] <= BATCH_MAX_SIZE:
+            size += pending[end][3]
+            end += 1
+        batch = pending[start:end]
+        data = batch_upload(api, token, [(p, form) for _, p, form, _ in batch])
+        for (i, _, _, _), res in zip(batch, data):
+            result[i] = res
+        start = end
     if result:
         if style == "typora":
             print("Upload Success:")
@@ -51,11 +51,22 @@ def gtv():
     }
 
 
+#: 静态资源端点（static及钩子的assets），无需登录态、钩子及重定向处理
+STATIC_ENDPOINTS = ("static", "assets")
+
+
 @app.before_request
 def before_request():
     g.rc = rc
     g.site = get_site_config()
     g.cfg = Attribute(g.site)
+    g.site_name = g.cfg.title_name or "picbed"
+    g.hm = hm
+    g.is_static = request.endpoint in STATIC_ENDPOINTS
+    if g.is_static:
+        g.signin, g.is_admin, g.next = False, False, None
+        g.userinfo = Attribute({})
+        return
     g.signin, g.userinfo = default_login_auth()
     #: Trigger hook, you can modify flask.g
     hm.call("before_request")
@@ -63,14 +74,13 @@ def before_request():
     g.userinfo = Attribute(change_userinfo(g.userinfo))
     g.is_admin = is_true(g.userinfo.is_admin)
     g.next = get_redirect_url()
-    g.site_name = g.cfg.title_name or "picbed"
-    g.hm = hm
 
 
 @app.after_request
 def after_request(res):
     #: Trigger hook, you can modify the response
-    hm.call("after_request", _args=(res,))
+    if not g.get("is_static"):
+        hm.call("after_request", _args=(res,))
     if g.cfg.cors:
         if g.cfg.cors == "*":
             res.headers.add("Access-Control-Allow-Origin", "*")
@@ -11,6 +11,7 @@
 """
 
 from os.path import dirname, join
+from tempfile import gettempdir
 from utils._compat import Properties
 
 envs = Properties(join(dirname(__file__), ".cfg"), from_env=True)
@@ -32,6 +33,7 @@ GLOBAL = {
 
     "HookReloadTime": int(envs.get("picbed_hookreloadtime", 600)),
     # 钩子管理器默认重载时间，单位：秒
+    # v1.11.0起钩子变更通过redis发布订阅通知各进程，此时间仅作为兜底检查间隔
 
     "SecretKey": envs.get(
         "picbed_secretkey", "BD1E2CF7DF9CD6971D641C115EE72871BEDA2806"
@@ -40,6 +42,45 @@ GLOBAL = {
 
     "MaxUpload": int(envs.get("picbed_maxupload", 20)),
     # 上传最大尺寸，单位MB
+
+    "SiteConfigCacheTime": int(envs.get("picbed_siteconfigcachetime", 5)),
+    # 站点配置在进程内的缓存时间，超时后检查版本号决定是否重新加载，单位：秒
+
+    "AuthCacheTime": int(envs.get("picbed_authcachetime", 5)),
+    # 认证数据（用户信息、LinkToken）在进程内的缓存时间，0表示不缓存，单位：秒
+    # 吊销Token、修改LinkToken等最迟在此时间后生效
+
+    "ReportFlushInterval": int(envs.get("picbed_reportflushinterval", 2)),
+    # LinkToken访问统计在进程内缓冲，由后台批量写入的间隔，单位：秒
+
+    "ReportMaxRecords": int(envs.get("picbed_reportmaxrecords", 10000)),
+    # 每个用户保留的LinkToken访问统计记录数，超过时删除最早的，0表示不限制
+
+    "MaxChunkedUpload": int(envs.get("picbed_maxchunkedupload", 100)),
+    # 分块上传的图片最大尺寸，单位MB（每个分块仍受MaxUpload限制）
+
+    "ChunkedUploadDir": envs.get(
+        "picbed_chunkeduploaddir", join(gettempdir(), "picbed_chunked")
+    ),
+    # 分块上传的暂存目录，多实例部署时同一上传的请求需要到达同一实例
+
+    "ImageCacheDir": envs.get(
+        "picbed_imagecachedir", join(gettempdir(), "picbed_imgcache")
+    ),
+    # 图片处理(/img/<sha>)结果的本地缓存目录
+
+    "ImageCacheSize": int(envs.get("picbed_imagecachesize", 512)),
+    # 图片处理结果的缓存大小上限，超过时淘汰最久未访问的，单位MB
+
+    "ProcessPoolSize": int(envs.get("picbed_processpoolsize", 2)),
+    # 每个进程的进程池大小，用于base64解码、摘要、图片处理等CPU密集的任务，
+    # 避免阻塞gevent的事件循环，0表示不使用进程池
+
+    "ProcessPoolQueue": int(envs.get("picbed_processpoolqueue", 16)),
+    # 进程池中排队等待的最大任务数，超过时提交任务的请求等待
+
+    "ProcessPoolThreshold": int(envs.get("picbed_processpoolthreshold", 256)),
+    # 数据不小于此大小时才使用进程池(图片处理除外)，单位KB
 }
 
 
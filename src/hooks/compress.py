@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+    compress
+    ~~~~~~~~
+
+    Recompress uploaded pictures.
+
+    :copyright: (c) 2019 by staugur.
+    :license: BSD 3-Clause, see LICENSE for more details.
+"""
+
+__version__ = '0.1.0'
+__author__ = 'staugur <staugur@saintic.com>'
+__hookname__ = 'compress'
+__description__ = '上传时压缩图片（需要安装Pillow）'
+__state__ = 'disabled'
+__catalog__ = 'upload'
+
+from flask import g
+from utils.tool import logger
+from utils.web import run_in_process, recompress_image
+
+intpl_localhooksetting = '''
+<div class="layui-col-xs12 layui-col-sm12 layui-col-md6">
+<fieldset class="layui-elem-field layui-field-title">
+    <legend>图片压缩</legend>
+    <div class="layui-field-box">
+        <div class="layui-form-item">
+            <label class="layui-form-label">JPEG质量上限</label>
+            <div class="layui-input-block">
+                <input type="number" name="compress_jpeg_quality"
+                    value="{{ g.site.compress_jpeg_quality }}"
+                    placeholder="1~95，高于此质量的jpeg重新编码，默认85，0表示不处理"
+                    autocomplete="off" class="layui-input">
+            </div>
+        </div>
+        <div class="layui-form-item">
+            <label class="layui-form-label">PNG无损优化</label>
+            <div class="layui-input-block">
+                <input type="checkbox" name="compress_png" lay-skin="switch"
+                    lay-text="ON|OFF" autocomplete="off" value="1"
+                    {% if g.site.compress_png|d("1")|string != "0" %}
+                    checked="checked"{% endif %}>
+            </div>
+        </div>
+        <div class="layui-form-item">
+            <label class="layui-form-label">BMP转PNG</label>
+            <div class="layui-input-block">
+                <input type="checkbox" name="compress_bmp" lay-skin="switch"
+                    lay-text="ON|OFF" autocomplete="off" value="1"
+                    {% if g.site.compress_bmp|d("1")|string != "0" %}
+                    checked="checked"{% endif %}>
+            </div>
+        </div>
+    </div>
+</fieldset>
+</div>
+'''
+
+
+def upimg_stream_processor(stream, suffix):
+    try:
+        quality = int(g.cfg.compress_jpeg_quality or 85)
+    except (ValueError, TypeError):
+        quality = 85
+    try:
+        data, new_suffix = run_in_process(
+            recompress_image, stream,
+            jpeg_quality=min(max(quality, 0), 95),
+            png_optimize=str(g.cfg.compress_png) != "0",
+            bmp_to_png=str(g.cfg.compress_bmp) != "0",
+        )
+    except ImportError:
+        return dict(code=1, msg="Please install Pillow")
+    except (IOError, ValueError, Exception) as e:
+        logger.debug(e, exc_info=True)
+        return dict(code=1, msg="Unrecognized picture")
+    if data:
+        rst = dict(stream=data)
+        if new_suffix:
+            rst.update(suffix=new_suffix)
+        return dict(code=0, data=rst)
+    return dict(code=1, msg="No need to compress")
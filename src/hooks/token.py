@@ -9,17 +9,19 @@
     :license: BSD 3-Clause, see LICENSE for more details.
 """
 
-__version__ = '0.3.4'
+__version__ = '0.5.0'
 __author__ = 'staugur'
 __description__ = '使用Token验证Api'
 __catalog__ = 'auth'
 
-import json
+from time import time
 from flask import request, g
 from base64 import urlsafe_b64decode as b64decode
 from utils.tool import rsp, hmac_sha256, logger, get_current_timestamp, \
-    parse_valid_comma, Attribution, ALLOWED_RULES, is_true, parse_ua
+    parse_valid_comma, ALLOWED_RULES, is_true, er_pat, IPSet
+from utils.web import push_report
 from utils._compat import PY2, text_type
+from config import GLOBAL
 
 intpl_profile = """
 <div class="layui-form-item">
@@ -77,65 +79,153 @@ def _parse_ir(ir):
         return rules
 
 
-def _allow_ir(ir, allow):
-    """解析ir规则，返回所有参数最终判断True的语句字符串
-    :param ir: in opt, not in opt
-    :return: {opt:(access_opt in/not in secure_opt), opt:(other)...}
-    """
-    #: ir解析成{opt:not in, opt:in, ...}
-    rules = _parse_ir(ir) or {}
-    cmd = {}
-    for opt in ALLOWED_RULES:
-        #: 只有用户定义了参数的安全项时才判断访问合法性
-        if allow[opt].secure:
-            cmd[opt] = "('%s' %s %s)" % (
-                allow[opt].access, rules.get(opt, "in"), allow[opt].secure
-            )
-        else:
-            cmd[opt] = "True"
-    return cmd
+#: LinkToken规则相关的字段，任一变化时重新编译
+RULE_FIELDS = (
+    "allow_ip", "allow_origin", "allow_ep", "allow_method",
+    "exterior_relation", "interior_relation",
+)
+#: 进程内编译后的规则缓存，LinkId: (规则字段值, LinkRule)
+_rules = {}
+#: 缓存的LinkToken数量上限，超过时清空
+RULE_CACHE_SIZE = 1024
 
 
-def verify_rule(Ld):
-    """根据er、ir规则判断是否放行请求"""
-    allow = Attribution(dict(
-        ip=Attribution(dict(
-            access=get_ip(),
-            secure=parse_valid_comma(Ld["allow_ip"]) or []
-        )),
-        origin=Attribution(dict(
-            access=get_origin(),
-            secure=parse_valid_comma(Ld["allow_origin"]) or []
-        )),
-        ep=Attribution(dict(
-            access=request.endpoint,
-            secure=parse_valid_comma(Ld["allow_ep"]) + ["api.index"]
-        )),
-        method=Attribution(dict(
-            access=request.method,
-            secure=[
+class LinkRule(object):
+    """编译后的er、ir规则，调用时传递请求的ip、origin、ep、method，
+    返回是否放行请求。
+
+    - ir定义的是参数如何返回True，编译为安全项集合与是否取反
+    - er定义的是参数之间的逻辑运算，编译为代码对象（只包含参数名与逻辑运算符）
+    """
+
+    def __init__(self, Ld):
+        rules = _parse_ir(Ld.get("interior_relation")) or {}
+        self.secure = dict(
+            ip=IPSet(parse_valid_comma(Ld.get("allow_ip")) or []),
+            origin=frozenset(parse_valid_comma(Ld.get("allow_origin")) or []),
+            ep=frozenset(
+                (parse_valid_comma(Ld.get("allow_ep")) or []) + ["api.index"]
+            ),
+            method=frozenset(
                 m.upper()
-                for m in parse_valid_comma(Ld["allow_method"]) or []
+                for m in parse_valid_comma(Ld.get("allow_method")) or []
                 if m
-            ]
-        ))
-    ))
-    #: 参数 逻辑运算符 参数 逻辑运算符 参数...
-    #: 参数: origin and ip and ep and method
-    #: 逻辑运算符: and or not in not in
-    #: er控制的是参与逻辑运算的参数及之间的逻辑运算符
-    #: ir控制的是参数如何返回True
-    er = Ld["exterior_relation"]
-    ir = Ld["interior_relation"]
-    if not er:
-        er = "origin and ip and ep and method"
-    #: ir定义的最终规则
-    ir_cmd = _allow_ir(ir, allow)
-    #: 综合er、ir构建最终执行的命令字符串
-    for opt in ALLOWED_RULES:
-        er = er.replace(opt, ir_cmd[opt])
-    logger.debug("last er: %s" % er)
-    return eval(er)
+            ),
+        )
+        self.negated = frozenset(
+            opt for opt in ALLOWED_RULES if rules.get(opt) == "not in"
+        )
+        #: 参数 逻辑运算符 参数 逻辑运算符 参数...
+        #: 参数: origin and ip and ep and method
+        #: 逻辑运算符: and or not in not in
+        er = (Ld.get("exterior_relation") or "").strip()
+        if not er:
+            er = "origin and ip and ep and method"
+        try:
+            if not er_pat.match(er):
+                raise SyntaxError(er)
+            self.code = compile(er, "<exterior_relation>", "eval")
+        except SyntaxError as e:
+            logger.warning("invalid exterior_relation: %s" % e)
+            self.code = None
+
+    def __call__(self, ip, origin, ep, method):
+        if self.code is None:
+            return False
+        access = dict(ip=ip, origin=origin, ep=ep, method=method)
+        values = {}
+        for opt in ALLOWED_RULES:
+            #: 只有用户定义了参数的安全项时才判断访问合法性
+            if self.secure[opt]:
+                values[opt] = (access[opt] in self.secure[opt]) != (
+                    opt in self.negated
+                )
+            else:
+                values[opt] = True
+        return bool(eval(self.code, {"__builtins__": None}, values))
+
+
+def get_rule(LinkId, Ld):
+    """获取LinkToken编译后的规则，规则字段变化（/api/link修改）时重新编译，
+    由于比较的是每次请求都会读取的LinkToken数据，多进程部署时也会及时失效"""
+    fields = tuple(Ld.get(f) or "" for f in RULE_FIELDS)
+    cached = _rules.get(LinkId)
+    if cached and cached[0] == fields:
+        return cached[1]
+    rule = LinkRule(Ld)
+    if len(_rules) >= RULE_CACHE_SIZE:
+        _rules.clear()
+    _rules[LinkId] = (fields, rule)
+    return rule
+
+
+def verify_rule(LinkId, Ld):
+    """根据er、ir规则判断是否放行请求"""
+    return get_rule(LinkId, Ld)(
+        get_ip(), get_origin(), request.endpoint, request.method
+    )
+
+
+#: 进程内缓存的认证数据，("linktoken", LinkId): (LinkToken数据, 用户数据)，
+#: ("account", 用户名): 用户数据，值是(过期时间, 数据)
+_auth_cache = {}
+#: LinkId所属用户（不会改变），已知时LinkToken与用户数据在一次请求中读取
+_link_users = {}
+#: 缓存数量上限，超过时清空
+AUTH_CACHE_SIZE = 4096
+
+
+def _cache_get(key):
+    item = _auth_cache.get(key)
+    if item and item[0] > time():
+        return item[1]
+
+
+def _cache_set(key, value):
+    ttl = GLOBAL["AuthCacheTime"]
+    if ttl > 0:
+        if len(_auth_cache) >= AUTH_CACHE_SIZE:
+            _auth_cache.clear()
+        _auth_cache[key] = (time() + ttl, value)
+
+
+def get_account(usr):
+    """读取用户数据（一次redis请求）"""
+    account = _cache_get(("account", usr))
+    if account is None:
+        account = g.rc.hgetall(rsp("account", usr))
+        _cache_set(("account", usr), account)
+    return dict(account)
+
+
+def get_linktoken(LinkId):
+    """读取LinkToken及其所属用户的数据，LinkId所属用户已知时仅一次redis请求
+
+    :returns: (LinkToken数据, 用户数据)，LinkId无效时LinkToken数据为空
+    """
+    cached = _cache_get(("linktoken", LinkId))
+    if cached is None:
+        usr = _link_users.get(LinkId)
+        pipe = g.rc.pipeline()
+        pipe.hexists(rsp("linktokens"), LinkId)
+        pipe.hgetall(rsp("linktoken", LinkId))
+        if usr:
+            pipe.hgetall(rsp("account", usr))
+        result = pipe.execute()
+        Ld = result[1] if result[0] is True and result[1] and \
+            isinstance(result[1], dict) else {}
+        account = result[2] if usr else {}
+        if Ld.get("user") and Ld["user"] != usr:
+            usr = Ld["user"]
+            account = g.rc.hgetall(rsp("account", usr))
+            if len(_link_users) >= AUTH_CACHE_SIZE:
+                _link_users.clear()
+            _link_users[LinkId] = usr
+        cached = (Ld, account)
+        _cache_set(("linktoken", LinkId), cached)
+        if Ld:
+            _cache_set(("account", usr), account)
+    return dict(cached[0]), dict(cached[1])
 
 
 def before_request():
@@ -146,6 +236,8 @@ def before_request():
     LinkToken = request.form.get(
         "LinkToken", request.args.get("LinkToken")
     ) or parse_authorization("LinkToken")
+    #: LinkToken校验时已读取的用户数据
+    accounts = {}
     if not token and LinkToken:
         try:
             if PY2 and isinstance(LinkToken, text_type):
@@ -160,51 +252,41 @@ def before_request():
         except (TypeError, ValueError, AttributeError) as e:
             logger.debug(e, exc_info=True)
         else:
-            pipe = g.rc.pipeline()
-            pipe.hexists(rsp("linktokens"), LinkId)
-            pipe.hgetall(rsp("linktoken", LinkId))
-            result = pipe.execute()
-            if result[0] is True and result[1] and isinstance(result[1], dict):
+            Ld, account = get_linktoken(LinkId)
+            if Ld:
                 #: LinkId有效，但等待校验签名与权限，可以统计请求数据
-                Ld = result[1]
                 usr = Ld.get("user")
                 secret = Ld.get("LinkSecret")
                 status = int(Ld.get("status", 1))
-                userinfo = g.rc.hmget(
-                    rsp("account", usr), "token", "ucfg_report_linktoken"
-                )
+                accounts[usr] = account
                 if status == 1 and hmac_sha256(LinkId, secret) == LinkSig:
                     authentication = "ok"
                     #: 权限校验规则
-                    if verify_rule(Ld):
+                    if verify_rule(LinkId, Ld):
                         authorization = "ok"
                         logger.info("LinkToken ok and permission pass")
                         g.up_album = Ld.get("album")
-                        token = userinfo[0]
+                        token = account.get("token")
                     else:
                         authorization = "fail"
                         logger.info("LinkToken ok and permission deny")
                 else:
                     authentication = "fail"
                     authorization = "fail"
-                #: 统计入库
-                if is_true(userinfo[1]):
-                    g.rc.lpush(
-                        rsp("report", "linktokens", usr),
-                        json.dumps(dict(
-                            LinkId=LinkId,
-                            user=usr,
-                            ctime=get_current_timestamp(),
-                            ip=get_ip(),
-                            agent=get_ua(),
-                            uap=parse_ua(get_ua()),
-                            referer=request.headers.get('Referer', ''),
-                            origin=get_origin(),
-                            ep=request.endpoint,
-                            authentication=authentication,
-                            authorization=authorization,
-                        ))
-                    )
+                #: 统计入库（进程内缓冲后批量写入，写入前解析用户代理）
+                if is_true(account.get("ucfg_report_linktoken")):
+                    push_report("linktokens", usr, dict(
+                        LinkId=LinkId,
+                        user=usr,
+                        ctime=get_current_timestamp(),
+                        ip=get_ip(),
+                        agent=get_ua(),
+                        referer=request.headers.get('Referer', ''),
+                        origin=get_origin(),
+                        ep=request.endpoint,
+                        authentication=authentication,
+                        authorization=authorization,
+                    ))
     if token:
         try:
             oldToken = token
@@ -219,13 +301,12 @@ def before_request():
         except (TypeError, ValueError, AttributeError, Exception) as e:
             logger.debug(e, exc_info=True)
         else:
-            tk = rsp("tokens")
-            token2usr = g.rc.hget(tk, oldToken)
-            if token2usr and token2usr == usr:
-                ak = rsp("account", usr)
-                userinfo = g.rc.hgetall(ak)
+            #: token与用户数据中的token字段总是同时设置、删除（与tokens索引
+            #: 一致），所以只需读取用户数据
+            userinfo = accounts.get(usr) or get_account(usr)
+            if userinfo and userinfo.get("token") == oldToken:
                 userstatus = int(userinfo.get("status", 1))
-                if userinfo and userstatus != 0:
+                if userstatus != 0:
                     pwd = userinfo.pop("password", None)
                     tkey = userinfo.pop("token_key", None)
                     if hmac_sha256(pwd, usr) == sig or \
@@ -19,8 +19,8 @@ __catalog__ = 'upload'
 import requests
 from flask import g
 from posixpath import join
-from base64 import b64encode
-from utils.tool import slash_join, try_request
+from utils.tool import slash_join, try_request, b64encode_to_text
+from utils.web import offload
 from utils._compat import string_types
 
 
@@ -99,7 +99,7 @@ def upimg_save(**kwargs):
             #: 通过API上传图片
             data = dict(
                 message="Create %s by picbed" % filepath,
-                content=b64encode(stream).decode("utf-8"),
+                content=offload(b64encode_to_text, stream),
                 access_token=token,
             )
             if branch:
@@ -20,9 +20,8 @@ import json
 import requests
 from flask import g
 from posixpath import join
-from base64 import b64encode
-from utils.tool import slash_join, is_true
-from utils.web import try_proxy_request
+from utils.tool import slash_join, is_true, b64encode_to_text
+from utils.web import try_proxy_request, offload
 from utils._compat import string_types
 
 
@@ -110,7 +109,7 @@ def upimg_save(**kwargs):
             #: 通过API上传图片
             data = dict(
                 message="Create %s by picbed" % filepath,
-                content=b64encode(stream).decode("utf-8"),
+                content=offload(b64encode_to_text, stream),
             )
             if branch:
                 data["branch"] = branch
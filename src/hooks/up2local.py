@@ -9,17 +9,21 @@
     :license: BSD 3-Clause, see LICENSE for more details.
 """
 
-__version__ = '0.2.2'
+__version__ = '0.3.0'
 __author__ = 'staugur'
 __description__ = '将图片保存到本地'
 __catalog__ = 'upload'
 
 from os import makedirs, remove
 from os.path import exists, join, isfile
+from shutil import copyfileobj
 from flask import current_app, url_for
 from posixpath import join as posixjoin
 from utils._compat import string_types
 
+#: upimg_save可以接收文件对象，分块写入
+upimg_streaming = True
+
 
 def get_basedir():
     return join(
@@ -49,7 +53,10 @@ def upimg_save(**kwargs):
                 makedirs(saveto)
             filepath = join(saveto, filename)
             with open(filepath, "wb") as fp:
-                fp.write(stream)
+                if hasattr(stream, "read"):
+                    copyfileobj(stream, fp)
+                else:
+                    fp.write(stream)
                 res.update(code=0, src=url_for(
                     "static",
                     filename=posixjoin(
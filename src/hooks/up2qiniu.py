@@ -9,7 +9,7 @@
     :license: BSD 3-Clause, see LICENSE for more details.
 """
 
-__version__ = '0.2.2'
+__version__ = '0.3.0'
 __author__ = 'staugur <staugur@saintic.com>'
 __hookname__ = 'up2qiniu'
 __description__ = '将图片保存到七牛云'
@@ -130,3 +130,28 @@ def upimg_delete(sha, upload_path, filename, basedir, save_result):
             qiniu_basedir = qiniu_basedir.lstrip('/')
         filepath = join(basedir or qiniu_basedir, upload_path, filename)
         bm.delete(bucket, filepath)
+
+
+def upimg_delete_batch(items):
+    try:
+        from qiniu import Auth, BucketManager, build_batch_delete
+    except ImportError:
+        raise ImportError("Please install qiniu module")
+    else:
+        ak = g.cfg.qiniu_ak
+        sk = g.cfg.qiniu_sk
+        qn = Auth(ak, sk)
+        bm = BucketManager(qn)
+        bucket = g.cfg.qiniu_bucket
+        qiniu_basedir = g.cfg.qiniu_basedir or ''
+        if qiniu_basedir.startswith("/"):
+            qiniu_basedir = qiniu_basedir.lstrip('/')
+        keys = [
+            join(
+                i["basedir"] or qiniu_basedir, i["upload_path"], i["filename"]
+            )
+            for i in items
+        ]
+        #: 七牛云每次批量操作最多1000个
+        for i in range(0, len(keys), 1000):
+            bm.batch(build_batch_delete(bucket, keys[i:i + 1000]))
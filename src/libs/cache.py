@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+    libs.cache
+    ~~~~~~~~~~
+
+    Size-bounded LRU cache on local disk.
+
+    :copyright: (c) 2019 by staugur.
+    :license: BSD 3-Clause, see LICENSE for more details.
+"""
+
+import os
+from os.path import join, isdir, getmtime, getsize
+from collections import OrderedDict
+from threading import Lock
+from time import time
+from tempfile import mkstemp
+from utils.tool import sha1
+
+
+class DiskCache(object):
+    """本地磁盘上的LRU缓存，每个key对应一个文件（以key的sha1命名）。
+
+    进程内维护按访问顺序排列的索引（文件名: 大小），命中时更新文件修改时间，
+    总大小超过上限时从索引中淘汰最久未访问的文件，直到低于上限的
+    :attr:`low_water` 比例，避免下次写入时再次淘汰。首次使用及距上次扫描
+    超过 :attr:`scan_interval` 秒后淘汰时，先按修改时间从目录重建索引
+    （包括其他进程写入的文件），因此多个进程可以共享同一目录。
+
+    :param str path: 缓存目录
+    :param int max_size: 缓存总大小上限，单位字节
+
+    .. versionadded:: 1.11.0
+    """
+
+    #: 淘汰到总大小上限的此比例
+    low_water = 0.9
+    #: 重建索引的最小间隔，秒
+    scan_interval = 300
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self._index = None
+        self._size = 0
+        self._scan_time = 0
+        self._lock = Lock()
+
+    def _filename(self, key):
+        return sha1(key)
+
+    def _scan(self):
+        """按修改时间从目录中重建索引"""
+        if not isdir(self.path):
+            os.makedirs(self.path)
+        files = []
+        for name in os.listdir(self.path):
+            if name.startswith("."):
+                continue
+            fp = join(self.path, name)
+            try:
+                files.append((getmtime(fp), name, getsize(fp)))
+            except OSError:
+                continue
+        files.sort()
+        self._index = OrderedDict((name, size) for _, name, size in files)
+        self._size = sum(self._index.values())
+        self._scan_time = time()
+
+    def _evict(self):
+        if time() - self._scan_time > self.scan_interval:
+            self._scan()
+        while self._size > self.max_size * self.low_water and self._index:
+            name, size = self._index.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(join(self.path, name))
+            except OSError:
+                pass
+
+    def get(self, key):
+        """读取缓存
+
+        :returns: 打开的文件对象，未命中时返回None
+        """
+        name = self._filename(key)
+        fp = join(self.path, name)
+        try:
+            f = open(fp, "rb")
+        except (IOError, OSError):
+            with self._lock:
+                if self._index and name in self._index:
+                    self._size -= self._index.pop(name)
+            return None
+        try:
+            os.utime(fp, None)
+        except OSError:
+            pass
+        with self._lock:
+            if self._index is not None and name in self._index:
+                self._index[name] = self._index.pop(name)
+        return f
+
+    def set(self, key, data):
+        """写入缓存（先写临时文件再重命名，读取时不会读到不完整的内容）
+
+        :param bytes data: 缓存内容
+        """
+        name = self._filename(key)
+        with self._lock:
+            if self._index is None:
+                self._scan()
+        fd, tmp = mkstemp(prefix=".", dir=self.path)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.rename(tmp, join(self.path, name))
+        except (IOError, OSError):
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            self._size -= self._index.pop(name, 0)
+            self._index[name] = len(data)
+            self._size += len(data)
+            if self._size > self.max_size:
+                self._evict()
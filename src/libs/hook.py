@@ -10,9 +10,10 @@
 """
 
 import warnings
-from time import time
+from time import time, sleep
+from threading import Thread
 from sys import modules
-from os import listdir, getpid
+from os import listdir
 from os.path import join, dirname, abspath, isdir, isfile, splitext, basename,\
     getmtime
 from jinja2 import ChoiceLoader, FileSystemLoader, PackageLoader
@@ -20,8 +21,7 @@ from flask import render_template, render_template_string, Markup, abort, \
     send_from_directory, url_for
 from utils.tool import Attribution, is_valid_verion, is_match_appversion, \
     logger, parse_author_mail
-from utils._compat import string_types, integer_types, iteritems, text_type, \
-    PY2
+from utils._compat import string_types, text_type, PY2
 from config import GLOBAL
 from .storage import get_storage
 
@@ -42,8 +42,15 @@ class HookManager(object):
         self.__hf = hooks_dir
         self.__hook_dir = join(dirname(dirname(abspath(__file__))), self.__hf)
         self.__MAX_RELOAD_TIME = int(GLOBAL["HookReloadTime"] or reload_time)
+        #: 钩子版本号，启用、禁用、重载等操作时递增，各进程据此重建钩子
+        self.__version = None
+        self.__last_check_time = 0
+        #: 是否已订阅钩子变更通知，订阅中仅在收到通知时检查版本号
+        self.__listening = False
+        self.__channel = "hook:notify"
+        #: 编译后的钩子表：全部、启用的钩子列表、映射及扩展点调用表
+        self.__compiled = None
         self.__third_hooks = third_hooks
-        self.__last_load_time = time()
         #: hook static endpoint and url_path
         self.__static_endpoint = "assets"
         self.__static_url_path = "/{}".format(self.__static_endpoint)
@@ -77,41 +84,47 @@ class HookManager(object):
         app.extensions = getattr(app, 'extensions', None) or {}
         app.extensions['hookmanager'] = self
         self.app = app
-
-    @property
-    def _pid(self):
-        return str(getpid())
-
-    @property
-    def __last_load_time(self):
-        hlt = self.__storage.get("hookloadtime") or {}
-        return hlt.get(self._pid)
-
-    @__last_load_time.setter
-    def __last_load_time(self, timestamp):
-        if not isinstance(timestamp, (integer_types, float)):
-            raise TypeError("The value of last_load_time type error")
-        hlt = self.__storage.get("hookloadtime") or {}
-        if timestamp == 0:
-            hlt = {k: 0 for k, v in iteritems(hlt)}
-        else:
-            hlt[self._pid] = timestamp
-        self.__storage.set("hookloadtime", hlt)
-
-    @__last_load_time.deleter
-    def __last_load_time(self):
-        if "hookloadtime" in self.__storage.list:
-            del self.__storage['hookloadtime']
-
-    def __del__(self):
-        del self.__last_load_time
+        #: gevent worker中线程已被patch为greenlet
+        t = Thread(target=self.__listen, name="HookManagerListener")
+        t.daemon = True
+        t.start()
+
+    def __listen(self):
+        """订阅钩子变更通知，收到通知后下次使用钩子时检查版本号"""
+        while True:
+            try:
+                ps = self.__storage.subscribe(self.__channel)
+                #: 订阅前可能错过的通知，通过立即检查版本号弥补
+                self.__last_check_time = 0
+                self.__listening = True
+                for msg in ps.listen():
+                    if msg and msg.get("type") == "message":
+                        self.__last_check_time = 0
+            except Exception as e:
+                logger.warning(e)
+            self.__listening = False
+            sleep(3)
 
     def __ensure_reloaded(self):
-        hlt = self.__storage.get("hookloadtime") or {}
-        myself = hlt.get(self._pid)
-        if not myself or (time() - myself) > self.__MAX_RELOAD_TIME:
-            self.__hooks = {}
-            self.__last_load_time = time()
+        """检查是否需要重新加载钩子
+
+        订阅中则仅在收到通知或超过重载时间时检查版本号，
+        未能订阅时(如未调用init_app)每秒最多检查一次。
+        """
+        now = time()
+        interval = self.__MAX_RELOAD_TIME if self.__listening else 1
+        if (now - self.__last_check_time) >= interval:
+            self.__last_check_time = now
+            version = self.__storage.get("hookversion", 0)
+            if version != self.__version:
+                self.__version = version
+                self.__hooks = {}
+
+    def __bump_version(self):
+        """递增钩子版本号，通知所有进程重建钩子"""
+        self.__version = self.__storage.incr("hookversion")
+        self.__compiled = None
+        self.__storage.publish(self.__channel, self.__version)
 
     @property
     def __third_hooks(self):
@@ -136,37 +149,29 @@ class HookManager(object):
         elif isinstance(third_hook_module_name, (list, tuple)):
             hooks.update(third_hook_module_name)
         self.__storage.set("hookthirds", list(set(hooks)))
+        self.__bump_version()
 
-    def __get_state_storage(self, name):
-        s = set(self.__storage.get("hookstate") or [])
-        d = "DISABLED.%s" % name
-        e = "ENABLED.%s" % name
-        if e in s:
-            return 'enabled'
-        elif d in s:
-            return 'disabled'
-        else:
-            return None
+    def __get_state_storage(self):
+        """一次性读取所有钩子状态，返回 {钩子名: enabled或disabled}
 
-    def __get_state(self, h):
-        s = self.__get_state_storage(h.name)
-        if s is None:
-            s = h.state
-        return s
+        .. versionchanged:: 1.11.0
+            每个钩子状态是独立哈希的一个字段，兼容迁移旧的hookstate列表
+        """
+        states = self.__storage.hgetall("hookstate")
+        if not states:
+            old = self.__storage.get("hookstate")
+            if old and isinstance(old, list):
+                for s in old:
+                    state, name = s.split(".", 1)
+                    states[name] = state.lower()
+                self.__storage.hmset("hookstate", states)
+                self.__storage.remove("hookstate")
+        return states
 
     def __set_state_storage(self, name, state):
-        s = set(self.__storage.get("hookstate") or [])
-        d = "DISABLED.%s" % name
-        e = "ENABLED.%s" % name
-        if state == "disabled":
-            if e in s:
-                s.remove(e)
-            s.add(d)
-        elif state == "enabled":
-            if d in s:
-                s.remove(d)
-            s.add(e)
-        self.__storage.set("hookstate", list(s))
+        if state in ("enabled", "disabled"):
+            self.__storage.hset("hookstate", name, state)
+            self.__bump_version()
 
     def __get_fileorparent(self, obj, ask_dir=False):
         py = abspath(obj.__file__.replace(".pyc", ".py"))
@@ -175,6 +180,61 @@ class HookManager(object):
     def __init_load_hooks(self):
         self.__scan_local()
         self.__scan_third()
+        self.__compiled = None
+
+    def __compile(self):
+        """根据钩子状态生成本进程的钩子表，扩展点调用表在首次使用时填充"""
+        states = self.__get_state_storage()
+        hooks = sorted(list(self.__hooks.values()), key=lambda h: h.name)
+        for h in hooks:
+            h["state"] = states.get(h.name) or getattr(
+                h.proxy, "__state__", "enabled"
+            )
+        enabled = [h for h in hooks if h.state == "enabled"]
+        self.__compiled = dict(
+            all=hooks,
+            map={h.name: h for h in hooks},
+            enabled=enabled,
+            enabled_map={h.name: h for h in enabled},
+            dispatch={},
+        )
+        return self.__compiled
+
+    def __get_compiled(self):
+        self.__ensure_reloaded()
+        if not self.__hooks:
+            self.__init_load_hooks()
+        return self.__compiled or self.__compile()
+
+    def __get_dispatch(self, kind, name):
+        """获取扩展点对应的已启用钩子及其方法/变量，按钩子名排序
+
+        :param str kind: func、tpl、bool或all
+        :param str name: 扩展点名称
+        :returns: list of (hook, attribute)
+        """
+        compiled = self.__get_compiled()
+        key = (kind, name)
+        if key not in compiled["dispatch"]:
+            table = []
+            for h in compiled["enabled"]:
+                if kind == "tpl":
+                    attr = getattr(h.proxy, "intpl_%s" % name, None)
+                    hin = bool(attr)
+                else:
+                    attr = getattr(h.proxy, name, None)
+                    if kind == "func":
+                        hin = callable(attr)
+                    elif kind == "bool":
+                        hin = attr is True
+                    else:
+                        hin = callable(attr) or bool(
+                            getattr(h.proxy, "intpl_%s" % name, None)
+                        )
+                if hin:
+                    table.append((h, attr))
+            compiled["dispatch"][key] = table
+        return compiled["dispatch"][key]
 
     def __scan_local(self):
         if isdir(self.__hook_dir):
@@ -236,9 +296,8 @@ class HookManager(object):
         name = getattr(
             f_obj, "__hookname__", f_obj.__name__.split('.')[-1],
         )
-        state = self.__get_state_storage(name)
-        if state is None:
-            state = getattr(f_obj, "__state__", "enabled")
+        #: 实际状态在生成钩子表时根据存储的hookstate确定
+        state = getattr(f_obj, "__state__", "enabled")
         (author, mail) = parse_author_mail(f_obj.__author__)
         return Attribution({
             "author": author,
@@ -265,20 +324,12 @@ class HookManager(object):
 
     @property
     def get_all_hooks(self):
-        """Get all hooks, enabled and disabled, returns list"""
-        self.__ensure_reloaded()
-        if not self.__hooks:
-            self.__init_load_hooks()
-        try:
-            hooks = self.__hooks.values()
-            data = []
-            for h in hooks:
-                h["state"] = self.__get_state(h)
-                data.append(h)
-        except RuntimeError:
-            return self.get_all_hooks
-        else:
-            return data
+        """Get all hooks, enabled and disabled, returns list
+
+        .. versionchanged:: 1.11.0
+            按钩子名排序，钩子状态仅在版本号变化时重新读取
+        """
+        return list(self.__get_compiled()["all"])
 
     @property
     def get_all_hooks_for_api(self):
@@ -304,25 +355,17 @@ class HookManager(object):
     @property
     def get_map_hooks(self):
         """Get all hooks, enabled and disabled, returns dict"""
-        return {h.name: h for h in self.get_all_hooks}
+        return dict(self.__get_compiled()["map"])
 
     @property
     def get_enabled_hooks(self):
         """Get all enabled hooks, return list"""
-        return [
-            h
-            for h in self.get_all_hooks
-            if h.state == 'enabled'
-        ]
+        return list(self.__get_compiled()["enabled"])
 
     @property
     def get_enabled_map_hooks(self):
         """Get map enabled hooks, return dict"""
-        return {
-            name: h
-            for name, h in iteritems(self.get_map_hooks)
-            if h.state == 'enabled'
-        }
+        return dict(self.__get_compiled()["enabled_map"])
 
     def disable(self, name):
         """禁用钩子"""
@@ -336,8 +379,8 @@ class HookManager(object):
 
     def reload(self):
         self.__hooks = {}
-        self.__last_load_time = 0
         self.__init_load_hooks()
+        self.__bump_version()
 
     def add_third_hook(self, third_hook_module_name):
         """添加第三方钩子
@@ -369,45 +412,29 @@ class HookManager(object):
         :param str name: 钩子名称（__hookname__），非其模块名
         :param bool is_enabled: True表示仅从已启用钩子中查找方法，否则查找所有
         """
-        if is_enabled:
-            if name in self.get_enabled_map_hooks:
-                return self.get_enabled_map_hooks[name]["proxy"]
-        else:
-            if name in self.get_map_hooks:
-                return self.get_map_hooks[name]["proxy"]
+        compiled = self.__get_compiled()
+        hooks = compiled["enabled_map"] if is_enabled else compiled["map"]
+        if name in hooks:
+            return hooks[name]["proxy"]
 
     def get_call_list(
         self, _callname, _include=None, _exclude=None, _type='all'
     ):
         """获取所有启用钩子的某个类型对应的方法/变量"""
+        if _type not in ("func", "tpl", "bool"):
+            _type = "all"
         hooks = []
-        for h in sorted(self.get_enabled_hooks, key=lambda h: h.name):
+        for h, _ in self.__get_dispatch(_type, _callname):
             if _include and isinstance(_include, (tuple, list)):
                 if h.name not in _include:
                     continue
             if _exclude and isinstance(_exclude, (tuple, list)):
                 if h.name in _exclude:
                     continue
-            hin = False
-            tpl = getattr(h.proxy, "intpl_%s" % _callname, None)
-            cn = getattr(h.proxy, _callname, None)
-            if _type == "func":
-                if callable(cn):
-                    hin = True
-            elif _type == "tpl":
-                if tpl:
-                    hin = True
-            elif _type == "bool":
-                if cn is True:
-                    hin = True
-            else:
-                if callable(cn) or tpl:
-                    hin = True
-            if hin:
-                if PY2 and h.description:
-                    if not isinstance(h.description, text_type):
-                        h["description"] = h.description.decode("utf-8")
-                hooks.append(dict(name=h.name, description=h.description))
+            if PY2 and h.description:
+                if not isinstance(h.description, text_type):
+                    h["description"] = h.description.decode("utf-8")
+            hooks.append(dict(name=h.name, description=h.description))
         return hooks
 
     def call(
@@ -434,53 +461,51 @@ class HookManager(object):
             kwargs replaced by `_kwargs`
         """
         response = []
-        for h in sorted(self.get_enabled_hooks, key=lambda h: h.name):
+        for h, func in self.__get_dispatch("func", _funcname):
             if _include and isinstance(_include, (tuple, list)):
                 if h.name not in _include:
                     continue
             if _exclude and isinstance(_exclude, (tuple, list)):
                 if h.name in _exclude:
                     continue
-            func = getattr(h.proxy, _funcname, None)
-            if callable(func):
-                try:
-                    if isinstance(_args, (list, tuple)) and \
-                            isinstance(_kwargs, dict):
-                        result = func(*_args, **_kwargs)
-                    elif isinstance(_kwargs, dict):
-                        result = func(**_kwargs)
-                    elif isinstance(_args, (list, tuple)):
-                        result = func(*_args)
-                    else:
-                        result = func()
-                except (ValueError, TypeError, Exception) as e:
-                    result = dict(code=1, msg=str(e))
+            try:
+                if isinstance(_args, (list, tuple)) and \
+                        isinstance(_kwargs, dict):
+                    result = func(*_args, **_kwargs)
+                elif isinstance(_kwargs, dict):
+                    result = func(**_kwargs)
+                elif isinstance(_args, (list, tuple)):
+                    result = func(*_args)
                 else:
-                    if isinstance(result, dict):
-                        if "code" not in result:
-                            result["code"] = 0
-                    else:
-                        result = dict(code=0, data=result)
-
-                result["sender"] = h.name
-                #: Use `_every` to change the hook execution result
-                if callable(_every):
-                    r = _every(result)
-                    if isinstance(r, dict) and "code" in r:
-                        if "sender" not in r:
-                            r["sender"] = h.name
-                        result = r
-                response.append(result)
-
-                if _mode == "any_true":
-                    #: 任意钩子处理成功时则中止后续
-                    if result.get("code") == 0:
-                        break
-
-                elif _mode == "any_false":
-                    #: 任意钩子处理失败时则中止后续
-                    if result.get("code") != 0:
-                        break
+                    result = func()
+            except (ValueError, TypeError, Exception) as e:
+                result = dict(code=1, msg=str(e))
+            else:
+                if isinstance(result, dict):
+                    if "code" not in result:
+                        result["code"] = 0
+                else:
+                    result = dict(code=0, data=result)
+
+            result["sender"] = h.name
+            #: Use `_every` to change the hook execution result
+            if callable(_every):
+                r = _every(result)
+                if isinstance(r, dict) and "code" in r:
+                    if "sender" not in r:
+                        r["sender"] = h.name
+                    result = r
+            response.append(result)
+
+            if _mode == "any_true":
+                #: 任意钩子处理成功时则中止后续
+                if result.get("code") == 0:
+                    break
+
+            elif _mode == "any_false":
+                #: 任意钩子处理失败时则中止后续
+                if result.get("code") != 0:
+                    break
 
         return response
 
@@ -495,7 +520,7 @@ class HookManager(object):
         :returns: Markup HTML
         """
         result = []
-        for h in sorted(self.get_enabled_hooks, key=lambda h: h.name):
+        for h, tpl in self.__get_dispatch("tpl", _tplname):
             if _include and isinstance(_include, (tuple, list)):
                 if h.name not in _include:
                     continue
@@ -503,9 +528,6 @@ class HookManager(object):
                 if h.name in _exclude:
                     continue
             #: tpl is a file or html code or a func
-            tpl = getattr(h.proxy, "intpl_%s" % _tplname, None)
-            if not tpl:
-                continue
             if callable(tpl):
                 tpl = tpl()
             if tpl.split(".")[-1] in ("html", "htm", "xhtml"):
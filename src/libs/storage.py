@@ -71,6 +71,33 @@ class RedisStorage(object):
             return json.loads(v)
         return default
 
+    def incr(self, key, amount=1):
+        """increase the integer value of key and return it"""
+        return self._db.hincrby(self.index, key, amount)
+
+    def hgetall(self, name):
+        """get all fields of the separate hash `name`(with prefix)"""
+        return self._db.hgetall(rsp(name))
+
+    def hset(self, name, field, value):
+        """set field of the separate hash `name`(with prefix)"""
+        return self._db.hset(rsp(name), field, value)
+
+    def hmset(self, name, mapping):
+        """set multiple fields of the separate hash `name`(with prefix)"""
+        if mapping and isinstance(mapping, dict):
+            return self._db.hmset(rsp(name), mapping)
+
+    def publish(self, channel, message):
+        """publish message to channel(with prefix)"""
+        return self._db.publish(rsp(channel), message)
+
+    def subscribe(self, channel):
+        """subscribe channel(with prefix), returns pubsub object"""
+        ps = self._db.pubsub(ignore_subscribe_messages=True)
+        ps.subscribe(rsp(channel))
+        return ps
+
     def remove(self, key):
         """delete key from redis"""
         return self._db.hdel(self.index, key)
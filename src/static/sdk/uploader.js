@@ -12,7 +12,7 @@
 
 var up2picbed = (function () {
 
-    let version = '1.1.2';
+    let version = '1.2.0';
 
     /* 上传类，options配置项如下
      * @param url {String}:  [必需]上传接口
@@ -26,6 +26,7 @@ var up2picbed = (function () {
      * @param success {Function}: 响应成功时的回调(2xx,304表示成功)
      * @param fail {Fcuntion}: 响应失败时的回调，与success一样传递返回值
      * @param progress {Function}: 上传进度回调，传递百分比
+     * @param chunk {Int}: 图片超过此大小时分块上传（失败的分块会重试），单位Kb，默认0不分块
      */
     class Uploader {
 
@@ -38,6 +39,7 @@ var up2picbed = (function () {
             options.exts = options.exts || "jpg|png|gif|bmp|jpeg|webp";
             options.name = options.name || "picbed";
             options.timeout = parseInt(options.timeout || 5000);
+            options.chunk = parseInt(options.chunk || 0);
             options.responseType = "json";
             //当返回数据中code字段为0才触发success回调
             options.onSuccess = typeof options.success === "function" && options.success;
@@ -105,6 +107,11 @@ var up2picbed = (function () {
                 }
             }
 
+            //分块上传
+            if (o.chunk > 0 && FILE.size > o.chunk * 1024) {
+                return self._chunkedUpload(o, FILE);
+            }
+
             //构建post数据并发送异步请求
             let data = new FormData();
             data.append(o.name, FILE, FILE.name);
@@ -153,6 +160,81 @@ var up2picbed = (function () {
             }
         }
 
+        _request(o, action, params, body) {
+            /* 分块上传的请求，返回Promise，响应的code不为0时reject
+             * @param action: 上传接口的Action查询参数
+             * @param params {Object}: 其他查询参数
+             * @param body: FormData或分块数据(Blob)
+             */
+            let qs = [`Action=${action}`];
+            for (let key in params) {
+                qs.push(`${key}=${encodeURIComponent(params[key])}`);
+            }
+            let url = o.url + (o.url.indexOf("?") > -1 ? "&" : "?") + qs.join("&");
+            return new Promise((resolve, reject) => {
+                let xhr = new XMLHttpRequest();
+                xhr.timeout = o.timeout;
+                xhr.responseType = o.responseType;
+                xhr.open("POST", url, true);
+                if (typeof o.headers === 'object' && Object.keys(o.headers).length !== 0) {
+                    for (let key in o.headers) {
+                        xhr.setRequestHeader(key, o.headers[key]);
+                    }
+                }
+                if (body instanceof Blob) {
+                    xhr.setRequestHeader("Content-Type", "application/octet-stream");
+                }
+                xhr.onload = function () {
+                    let res = xhr.response;
+                    if (xhr.status >= 200 && xhr.status < 300 && typeof res === "object" && res.code === 0) {
+                        resolve(res);
+                    } else {
+                        reject(res);
+                    }
+                };
+                xhr.onerror = xhr.ontimeout = () => reject(null);
+                xhr.send(body);
+            });
+        }
+
+        _chunkedUpload(o, FILE) {
+            /* 分块上传：chunkInit -> chunkPut(按顺序，失败时查询chunkStatus续传) -> chunkComplete
+             */
+            let self = this,
+                retries = 3,
+                uploadId;
+            let init = new FormData();
+            init.append("filename", FILE.name);
+            init.append("size", FILE.size);
+            let put = (offset, chunkSize) => {
+                if (offset >= FILE.size) return Promise.resolve();
+                let end = Math.min(offset + chunkSize, FILE.size);
+                return self._request(o, "chunkPut", { upload_id: uploadId, offset: offset }, FILE.slice(offset, end)).then(res => {
+                    o.onProgress && o.onProgress(Math.floor(res.received / FILE.size * 100) + "%");
+                    return put(res.received, chunkSize);
+                }, res => {
+                    if (retries-- <= 0) return Promise.reject(res);
+                    return self._request(o, "chunkStatus", { upload_id: uploadId }).then(res => put(res.received, chunkSize));
+                });
+            };
+            return self._request(o, "chunkInit", {}, init).then(res => {
+                uploadId = res.upload_id;
+                return put(0, Math.min(res.chunk_size, o.chunk * 1024));
+            }).then(() => {
+                let data = new FormData();
+                if (typeof o.data === 'object' && Object.keys(o.data).length !== 0) {
+                    for (let key in o.data) {
+                        data.append(key, o.data[key]);
+                    }
+                }
+                return self._request(o, "chunkComplete", { upload_id: uploadId }, data);
+            }).then(res => {
+                o.onSuccess && o.onSuccess(res);
+            }, res => {
+                o.onFail && o.onFail(res);
+            });
+        }
+
         _alert(msg) {
             let f = (typeof layer !== "undefined" && typeof layer === "object") && layer.alert;
             if (!f) {
@@ -209,6 +291,7 @@ var up2picbed = (function () {
      * @param success: 上传成功的回调（通过字符串映射函数，传递响应结果，在脚本执行之前全局要有此函数，否则不生效）
      * @param fail: 上传失败或错误的回调（同success）
      * @param progress: 上传进度回调，传递百分比
+     * @param chunk: 图片超过此大小时分块上传，单位Kb，默认不分块
      */
     let init = (opt) => {
         if (!opt) opt = {};
@@ -254,6 +337,7 @@ var up2picbed = (function () {
             name: name,
             size: opt.size || getSelf.dataset.size,
             exts: opt.exts || getSelf.dataset.exts,
+            chunk: opt.chunk || getSelf.dataset.chunk,
             data: data,
             headers: {
                 "Authorization": `LinkToken ${token}`
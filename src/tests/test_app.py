@@ -1,11 +1,41 @@
 # -*- coding: utf-8 -*-
 
+import json
 import unittest
+from io import BytesIO
+from threading import Thread
+from os.path import join, isfile
+from base64 import b64encode, b64decode
 from jinja2 import ChoiceLoader
-from utils.web import default_login_auth, get_site_config
-from utils.tool import generate_random
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from flask import g
+from redis import Redis
+import utils.web
+from utils.web import default_login_auth, get_site_config, \
+    bump_auth_version, rc, get_expire_member, prune_expired_images, \
+    get_album_counter_key, get_album_counter, get_image_index_key, \
+    save_derivatives, read_saved_image, push_report, flush_reports, \
+    add_album_index, remove_album_index, zrange_after, \
+    _site_cache
+from utils.tool import generate_random, rsp
 from app import app
-from utils.cli import exec_createuser
+from utils.cli import exec_createuser, exec_reindex, get_reindex_key
+from libs.storage import get_storage
+from config import GLOBAL
+from utils.job import enqueue_job, exec_worker, run_job, JOB_DELAYED, \
+    JOB_MAX_TRIES
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+PNG_BASE64 = (
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADElEQVR4nGNgYGAAAAAEAAH2"
+    "FzhVAAAAAElFTkSuQmCC"
+)
 
 
 class AppTest(unittest.TestCase):
@@ -32,6 +62,14 @@ class AppTest(unittest.TestCase):
         self.assertIn("api", self.app.blueprints)
         self.assertIn("front.index", self.app.view_functions)
 
+    def test_static_fast_path(self):
+        with self.client:
+            rv = self.client.get("/static/img/bg1.jpg")
+            self.assertEqual(200, rv.status_code)
+            self.assertTrue(g.is_static)
+            self.assertFalse(g.signin)
+            self.assertEqual(rv.headers["X-Content-Type-Options"], "nosniff")
+
     def test_api(self):
         #: No cookie
         self.logout()
@@ -67,6 +105,8 @@ class AppTest(unittest.TestCase):
             self.assertTrue(signin)
             self.assertIsInstance(userinfo, dict)
             self.assertEqual(user, userinfo["username"])
+            #: 命中进程内会话缓存
+            self.assertTrue(default_login_auth(data["sid"])[0])
 
         rv = self.client.get("/api/config")
         self.assertEqual(405, rv.status_code)
@@ -77,6 +117,13 @@ class AppTest(unittest.TestCase):
         rv = self.client.post("/api/config")
         self.assertEqual(404, rv.status_code)
 
+        #: 修改密码后缓存的会话失效
+        with self.app.test_request_context():
+            self.app.preprocess_request()
+            g.rc.hset(rsp("account", user), "password", "changed")
+            bump_auth_version(user)
+            self.assertFalse(default_login_auth(data["sid"])[0])
+
     def test_admin(self):
         user = "testadmin_" + generate_random()
         pwd = "pwd123"
@@ -90,6 +137,18 @@ class AppTest(unittest.TestCase):
         self.assertIn("hello", site)
         self.assertEqual(site["hello"], "world")
 
+        #: 其他进程修改配置：缓存时间内不重新读取，之后版本号变化才重新读取
+        storage = get_storage()
+        cfg = storage.get("siteconfig")
+        cfg["hello"] = "other"
+        storage.set("siteconfig", cfg)
+        self.assertEqual(get_site_config()["hello"], "world")
+        _site_cache["checked"] = 0
+        self.assertEqual(get_site_config()["hello"], "world")
+        rc.incr(rsp("config", "siteversion"))
+        _site_cache["checked"] = 0
+        self.assertEqual(get_site_config()["hello"], "other")
+
         hm = self.app.extensions["hookmanager"]
         self.client.post("/api/hook?Action=disable", data=dict(
             name='up2local'
@@ -100,6 +159,669 @@ class AppTest(unittest.TestCase):
         ))
         self.assertEqual(3, len(hm.get_enabled_hooks))
 
+    def test_waterfall(self):
+        user = ("test_" + generate_random()).lower()
+        pwd = "pwd123"
+        exec_createuser(user, pwd)
+        self.login(user, pwd)
+        shas = []
+        for name in ("first.png", "second.png"):
+            rv = self.client.post("/api/upload", data=dict(
+                picbed=PNG_BASE64, filename=name, album="test",
+            ))
+            data = rv.get_json()
+            self.assertEqual(0, data["code"])
+            shas.append(data["sha"])
+
+        rv = self.client.get("/api/waterfall?limit=1&page=1")
+        data = rv.get_json()
+        self.assertEqual(0, data["code"])
+        self.assertEqual(2, data["count"])
+        self.assertEqual(2, data["pageCount"])
+        self.assertEqual(1, len(data["data"]))
+
+        rv = self.client.get("/api/waterfall?limit=1&page=3")
+        self.assertEqual(3, rv.get_json()["code"])
+
+        rv = self.client.get("/api/waterfall?limit=1&cursor=")
+        data = rv.get_json()
+        self.assertEqual(shas[1], data["data"][0]["sha"])
+        rv = self.client.get(
+            "/api/waterfall?limit=1&cursor=" + data["next_cursor"]
+        )
+        data = rv.get_json()
+        self.assertEqual(shas[0], data["data"][0]["sha"])
+        rv = self.client.get(
+            "/api/waterfall?limit=1&cursor=" + data["next_cursor"]
+        )
+        self.assertEqual(3, rv.get_json()["code"])
+
+        rv = self.client.get("/api/album")
+        self.assertEqual({"test": 2}, rv.get_json()["counter"])
+        rv = self.client.put("/api/sha/" + shas[0], data=dict(
+            Action="updateAlbum", album="other",
+        ))
+        self.assertEqual(0, rv.get_json()["code"])
+        rv = self.client.get("/api/album")
+        self.assertEqual(
+            {"test": 1, "other": 1}, rv.get_json()["counter"]
+        )
+        rv = self.client.get("/api/waterfall?album=other")
+        data = rv.get_json()
+        self.assertEqual(1, data["count"])
+        self.assertEqual(shas[0], data["data"][0]["sha"])
+        rv = self.client.get("/api/waterfall?album=other,test&limit=1")
+        data = rv.get_json()
+        self.assertEqual(2, data["count"])
+        self.assertEqual(shas[1], data["data"][0]["sha"])
+
+        for sha in shas:
+            rv = self.client.delete("/api/sha/" + sha)
+            self.assertEqual(0, rv.get_json()["code"])
+        rv = self.client.get("/api/waterfall")
+        self.assertEqual(3, rv.get_json()["code"])
+        rv = self.client.get("/api/album")
+        self.assertEqual({}, rv.get_json()["counter"])
+        #: 重复删除或添加同一图片时计数不变
+        pipe = rc.pipeline()
+        remove_album_index(pipe, shas[1], "test", user)
+        remove_album_index(pipe, shas[1], "test", user)
+        pipe.execute()
+        self.assertEqual("0", rc.hget(get_album_counter_key(user), "test"))
+        self.assertEqual("0", rc.hget(get_album_counter_key(), "test"))
+        pipe = rc.pipeline()
+        add_album_index(pipe, shas[1], 1, "test", user)
+        add_album_index(pipe, shas[1], 1, "test", user)
+        pipe.execute()
+        self.assertEqual({"test": 1}, get_album_counter(user))
+        pipe = rc.pipeline()
+        remove_album_index(pipe, shas[1], "test", user)
+        pipe.execute()
+        self.assertEqual({}, get_album_counter(user))
+        self.logout()
+
+    def test_zrange_after(self):
+        key = rsp("test", "zrange_after", generate_random())
+        #: 同一分数的大量成员夹在不同分数之间
+        rc.zadd(key, {"a": 3, "z": 1})
+        rc.zadd(key, {"m%03d" % i: 2 for i in range(95)})
+        for reverse in (True, False):
+            full = rc.zrange(key, 0, -1, desc=reverse, withscores=True)
+            pages, cursor = [], None
+            while True:
+                items = zrange_after(key, cursor, 10, reverse)
+                if not items:
+                    break
+                pages.extend(items)
+                cursor = (items[-1][1], items[-1][0])
+            self.assertEqual(full, pages)
+            #: 游标成员已被删除时从其原位置之后继续
+            for i in (0, 40, 94):
+                member = "m%03d" % i
+                rank = [m for m, _ in full].index(member)
+                rc.zrem(key, member)
+                self.assertEqual(
+                    full[rank + 1:rank + 6],
+                    zrange_after(key, (2, member), 5, reverse),
+                )
+                rc.zadd(key, {member: 2})
+        rc.delete(key)
+
+    def create_linktoken(self, **rules):
+        """登录并创建Token、LinkToken，返回(LinkToken, LinkId)"""
+        user = ("test_" + generate_random()).lower()
+        pwd = "pwd123"
+        exec_createuser(user, pwd)
+        self.login(user, pwd)
+        rv = self.client.post("/api/token?Action=create").get_json()
+        self.assertEqual(0, rv["code"])
+        rv = self.client.post("/api/link", data=rules).get_json()
+        self.assertEqual(0, rv["code"])
+        self.logout()
+        LinkToken = rv["LinkToken"]
+        LinkId = b64decode(LinkToken).decode("utf-8").split(":")[1]
+        return LinkToken, LinkId
+
+    def test_linktoken_rule(self):
+        ttl = GLOBAL["AuthCacheTime"]
+        #: 不缓存认证数据，修改规则后立即生效
+        GLOBAL["AuthCacheTime"] = 0
+        try:
+            LinkToken, LinkId = self.create_linktoken(
+                allow_ep="api.album", allow_method="get"
+            )
+            key = rsp("linktoken", LinkId)
+            rules = self.app.extensions["hookmanager"].proxy("token")._rules
+
+            def allowed(ip="127.0.0.1", origin=None, method="get", **fields):
+                if fields:
+                    rc.hmset(key, fields)
+                headers = {
+                    "Authorization": "LinkToken " + LinkToken,
+                    "X-Real-Ip": ip,
+                }
+                if origin:
+                    headers["Origin"] = origin
+                rv = self.client.open(
+                    "/api/album", method=method, headers=headers
+                )
+                return rv.status_code == 200
+
+            #: ep、method
+            self.assertTrue(allowed())
+            self.assertFalse(allowed(method="post"))
+            self.assertFalse(allowed(allow_ep="api.upload"))
+            self.assertTrue(allowed(allow_ep="api.upload,api.album"))
+            #: ip及CIDR
+            self.assertFalse(allowed(allow_ip="10.0.0.0/8"))
+            self.assertTrue(allowed(ip="10.1.2.3"))
+            self.assertTrue(allowed(allow_ip="127.0.0.1,10.0.0.0/8"))
+            self.assertFalse(allowed(ip="192.168.1.1"))
+            #: origin
+            self.assertFalse(allowed(allow_ip="", allow_origin="http://a.com"))
+            self.assertTrue(allowed(origin="http://a.com"))
+            self.assertFalse(allowed(origin="http://b.com"))
+            #: ir取反
+            self.assertTrue(allowed(
+                origin="http://b.com", interior_relation="not in:origin"
+            ))
+            self.assertFalse(allowed(origin="http://a.com"))
+            self.assertFalse(allowed(
+                allow_origin="", allow_ip="10.0.0.0/8",
+                interior_relation="not in:ip",
+                ip="10.1.2.3",
+            ))
+            self.assertTrue(allowed(ip="192.168.1.1"))
+            #: er
+            rc.hmset(key, dict(
+                allow_ip="10.0.0.0/8", allow_origin="http://a.com",
+                interior_relation="",
+            ))
+            self.assertFalse(allowed())
+            self.assertTrue(allowed(
+                origin="http://a.com", exterior_relation="ip or origin"
+            ))
+            self.assertTrue(allowed(ip="10.1.2.3"))
+            self.assertFalse(allowed())
+            #: er中未包含的参数不校验
+            self.assertTrue(allowed(ip="10.1.2.3", method="post"))
+            self.assertTrue(allowed(exterior_relation="not ip"))
+            self.assertFalse(allowed(ip="10.1.2.3"))
+            #: er_pat拒绝或语法错误的er一律拒绝
+            self.assertFalse(allowed(exterior_relation="__import__('os')"))
+            self.assertFalse(allowed(exterior_relation="ip ep"))
+            #: 规则字段不变时复用编译结果，变化时重新编译
+            rc.hmset(key, dict(exterior_relation="", allow_ip=""))
+            self.assertTrue(allowed(origin="http://a.com"))
+            rule = rules[LinkId][1]
+            self.assertTrue(allowed(origin="http://a.com"))
+            self.assertIs(rule, rules[LinkId][1])
+            self.assertFalse(allowed(
+                origin="http://a.com", allow_method="post"
+            ))
+            self.assertIsNot(rule, rules[LinkId][1])
+        finally:
+            GLOBAL["AuthCacheTime"] = ttl
+
+    def test_auth_cache(self):
+        LinkToken, LinkId = self.create_linktoken(
+            allow_ep="api.album", allow_method="get"
+        )
+        user = rc.hget(rsp("linktoken", LinkId), "user")
+        ak = rsp("account", user)
+        token = rc.hget(ak, "token")
+        hook = self.app.extensions["hookmanager"].proxy("token")
+        ttl = GLOBAL["AuthCacheTime"]
+        now = hook.time
+        offset = [0]
+        hook.time = lambda: now() + offset[0]
+        GLOBAL["AuthCacheTime"] = 60
+
+        def status(prefix, value):
+            return self.client.get("/api/album", headers={
+                "Authorization": "%s %s" % (prefix, value),
+            }).status_code
+
+        try:
+            self.assertEqual(200, status("Token", token))
+            self.assertEqual(200, status("LinkToken", LinkToken))
+            #: 缓存有效期内使用缓存的数据
+            rc.hset(rsp("linktoken", LinkId), "status", 0)
+            self.assertEqual(200, status("LinkToken", LinkToken))
+            #: 过期后禁用的LinkToken被拒绝
+            offset[0] = 61
+            self.assertEqual(403, status("LinkToken", LinkToken))
+            self.assertEqual(200, status("Token", token))
+            rc.hdel(ak, "token")
+            self.assertEqual(200, status("Token", token))
+            offset[0] = 122
+            self.assertEqual(403, status("Token", token))
+            #: 不缓存时立即生效
+            GLOBAL["AuthCacheTime"] = 0
+            hook._auth_cache.clear()
+            rc.hset(ak, "token", token)
+            self.assertEqual(200, status("Token", token))
+            rc.hdel(ak, "token")
+            self.assertEqual(403, status("Token", token))
+        finally:
+            hook.time = now
+            GLOBAL["AuthCacheTime"] = ttl
+
+    def test_report(self):
+        user = ("test_" + generate_random()).lower()
+        pwd = "pwd123"
+        exec_createuser(user, pwd)
+        self.login(user, pwd)
+        interval = GLOBAL["ReportFlushInterval"]
+        maxlen = GLOBAL["ReportMaxRecords"]
+        #: 关闭后台线程，立即写入
+        GLOBAL["ReportFlushInterval"] = 0
+        GLOBAL["ReportMaxRecords"] = 3
+        try:
+            for n in range(4):
+                push_report("linktokens", user, dict(n=n, agent="curl/7.0"))
+            self.assertEqual(0, flush_reports())
+            url = "/api/report/linktokens?limit=2&cursor="
+            data = self.client.get(url).get_json()
+            self.assertEqual(0, data["code"])
+            self.assertEqual(3, data["count"])
+            self.assertEqual([3, 2], [r["n"] for r in data["data"]])
+            self.assertIn("uap", data["data"][0])
+            cursor = data["next_cursor"]
+            data = self.client.get(url + cursor).get_json()
+            self.assertEqual([1], [r["n"] for r in data["data"]])
+            self.assertIsNone(data["next_cursor"])
+            #: 超过保留上限被删除的记录不会在下一页出现
+            push_report("linktokens", user, dict(n=4))
+            data = self.client.get(url + cursor).get_json()
+            self.assertEqual([], data["data"])
+            #: redis不可用时记录保留在缓冲区，下次写入
+            utils.web.rc = Redis(port=1, socket_connect_timeout=1)
+            try:
+                push_report("linktokens", user, dict(n=5))
+                self.assertEqual(0, flush_reports())
+            finally:
+                utils.web.rc = rc
+            self.assertEqual(1, flush_reports())
+            data = self.client.get(url).get_json()
+            self.assertEqual([5, 4], [r["n"] for r in data["data"]])
+        finally:
+            GLOBAL["ReportFlushInterval"] = interval
+            GLOBAL["ReportMaxRecords"] = maxlen
+        self.logout()
+
+    def test_expire_index(self):
+        user = ("test_" + generate_random()).lower()
+        pwd = "pwd123"
+        exec_createuser(user, pwd)
+        self.login(user, pwd)
+        ek = rsp("index", "expire")
+        rv = self.client.post("/api/upload", data=dict(
+            picbed=PNG_BASE64, filename="tmp.png", album="tmp", expire=60,
+        )).get_json()
+        self.assertEqual(0, rv["code"])
+        sha = rv["sha"]
+        member = get_expire_member(sha, user, "tmp")
+        self.assertIsNotNone(rc.zscore(ek, member))
+
+        rv = self.client.put("/api/sha/" + sha, data=dict(
+            Action="updateAlbum", album="other",
+        ))
+        self.assertEqual(0, rv.get_json()["code"])
+        self.assertIsNone(rc.zscore(ek, member))
+        member = get_expire_member(sha, user, "other")
+        self.assertIsNotNone(rc.zscore(ek, member))
+
+        rv = self.client.delete("/api/sha/" + sha)
+        self.assertEqual(0, rv.get_json()["code"])
+        self.assertIsNone(rc.zscore(ek, member))
+        #: 残留的过期成员不会再次扣减相册计数
+        rc.zadd(ek, {member: 1})
+        prune_expired_images()
+        self.assertIsNone(rc.zscore(ek, member))
+        self.assertEqual(
+            "0", rc.hget(get_album_counter_key(user), "other")
+        )
+        self.logout()
+
+    def test_reindex(self):
+        user = ("test_" + generate_random()).lower()
+        pwd = "pwd123"
+        exec_createuser(user, pwd)
+        self.login(user, pwd)
+        rv = self.client.post("/api/upload", data=dict(
+            picbed=PNG_BASE64, filename="index.png", album="reindex",
+        )).get_json()
+        self.assertEqual(0, rv["code"])
+        #: 模拟残留的索引与上次中断的临时键
+        stale = rsp("index", "album", "global", "stale_" + user)
+        rc.zadd(stale, {"nosha": 1})
+        rc.zadd(get_reindex_key(get_image_index_key(user)), {"nosha": 1})
+        self.assertGreaterEqual(exec_reindex(rc), 1)
+        self.assertFalse(rc.exists(stale))
+        self.assertEqual(
+            [rv["sha"]], rc.zrange(get_image_index_key(user), 0, -1)
+        )
+        self.assertEqual({"reindex": 1}, get_album_counter(user))
+        self.assertEqual(
+            [], list(rc.scan_iter(match=get_reindex_key(rsp("index", "*"))))
+        )
+        self.client.delete("/api/sha/" + rv["sha"])
+        self.logout()
+
+    def test_job_worker(self):
+        user = ("test_" + generate_random()).lower()
+        pwd = "pwd123"
+        exec_createuser(user, pwd)
+        self.login(user, pwd)
+        rv = self.client.post("/api/upload", data=dict(
+            picbed=PNG_BASE64, filename="job.png",
+        )).get_json()
+        self.assertEqual(0, rv["code"])
+        sha = rv["sha"]
+        info = rc.hgetall(rsp("image", sha))
+        filepath = join(
+            self.app.static_folder, self.app.config["UPLOAD_FOLDER"],
+            info["upload_path"], info["filename"],
+        )
+        self.assertTrue(isfile(filepath))
+        #: 删除任务由后台执行
+        enqueue_job(
+            "delete", sha, "up2local", upload_path=info["upload_path"],
+            filename=info["filename"],
+            save_result=json.loads(info["senders"])[0],
+        )
+        self.assertEqual(1, exec_worker(self.app, burst=True, timeout=1))
+        self.assertFalse(isfile(filepath))
+        #: 失败的任务延迟重试，超过最大尝试次数时标记为失败
+        enqueue_job("save", sha, "nonexistent")
+        self.assertEqual(1, exec_worker(self.app, burst=True, timeout=1))
+        delayed = rc.zrange(JOB_DELAYED, 0, -1)
+        self.assertEqual(1, len(delayed))
+        self.assertEqual(1, json.loads(delayed[0])["tries"])
+        rc.delete(JOB_DELAYED)
+        with self.app.test_request_context():
+            self.app.preprocess_request()
+            job = dict(action="save", sha=sha, sender="nonexistent")
+            self.assertFalse(run_job(dict(job, tries=JOB_MAX_TRIES - 1)))
+        self.assertEqual(
+            "failed", rc.hget(rsp("image", sha), "replica:nonexistent")
+        )
+        self.assertEqual(0, rc.zcard(JOB_DELAYED))
+        self.client.delete("/api/sha/" + sha)
+        self.logout()
+
+    def test_load_fetch(self):
+        content = b64decode(PNG_BASE64)
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), Handler)
+        t = Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        user = ("test_" + generate_random()).lower()
+        pwd = "pwd123"
+        exec_createuser(user, pwd)
+        self.login(user, pwd)
+        url = "http://127.0.0.1:%s/remote.png" % server.server_port
+        rv = self.client.post(
+            "/api/load?fetch=true", json=[dict(url=url, album="load")],
+            base_url="http://pic.example.com",
+        ).get_json()
+        self.assertEqual(0, rv["code"])
+        self.assertEqual(dict(todo=1, fail=0), rv["count"])
+        self.assertEqual(1, exec_worker(self.app, burst=True, timeout=1))
+        server.shutdown()
+        server.server_close()
+        rv = self.client.get("/api/load/" + rv["jobid"]).get_json()
+        self.assertEqual(0, rv["code"])
+        self.assertEqual("done", rv["data"]["status"])
+        self.assertEqual(1, rv["data"]["success"])
+        result = rv["results"][0]
+        #: 图片地址使用创建任务时请求的站点，而不是localhost
+        self.assertTrue(result["src"].startswith("http://pic.example.com/"))
+        info = rc.hgetall(rsp("image", result["sha"]))
+        self.assertEqual("load", info["method"])
+        self.assertEqual("load", info["album"])
+        self.assertEqual(user, info["user"])
+        self.assertEqual("remote.png", info["filename"])
+        self.client.delete("/api/sha/" + result["sha"])
+        self.logout()
+
+    def test_dedup(self):
+        user = ("test_" + generate_random()).lower()
+        pwd = "pwd123"
+        exec_createuser(user, pwd)
+        self.login(user, pwd)
+        rvs = [
+            self.client.post("/api/upload", data=dict(
+                picbed=PNG_BASE64, filename=name,
+            )).get_json()
+            for name in ("first.png", "again.png")
+        ]
+        self.assertEqual(0, rvs[0]["code"])
+        self.assertEqual(0, rvs[1]["code"])
+        self.assertNotEqual(rvs[0]["sha"], rvs[1]["sha"])
+        self.assertEqual(rvs[0]["src"], rvs[1]["src"])
+        self.assertEqual("again.png", rvs[1]["filename"])
+        info = rc.hgetall(rsp("image", rvs[1]["sha"]))
+        self.assertEqual("again.png", info["filename"])
+        self.assertEqual("first.png", info["stored_filename"])
+        for rv in rvs:
+            rv = self.client.delete("/api/sha/" + rv["sha"])
+            self.assertEqual(0, rv.get_json()["code"])
+        self.logout()
+
+    def test_batch_upload(self):
+        user = ("test_" + generate_random()).lower()
+        pwd = "pwd123"
+        exec_createuser(user, pwd)
+        self.login(user, pwd)
+        content = b64decode(PNG_BASE64)
+        rv = self.client.post("/api/upload?Action=batch", data=dict(
+            picbed=[
+                (BytesIO(content), "a.png"),
+                (BytesIO(b"text"), "b.txt"),
+            ],
+            album="batch",
+        )).get_json()
+        self.assertEqual(0, rv["code"])
+        self.assertEqual(dict(success=1, fail=1), rv["count"])
+        self.assertEqual("a.png", rv["data"][0]["filename"])
+        self.assertEqual(1, rv["data"][1]["code"])
+        shas = [rv["data"][0]["sha"]]
+        lines = [
+            json.dumps(dict(picbed=PNG_BASE64, filename="c.png")),
+            "not json",
+            json.dumps(dict(picbed=PNG_BASE64, filename="d.png", album=1)),
+        ]
+        rv = self.client.post(
+            "/api/upload?Action=batch", data="\n".join(lines),
+            content_type="application/x-ndjson",
+        ).get_json()
+        self.assertEqual(dict(success=1, fail=2), rv["count"])
+        self.assertEqual("Invalid JSON line", rv["data"][1]["msg"])
+        self.assertEqual("Parameter error", rv["data"][2]["msg"])
+        #: 字段类型错误时不保存图片
+        self.assertFalse(isfile(join(
+            self.app.static_folder, self.app.config["UPLOAD_FOLDER"],
+            user, "d.png",
+        )))
+        shas.append(rv["data"][0]["sha"])
+        for sha in shas:
+            rv = self.client.delete("/api/sha/" + sha)
+            self.assertEqual(0, rv.get_json()["code"])
+        self.logout()
+
+    def test_sha_batch(self):
+        user = ("test_" + generate_random()).lower()
+        pwd = "pwd123"
+        exec_createuser(user, pwd)
+        self.login(user, pwd)
+        shas = [
+            self.client.post("/api/upload", data=dict(
+                picbed=PNG_BASE64, filename=name,
+            )).get_json()["sha"]
+            for name in ("one.png", "two.png")
+        ]
+        rv = self.client.post("/api/sha", json=dict(sha=shas + ["nothing"]))
+        data = rv.get_json()
+        self.assertEqual(dict(success=2, fail=1), data["count"])
+        self.assertEqual("two.png", data["data"][shas[1]]["filename"])
+        self.assertEqual("Not Found", data["fail"]["nothing"])
+        rv = self.client.delete("/api/sha", data=dict(sha=",".join(shas)))
+        data = rv.get_json()
+        self.assertEqual(sorted(shas), sorted(data["success"]))
+        rv = self.client.post("/api/sha", data=dict(sha=shas[0]))
+        self.assertEqual(dict(success=0, fail=1), rv.get_json()["count"])
+        self.logout()
+
+    def test_chunked_upload(self):
+        user = ("test_" + generate_random()).lower()
+        pwd = "pwd123"
+        exec_createuser(user, pwd)
+        self.login(user, pwd)
+        content = b64decode(PNG_BASE64)
+        rv = self.client.post("/api/upload?Action=chunkInit", data=dict(
+            filename="chunked.png", size=len(content),
+        )).get_json()
+        self.assertEqual(0, rv["code"])
+        upload_id = rv["upload_id"]
+        url = "/api/upload?Action=%s&upload_id=" + upload_id
+        rv = self.client.post(url % "chunkComplete").get_json()
+        self.assertEqual("Chunked upload is incomplete", rv["msg"])
+        for offset in (0, 30, 30):
+            rv = self.client.post(
+                (url % "chunkPut") + "&offset=%d" % offset,
+                data=content[offset:offset + 30],
+                content_type="application/octet-stream",
+            ).get_json()
+            self.assertEqual(0, rv["code"])
+        self.assertEqual(60, rv["received"])
+        rv = self.client.post(
+            (url % "chunkPut") + "&offset=70", data=content[60:],
+            content_type="application/octet-stream",
+        ).get_json()
+        self.assertEqual("Invalid offset param", rv["msg"])
+        rv = self.client.post(
+            (url % "chunkPut") + "&offset=60", data=content[60:],
+            content_type="application/octet-stream",
+        ).get_json()
+        self.assertEqual(len(content), rv["received"])
+        rv = self.client.post(url % "chunkComplete", data=dict(
+            title="chunked",
+        )).get_json()
+        self.assertEqual(0, rv["code"])
+        self.assertEqual("chunked.png", rv["filename"])
+        sha = rv["sha"]
+        rv = self.client.post(url % "chunkStatus").get_json()
+        self.assertEqual("Chunked upload not found or expired", rv["msg"])
+        self.client.delete("/api/sha/" + sha)
+        self.logout()
+
+    @unittest.skipIf(Image is None, "Pillow is not installed")
+    def test_derivatives(self):
+        user = "testadmin_" + generate_random()
+        pwd = "pwd123"
+        exec_createuser(user, pwd, is_admin=1)
+        self.login(user, pwd)
+        self.client.post("/api/config", data=dict(
+            upload_derivatives="thumb:20", upload_dedup="off",
+        ))
+        buf = BytesIO()
+        Image.new("RGB", (80, 40)).save(buf, format="PNG")
+        rv = self.client.post("/api/upload", data=dict(
+            picbed=b64encode(buf.getvalue()).decode("utf-8"),
+            filename="big.png",
+        ))
+        data = rv.get_json()
+        self.assertEqual(0, data["code"])
+        self.assertIn("thumb", data["derivatives"])
+        self.assertTrue(data["derivatives"]["thumb"].endswith(".thumb.png"))
+        rv = self.client.get("/api/sha/" + data["sha"])
+        self.assertEqual(
+            data["derivatives"], rv.get_json()["data"]["derivatives"]
+        )
+        rv = self.client.get("/api/waterfall?limit=1")
+        self.assertEqual(
+            data["derivatives"], rv.get_json()["data"][0]["derivatives"]
+        )
+        rv = self.client.delete("/api/sha/" + data["sha"])
+        self.assertEqual(0, rv.get_json()["code"])
+        self.client.post("/api/config", data=dict(
+            upload_derivatives="", upload_dedup="user",
+        ))
+
+        #: 未设置衍生图规则时不读取原图
+        class Unreadable(object):
+
+            def read(self):
+                raise AssertionError("stream should not be read")
+
+        with self.app.test_request_context():
+            self.app.preprocess_request()
+            self.assertEqual(
+                {}, save_derivatives(Unreadable(), "a.png", "", "up2local")
+            )
+        self.logout()
+
+    @unittest.skipIf(Image is None, "Pillow is not installed")
+    def test_transform(self):
+        user = ("test_" + generate_random()).lower()
+        pwd = "pwd123"
+        exec_createuser(user, pwd)
+        self.login(user, pwd)
+        buf = BytesIO()
+        Image.new("RGB", (80, 40)).save(buf, format="PNG")
+        sha = self.client.post("/api/upload", data=dict(
+            picbed=b64encode(buf.getvalue()).decode("utf-8"),
+            filename="big.png",
+        )).get_json()["sha"]
+        rv = self.client.get("/img/%s?w=20&fmt=webp" % sha)
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual("image/webp", rv.mimetype)
+        self.assertEqual((20, 10), Image.open(BytesIO(rv.data)).size)
+        etag = rv.headers["ETag"]
+        rv = self.client.get("/img/%s?w=20&fmt=webp" % sha)
+        self.assertEqual(200, rv.status_code)
+        rv = self.client.get(
+            "/img/%s?w=20&fmt=webp" % sha, headers={"If-None-Match": etag}
+        )
+        self.assertEqual(304, rv.status_code)
+        rv = self.client.get("/img/%s?w=-1" % sha)
+        self.assertEqual(400, rv.status_code)
+        #: 宽高向上取整到步长，超过最大值时按最大值处理
+        rv = self.client.get("/img/%s?w=25" % sha)
+        self.assertEqual((30, 15), Image.open(BytesIO(rv.data)).size)
+        rv = self.client.get("/img/%s?w=99999&q=1000" % sha)
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual((80, 40), Image.open(BytesIO(rv.data)).size)
+        self.client.delete("/api/sha/" + sha)
+        self.assertEqual(404, self.client.get("/img/" + sha).status_code)
+        #: 不下载非存储后端的图片地址（如直接导入的地址）
+        rv = self.client.post("/api/load", json=[
+            dict(url="http://127.0.0.1:1/internal.png")
+        ]).get_json()
+        sha = rv["success"][0]["sha"]
+        with self.app.test_request_context():
+            self.app.preprocess_request()
+            with self.assertRaises(ValueError):
+                read_saved_image(rc.hgetall(rsp("image", sha)))
+        self.assertEqual(404, self.client.get("/img/" + sha).status_code)
+        self.client.delete("/api/sha/" + sha)
+        self.logout()
+
 
 if __name__ == '__main__':
     unittest.main()
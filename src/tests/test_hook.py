@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 
 import unittest
+from time import sleep
 from os import remove
 from os.path import join, isfile, dirname, abspath
+from flask import Flask
 from libs.hook import HookManager
+from libs.storage import get_storage
+from utils.web import fanout_call
+from utils.tool import rsp
 from utils._compat import PY2
 
 
@@ -78,6 +83,137 @@ class HookTest(unittest.TestCase):
         self.hm.reload()
         self.assertEqual(len(self.hm.get_enabled_hooks), 1)
 
+    @unittest.skipIf(PY2, "Damn py2 anomaly.")
+    def test_dispatch(self):
+        content = "\n".join([
+            "# -*- coding: utf-8 -*-",
+            "__version__ = '0.1.0'",
+            "__author__ = 'staugur'",
+            "__hookname__ = 'test'",
+            "intpl_test_tpl = '<p>test</p>'",
+            "test_bool = True",
+            "def test_func(*args, **kwargs):",
+            "    return dict(args=args, kwargs=kwargs)"
+        ])
+        with open(self.tf, "w") as fd:
+            fd.write(content)
+        self.hm.enable('test')
+        self.hm.reload()
+        tests = [dict(name="test", description=None)]
+        gcl = self.hm.get_call_list
+        self.assertEqual(gcl("test_func", _type="func"), tests)
+        self.assertEqual(gcl("test_tpl", _type="tpl"), tests)
+        self.assertEqual(gcl("test_bool", _type="bool"), tests)
+        self.assertEqual(gcl("test_tpl"), tests)
+        self.assertEqual(gcl("test_func", _type="tpl"), [])
+        self.assertEqual(gcl("nonexistent"), [])
+        self.hm.call("test_func", _every=self.callback)
+        #: 另一个进程的钩子表在版本号变化后重建
+        other = HookManager(hooks_dir="tests")
+        self.assertEqual(len(other.get_enabled_hooks), 1)
+        self.hm.disable('test')
+        self.assertEqual(self.hm.get_call_list("test_func"), [])
+        self.assertEqual(len(other.get_enabled_hooks), 1)
+        sleep(1)
+        self.assertEqual(len(other.get_enabled_hooks), 0)
+        self.assertEqual(other.call("test_func"), [])
+
+    @unittest.skipIf(PY2, "Damn py2 anomaly.")
+    def test_notify(self):
+        self.write_testmodule()
+        self.hm.enable('test')
+        self.hm.reload()
+        #: init_app后订阅钩子变更通知，收到通知即检查版本号
+        other = HookManager(Flask(__name__), hooks_dir="tests")
+        for _ in range(50):
+            if other._HookManager__listening:
+                break
+            sleep(0.1)
+        self.assertTrue(other._HookManager__listening)
+        self.assertEqual(len(other.get_enabled_hooks), 1)
+        self.hm.disable('test')
+        for _ in range(50):
+            if len(other.get_enabled_hooks) == 0:
+                break
+            sleep(0.1)
+        self.assertEqual(len(other.get_enabled_hooks), 0)
+
+    @unittest.skipIf(PY2, "Damn py2 anomaly.")
+    def test_hookstate(self):
+        storage = get_storage()
+        self.write_testmodule()
+        self.hm.disable('test')
+        self.assertEqual(storage.hgetall("hookstate").get("test"), "disabled")
+        self.hm.enable('test')
+        self.assertEqual(storage.hgetall("hookstate").get("test"), "enabled")
+        #: 兼容迁移旧的hookstate列表
+        storage._db.delete(rsp("hookstate"))
+        storage.set("hookstate", ["DISABLED.test"])
+        self.hm.reload()
+        self.assertEqual(len(self.hm.get_enabled_hooks), 0)
+        self.assertEqual(storage.hgetall("hookstate"), {"test": "disabled"})
+        self.assertIsNone(storage.get("hookstate"))
+
+    @unittest.skipIf(PY2, "Damn py2 anomaly.")
+    def test_fanout(self):
+        hooks = dict(
+            fanok="return dict(code=0, src='ok')",
+            fanfail="return dict(code=1, msg='fail')",
+            fanslow="sleep(0.3)\n    return dict(code=0, src='slow')",
+        )
+        files = []
+        for name, body in hooks.items():
+            files.append(join(dirname(self.tf), "forTest_%s.py" % name))
+            with open(files[-1], "w") as fd:
+                fd.write("\n".join([
+                    "from time import sleep",
+                    "__version__ = '0.1.0'",
+                    "__author__ = 'staugur'",
+                    "__hookname__ = '%s'" % name,
+                    "def upimg_save(**kwargs):",
+                    "    " + body,
+                ]))
+        app = Flask(__name__)
+        HookManager(app, hooks_dir="tests")
+        rollbacks = []
+
+        def fanout(names, quorum, timeout=5):
+            with app.test_request_context():
+                return {
+                    r["sender"]: r["code"] for r in fanout_call(
+                        "upimg_save", names, lambda name: {}, quorum,
+                        timeout, rollbacks.append,
+                    )
+                }
+
+        def wait_rollback(count):
+            for _ in range(20):
+                if len(rollbacks) >= count:
+                    break
+                sleep(0.1)
+            return [r["sender"] for r in rollbacks[:count]]
+
+        try:
+            self.assertEqual(
+                fanout(["fanok", "fanfail"], 1), dict(fanok=0, fanfail=1)
+            )
+            #: 未达到quorum时成功的结果也是失败，并回滚
+            self.assertEqual(
+                fanout(["fanok", "fanfail"], "all"), dict(fanok=1, fanfail=1)
+            )
+            self.assertEqual(wait_rollback(1), ["fanok"])
+            #: first时采纳最先成功的，之后完成的回滚
+            self.assertEqual(
+                fanout(["fanok", "fanslow"], "first"), dict(fanok=0, fanslow=1)
+            )
+            self.assertEqual(wait_rollback(2)[1:], ["fanslow"])
+            #: 超时的视为失败，完成后回滚
+            self.assertEqual(fanout(["fanslow"], 1, 0.1), dict(fanslow=1))
+            self.assertEqual(wait_rollback(3)[2:], ["fanslow"])
+        finally:
+            for f in files:
+                remove(f)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -3,6 +3,7 @@
 import unittest
 from config import REDIS as redis_url
 from libs.storage import RedisStorage
+from utils.tool import rsp
 
 
 class StorageTest(unittest.TestCase):
@@ -27,6 +28,14 @@ class StorageTest(unittest.TestCase):
             # RedisStorage allow remove
             del storage['test']
             self.assertIsNone(storage['test'])
+            # separate hash and counter
+            storage.hset("_test_hash", "a", "1")
+            storage.hmset("_test_hash", dict(b="2"))
+            self.assertEqual(storage.hgetall("_test_hash"), dict(a="1", b="2"))
+            storage._db.delete(rsp("_test_hash"))
+            self.assertEqual(storage.incr("_test_counter"), 1)
+            self.assertEqual(storage.incr("_test_counter", 2), 3)
+            del storage["_test_counter"]
 
 
 if __name__ == '__main__':
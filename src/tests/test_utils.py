@@ -1,12 +1,33 @@
 # -*- coding: utf-8 -*-
 
 import unittest
+from io import BytesIO
+from os import getpid, listdir
+from threading import Thread
+from shutil import rmtree
+from tempfile import mkdtemp
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 from utils.tool import Attribution, md5, sha1, rsp, get_current_timestamp, \
     allowed_file, parse_valid_comma, parse_valid_verticaline, is_true, \
     hmac_sha256, sha256, check_origin, get_origin, parse_data_uri, \
     format_upload_src, format_apires, generate_random, check_ip, gen_ua, \
-    is_valid_verion, is_match_appversion, bleach_html, parse_author_mail
+    is_valid_verion, is_match_appversion, bleach_html, parse_author_mail, \
+    encode_cursor, decode_cursor, check_ip_network, IPSet, parse_ua, \
+    try_request, get_http_session
+from utils.web import recompress_image, run_in_process, offload, \
+    _process_pool
+from utils._compat import ProcessPoolExecutor
+from libs.cache import DiskCache
+from config import GLOBAL
 from version import __version__ as VER
+try:
+    from PIL import Image, PngImagePlugin
+except ImportError:
+    Image = None
+
 
 class UtilsTest(unittest.TestCase):
 
@@ -114,6 +135,116 @@ class UtilsTest(unittest.TestCase):
             parse_author_mail("staugur <mail>"), ('staugur', 'mail')
         )
 
+    def test_cursor(self):
+        cursor = encode_cursor(1600000000, "sha1.1600000000.1.abc")
+        self.assertEqual(
+            decode_cursor(cursor), ["1600000000", "sha1.1600000000.1.abc"]
+        )
+        self.assertEqual(decode_cursor(encode_cursor(5), 1), ["5"])
+        with self.assertRaises(ValueError):
+            decode_cursor(encode_cursor(5))
+        with self.assertRaises(ValueError):
+            decode_cursor("!invalid")
+
+    def test_parse_ua(self):
+        ua = gen_ua()
+        uap = parse_ua(ua)
+        self.assertEqual(uap["platform"], "pc")
+        uap["platform"] = "changed"
+        self.assertEqual(parse_ua(ua)["platform"], "pc")
+
+    def test_http_session(self):
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = (self.headers.get("Cookie") or "").encode("utf-8")
+                self.send_response(200)
+                self.send_header("Set-Cookie", "sid=secret; Path=/")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), Handler)
+        t = Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        url = "http://127.0.0.1:%s/" % server.server_port
+        try:
+            #: 复用同一会话，但不会把上个请求的cookie发送给后续请求
+            self.assertIs(get_http_session(), get_http_session())
+            for _ in range(2):
+                resp = try_request(url, method="get")
+                self.assertEqual(200, resp.status_code)
+                self.assertEqual(b"", resp.content)
+            self.assertEqual(0, len(get_http_session().cookies))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    @unittest.skipIf(ProcessPoolExecutor is None, "futures is not installed")
+    def test_process_pool(self):
+        size = GLOBAL["ProcessPoolSize"]
+        try:
+            GLOBAL["ProcessPoolSize"] = 1
+            self.assertNotEqual(getpid(), run_in_process(getpid))
+            executor = _process_pool["executor"]
+            self.assertEqual(getpid(), _process_pool["pid"])
+            #: 同一进程中复用进程池，fork后(pid变化)重新创建
+            run_in_process(getpid)
+            self.assertIs(executor, _process_pool["executor"])
+            _process_pool["pid"] = None
+            run_in_process(getpid)
+            self.assertIsNot(executor, _process_pool["executor"])
+            executor.shutdown()
+            #: 小于阈值的数据直接执行，不创建进程池
+            _process_pool["pid"] = None
+            self.assertEqual(1, offload(len, b"x"))
+            self.assertIsNone(_process_pool["pid"])
+            data = b"x" * GLOBAL["ProcessPoolThreshold"] * 1024
+            self.assertEqual(len(data), offload(len, data))
+            self.assertEqual(getpid(), _process_pool["pid"])
+            #: 进程数为0时不使用进程池
+            GLOBAL["ProcessPoolSize"] = 0
+            self.assertEqual(getpid(), run_in_process(getpid))
+        finally:
+            GLOBAL["ProcessPoolSize"] = size
+
+    @unittest.skipIf(Image is None, "Pillow is not installed")
+    def test_recompress(self):
+        #: png优化时保留icc_profile及文本块
+        im = Image.new("RGB", (64, 64), "white")
+        info = PngImagePlugin.PngInfo()
+        info.add_text("Comment", "picbed")
+        info.add_itxt("Title", u"图床")
+        for _ in range(50):
+            info.add_text("Padding", "x" * 64)
+        buf = BytesIO()
+        im.save(buf, format="PNG", icc_profile=b"fake-icc", pnginfo=info)
+        data, suffix = recompress_image(buf.getvalue())
+        self.assertIsNotNone(data)
+        self.assertIsNone(suffix)
+        new = Image.open(BytesIO(data))
+        self.assertEqual(b"fake-icc", new.info["icc_profile"])
+        self.assertEqual("picbed", new.text["Comment"])
+        self.assertEqual(u"图床", new.text["Title"])
+        #: bmp转为png
+        buf = BytesIO()
+        im.save(buf, format="BMP")
+        data, suffix = recompress_image(buf.getvalue())
+        self.assertEqual(".png", suffix)
+        self.assertEqual("PNG", Image.open(BytesIO(data)).format)
+        #: 动图（apng）不处理
+        buf = BytesIO()
+        im.save(
+            buf, format="PNG", save_all=True,
+            append_images=[Image.new("RGB", (64, 64), "black")],
+        )
+        self.assertTrue(Image.open(BytesIO(buf.getvalue())).is_animated)
+        self.assertEqual((None, None), recompress_image(buf.getvalue()))
+
     def test_checkorigin(self):
         self.assertTrue(check_origin('http://127.0.0.1'))
         self.assertTrue(check_origin('http://localhost:5000'))
@@ -134,6 +265,55 @@ class UtilsTest(unittest.TestCase):
         self.assertFalse(check_ip("1.2.3"))
         self.assertFalse(check_ip("a.1.2.3"))
         self.assertFalse(check_ip("999.1.2.3"))
+        self.assertTrue(check_ip_network("10.0.0.0/8"))
+        self.assertTrue(check_ip_network("1.2.3.4"))
+        self.assertFalse(check_ip_network("10.0.0.0/33"))
+        self.assertFalse(check_ip_network("10.0.0/8"))
+        ips = IPSet(["1.2.3.4", "192.168.0.0/16"])
+        self.assertIn("1.2.3.4", ips)
+        self.assertIn("192.168.10.1", ips)
+        self.assertNotIn("192.169.0.1", ips)
+        self.assertNotIn("::1", ips)
+        self.assertFalse(IPSet([]))
+
+    def test_diskcache(self):
+        path = mkdtemp()
+        cache = DiskCache(path, 1000)
+        scans = []
+        scan = cache._scan
+
+        def counted_scan():
+            scans.append(1)
+            scan()
+
+        cache._scan = counted_scan
+        try:
+            for i in range(10):
+                cache.set(str(i), b"x" * 100)
+            self.assertEqual(1, len(scans))
+            self.assertEqual(1000, cache._size)
+            #: 访问后不会被优先淘汰
+            cache.get("0").close()
+            #: 超过上限时淘汰到低水位，不扫描目录
+            cache.set("10", b"x" * 100)
+            self.assertEqual(1, len(scans))
+            self.assertEqual(900, cache._size)
+            self.assertEqual(9, len(listdir(path)))
+            f = cache.get("0")
+            self.assertIsNotNone(f)
+            f.close()
+            self.assertIsNone(cache.get("1"))
+            self.assertIsNone(cache.get("2"))
+            cache.set("11", b"x" * 100)
+            self.assertEqual(10, len(listdir(path)))
+            #: 超过扫描间隔后淘汰时重建索引
+            cache._scan_time = 0
+            cache.set("12", b"x" * 100)
+            self.assertEqual(2, len(scans))
+            self.assertEqual(900, cache._size)
+            self.assertEqual(9, len(listdir(path)))
+        finally:
+            rmtree(path)
 
     def test_datauri(self):
         uri1 = 'data:,Hello%2C%20World!'
@@ -30,6 +30,8 @@ if PY2:  # pragma: nocover
     from urlparse import urlparse, urlsplit, parse_qs
     import ConfigParser
     import thread
+    from Queue import Queue, Empty
+    from cookielib import DefaultCookiePolicy
 
 else:  # pragma: nocover
 
@@ -46,6 +48,15 @@ else:  # pragma: nocover
     from urllib.request import Request, urlopen
     import configparser as ConfigParser
     import _thread as thread
+    from queue import Queue, Empty
+    from http.cookiejar import DefaultCookiePolicy
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+except ImportError:  # pragma: nocover
+    ProcessPoolExecutor = None
+    BrokenProcessPool = RuntimeError
 
 
 class Properties(object):
@@ -11,13 +11,16 @@
 
 import json
 import click
+from flask import current_app
 from flask.cli import AppGroup
 from redis.exceptions import RedisError
 from werkzeug.security import generate_password_hash
 from libs.storage import get_storage
 from .tool import rsp, get_current_timestamp, create_redis_engine, is_true, \
     parse_ua
-from .web import check_username, _pip_install
+from .web import check_username, _pip_install, get_image_index_key, \
+    add_image_index, get_digest_key
+from .job import exec_worker
 
 
 def echo(msg, color=None):
@@ -38,15 +41,17 @@ def exec_createuser(username, password, **kwargs):
             else:
                 is_admin = kwargs.pop("is_admin", 0)
                 uk = rsp("account", username)
+                ctime = get_current_timestamp()
                 pipe = rc.pipeline()
                 pipe.sadd(ak, username)
+                pipe.zadd(rsp("index", "accounts"), {username: ctime})
                 if kwargs:
                     pipe.hmset(uk, kwargs)
                 pipe.hmset(uk, dict(
                     username=username,
                     password=generate_password_hash(password),
                     is_admin=1 if is_true(is_admin) else 0,
-                    ctime=get_current_timestamp(),
+                    ctime=ctime,
                     status=1,
                 ))
                 try:
@@ -61,6 +66,106 @@ def exec_createuser(username, password, **kwargs):
         echo("用户名不合法或不允许注册", "yellow")
 
 
+#: 重建时先写入临时键的索引（键名前缀），完成后再替换原索引
+REINDEX_PREFIXES = tuple(
+    rsp("index", p)
+    for p in ("ctime", "album", "albums", "digest", "expire", "accounts")
+)
+
+
+def get_reindex_key(key):
+    """索引重建时的临时键，哈希标签使其与原键在redis集群的同一槽位"""
+    return "{%s}:reindex" % key
+
+
+class ReindexPipeline(object):
+    """把重建索引的写入重定向到临时键，其他命令照常在pipeline中执行"""
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+        #: 已写入的索引（原键名）
+        self.keys = set()
+
+    def _key(self, key):
+        if key.startswith(REINDEX_PREFIXES):
+            self.keys.add(key)
+            return get_reindex_key(key)
+        return key
+
+    def __getattr__(self, name):
+        method = getattr(self.pipe, name)
+
+        def wrapper(key, *args, **kwargs):
+            return method(self._key(key), *args, **kwargs)
+        return wrapper
+
+    def eval(self, script, numkeys, *args):
+        keys = [self._key(k) for k in args[:numkeys]]
+        return self.pipe.eval(script, numkeys, *(keys + list(args[numkeys:])))
+
+    def execute(self):
+        return self.pipe.execute()
+
+
+def exec_reindex(rc):
+    """根据全局集合索引重建图片的时间、相册、内容摘要索引，以及用户索引
+
+    .. versionchanged:: 1.11.0
+        新索引写入临时键后RENAME替换，重建期间原索引仍可正常读取
+    """
+    gk = rsp("index", "global")
+    shas = list(rc.smembers(gk))
+    #: 清理上次重建中断残留的临时键
+    stale = list(rc.scan_iter(
+        match=get_reindex_key(rsp("index", "*")), count=1000
+    ))
+    pipe = ReindexPipeline(rc.pipeline())
+    for k in stale:
+        pipe.pipe.delete(k)
+    #: 按注册时间排序的用户索引
+    for u in rc.smembers(rsp("accounts")):
+        ctime = rc.hget(rsp("account", u), "ctime")
+        pipe.zadd(rsp("index", "accounts"), {u: int(ctime or 0)})
+    for sha in shas:
+        pipe.hmget(
+            rsp("image", sha), "user", "ctime", "album", "digest",
+            "digest_scope",
+        )
+        pipe.ttl(rsp("image", sha))
+    result = pipe.execute()[-len(shas) * 2:] if shas else []
+    total = 0
+    for sha, (usr, ctime, album, digest, scope), ttl in zip(
+        shas, result[::2], result[1::2]
+    ):
+        if ctime is None:
+            #: 图片数据已不存在（比如临时图片已过期）
+            pipe.srem(gk, sha)
+            continue
+        ctime = int(ctime)
+        expire = 0
+        if ttl and ttl > 0:
+            expire = get_current_timestamp() + ttl - ctime
+        add_image_index(
+            pipe, sha, ctime, None if usr == "anonymous" else usr, expire,
+            album,
+        )
+        if digest and scope:
+            pipe.sadd(get_digest_key(digest, scope), sha)
+        total += 1
+    pipe.execute()
+    #: 替换已重建的索引，删除不再有数据的原索引
+    old = {rsp("index", "expire"), rsp("index", "accounts")}
+    for pat in ("ctime", "album", "albums", "digest"):
+        old.update(rc.scan_iter(match=rsp("index", pat, "*"), count=1000))
+    rp = rc.pipeline()
+    for k in pipe.keys:
+        rp.rename(get_reindex_key(k), k)
+    for k in old - pipe.keys:
+        rp.delete(k)
+    rp.execute()
+    return total
+
+
 sa_cli = AppGroup(
     'sa',
     help='Administrator commands',
@@ -103,19 +208,51 @@ def clean(hookloadtime, hookthirds, invalidkey):
         del s['hookthirds']
     if invalidkey:
         rc = create_redis_engine()
-        ius = rc.keys(rsp("index", "user", "*"))
+        ius = rc.scan_iter(match=rsp("index", "user", "*"), count=1000)
         pipe = rc.pipeline()
         for uk in ius:
             us = rc.smembers(uk)
             for sha in us:
                 if not rc.exists(rsp("image", sha)):
                     pipe.srem(uk, sha)
+                    pipe.zrem(
+                        get_image_index_key(uk.split(":")[-1]), sha
+                    )
         try:
             pipe.execute()
         except RedisError:
             pass
 
 
+@sa_cli.command()
+def reindex():
+    """重建图片索引（时间排序及相册）"""
+    rc = create_redis_engine()
+    try:
+        total = exec_reindex(rc)
+    except RedisError as e:
+        echo(e, "red")
+    else:
+        echo("已重建%s张图片的索引" % total, "green")
+    finally:
+        rc.connection_pool.disconnect()
+
+
+@sa_cli.command()
+@click.option('--burst/--no-burst', default=False,
+              help=u'队列为空时退出', show_default=True)
+def worker(burst):
+    """执行后台任务（异步复制图片到远程存储后端、删除图片等）"""
+    try:
+        total = exec_worker(current_app._get_current_object(), burst)
+    except RedisError as e:
+        echo(e, "red")
+    except KeyboardInterrupt:
+        pass
+    else:
+        echo("已执行%s个任务" % total, "green")
+
+
 @sa_cli.command()
 @click.confirmation_option(prompt=u'确定要升级更新吗？')
 @click.argument('v2v', type=click.Choice(['1.6-1.7', '1.7-1.8']))
@@ -141,7 +278,9 @@ def upgrade(v2v):
                 pipe.hset(rsp("account", i[0]), "status", 1)
         pipe.execute()
         #: 调整linktoken字段
-        rls = rc.keys(rsp("report", "linktokens", "*"))
+        rls = list(rc.scan_iter(
+            match=rsp("report", "linktokens", "*"), count=1000
+        ))
         for k in rls:
             data = rc.lrange(k, 0, -1)
             new = []
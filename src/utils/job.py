@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+    utils.job
+    ~~~~~~~~~
+
+    Redis-backed background jobs, such as replicating uploaded pictures
+    to slow remote storage backends and deleting them.
+
+    :copyright: (c) 2019 by staugur.
+    :license: BSD 3-Clause, see LICENSE for more details.
+"""
+
+import json
+from uuid import uuid4
+from time import time, sleep
+from functools import partial
+from redis.exceptions import WatchError
+from flask import g
+from .tool import logger, rsp, get_current_timestamp, Attribute, is_true, \
+    allowed_file, parse_valid_verticaline
+from .web import rc, get_site_config, delete_saved_image, spawn_in_context, \
+    ImgUrlFileStorage, read_saved_image, get_stored_filename, change_userinfo
+from ._compat import Queue, Empty, urlparse
+
+#: 待执行任务队列(list)及延迟重试的任务(zset，分数是执行时间)
+JOB_QUEUE = rsp("queue", "jobs")
+JOB_DELAYED = rsp("queue", "delayed")
+#: 任务最大尝试次数
+JOB_MAX_TRIES = 5
+#: 每个导入子任务的图片数，其图片数据在一个pipeline中写入
+LOAD_CHUNK_SIZE = 100
+#: 导入任务进度及结果的保留时间，秒
+LOAD_JOB_EXPIRE = 7 * 86400
+
+
+def enqueue_job(action, sha, sender, pipe=None, **data):
+    """添加任务
+
+    :param str action: 任务类型，save(复制图片到存储后端)、delete(删除图片)、
+                       load(下载并导入远程图片)
+    :param str sha: 图片唯一标识（导入任务时是任务ID）
+    :param str sender: 存储后端的钩子名（导入任务时为空）
+    :param pipe: redis pipeline，否则直接添加
+    :param data: 任务所需的其他数据
+    """
+    data.update(action=action, sha=sha, sender=sender, tries=0)
+    (pipe or rc).lpush(JOB_QUEUE, json.dumps(data))
+
+
+def get_replica_field(sender):
+    """图片数据中异步复制到存储后端的状态字段：pending、done、failed"""
+    return "replica:%s" % sender
+
+
+def _append_sender(sha, result):
+    """将存储后端保存结果加入图片的senders，使用乐观锁避免覆盖并发的更新
+
+    :returns: False表示图片已不存在
+    """
+    ik = rsp("image", sha)
+    with rc.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(ik)
+                senders = pipe.hget(ik, "senders")
+                if senders is None:
+                    return False
+                senders = json.loads(senders)
+                senders.append(result)
+                pipe.multi()
+                pipe.hset(ik, "senders", json.dumps(senders))
+                pipe.hset(ik, get_replica_field(result["sender"]), "done")
+                pipe.execute()
+                return True
+            except WatchError:
+                continue
+
+
+def _do_save(job):
+    ik = rsp("image", job["sha"])
+    info = rc.hgetall(ik)
+    if not info:
+        #: 图片已删除
+        return
+    stream = read_saved_image(info)
+    result = g.hm.call(
+        "upimg_save",
+        _include=[job["sender"]],
+        _kwargs=dict(
+            filename=get_stored_filename(info),
+            stream=stream,
+            upload_path=info["upload_path"],
+        ),
+    )
+    if not result:
+        raise ValueError("No valid backend storage service")
+    result = result[0]
+    if result.get("code") != 0:
+        raise ValueError(result.get("msg") or "Failed to save picture")
+    if not _append_sender(job["sha"], result):
+        #: 复制期间图片被删除了
+        delete_saved_image(
+            job["sha"], info["upload_path"], get_stored_filename(info),
+            [result]
+        )
+
+
+def _do_delete(job):
+    g.hm.proxy(job["sender"]).upimg_delete(
+        sha=job["sha"],
+        upload_path=job["upload_path"],
+        filename=job["filename"],
+        basedir=job["save_result"].get("basedir"),
+        save_result=job["save_result"],
+    )
+
+
+def get_load_key(jobid, *keys):
+    """导入任务进度(hash)及结果(list)的key"""
+    return rsp("load", jobid, *keys)
+
+
+def create_load_job(imgs, user, origin, base_url=None):
+    """创建导入任务，按 :data:`LOAD_CHUNK_SIZE` 拆分成多个子任务加入队列，
+    由后台任务下载图片并保存到存储后端
+
+    :param list imgs: 图片列表，元素是已校验url及filename的字典
+    :param str user: 导入图片的用户
+    :param str origin: 图片来源
+    :param str base_url: 站点根地址（请求的url_root），后台任务以此生成
+                         图片地址，否则是localhost
+    :returns: 任务ID
+    """
+    jobid = uuid4().hex
+    key = get_load_key(jobid)
+    pipe = rc.pipeline()
+    pipe.hmset(key, dict(
+        jobid=jobid,
+        user=user,
+        total=len(imgs),
+        done=0,
+        success=0,
+        fail=0,
+        status="running" if imgs else "done",
+        ctime=get_current_timestamp(),
+    ))
+    pipe.expire(key, LOAD_JOB_EXPIRE)
+    for i in range(0, len(imgs), LOAD_CHUNK_SIZE):
+        enqueue_job(
+            "load", jobid, None, pipe,
+            imgs=imgs[i:i + LOAD_CHUNK_SIZE], user=user, origin=origin,
+            base_url=base_url,
+        )
+    pipe.execute()
+    return jobid
+
+
+def wait_host_rate(host, rate):
+    """按域名限速，每秒最多请求rate次，计数在redis中，多个worker共享
+
+    :param str host: 域名
+    :param int rate: 每秒请求数，小于等于0表示不限制
+    """
+    if rate <= 0:
+        return
+    while True:
+        now = time()
+        key = rsp("ratelimit", "load", host, int(now))
+        pipe = rc.pipeline()
+        pipe.incr(key)
+        pipe.expire(key, 2)
+        if pipe.execute()[0] <= rate:
+            return
+        sleep(1 - now % 1)
+
+
+def _load_image(img, rate, allowed_suffix):
+    """下载一张远程图片，与上传接口一样由 :func:`views.api.save_upload`
+    保存到存储后端（包括去重、冗余存储及用户上传分组等规则）
+
+    :returns: 保存结果，code为0时含有图片数据字段
+    """
+    from views.api import save_upload
+    wait_host_rate(urlparse(img["url"]).netloc, rate)
+    fp = ImgUrlFileStorage(img["url"], img["filename"]).getObj
+    if not fp:
+        return dict(code=1, msg="Failed to download picture")
+    saved = save_upload(fp, allowed_suffix)
+    saved["method"] = "load"
+    return saved
+
+
+def _do_load(job):
+    """并发下载并保存一批远程图片，图片数据及任务进度在一个pipeline中写入"""
+    from views.api import index_upload
+    try:
+        concurrency = int(g.cfg.load_concurrency or 5)
+        rate = int(g.cfg.load_host_rate or 2)
+    except (ValueError, TypeError):
+        concurrency, rate = 5, 2
+    #: 以导入图片的用户身份保存，上传规则与上传接口一致
+    g.userinfo = Attribute(rc.hgetall(rsp("account", job["user"])))
+    g.userinfo = Attribute(change_userinfo(g.userinfo))
+    g.signin = bool(g.userinfo)
+    g.is_admin = is_true(g.userinfo.is_admin)
+    allowed_suffix = partial(
+        allowed_file, suffix=parse_valid_verticaline(g.cfg.upload_exts)
+    )
+    todo = Queue()
+    for i, img in enumerate(job["imgs"]):
+        todo.put((i, img))
+    results = {}
+
+    def fetch():
+        while True:
+            try:
+                i, img = todo.get_nowait()
+            except Empty:
+                return
+            try:
+                results[i] = _load_image(img, rate, allowed_suffix)
+            except Exception as e:
+                logger.warning(e, exc_info=True)
+                results[i] = dict(code=1, msg=str(e))
+
+    threads = [
+        spawn_in_context(fetch)
+        for _ in range(max(1, min(concurrency, len(job["imgs"]))))
+    ]
+    for t in threads:
+        t.join()
+
+    key = get_load_key(job["sha"])
+    pipe = rc.pipeline()
+    success = 0
+    for i, img in enumerate(job["imgs"]):
+        saved = results.get(i) or dict(code=1, msg="Not processed")
+        if saved.get("code") != 0:
+            pipe.rpush(get_load_key(job["sha"], "results"), json.dumps(
+                dict(img, status="fail", msg=saved.get("msg"))
+            ))
+            continue
+        index_upload(
+            pipe, saved, (img.get("album") or "").strip(),
+            title=img.get("title") or "", origin=job["origin"],
+        )
+        pipe.rpush(get_load_key(job["sha"], "results"), json.dumps(dict(
+            img, status="success", sha=saved["sha"],
+            src=saved["data"][0]["src"],
+        )))
+        success += 1
+    total = len(job["imgs"])
+    pipe.hincrby(key, "done", total)
+    pipe.hincrby(key, "success", success)
+    pipe.hincrby(key, "fail", total - success)
+    pipe.expire(get_load_key(job["sha"], "results"), LOAD_JOB_EXPIRE)
+    rst = pipe.execute()
+    done = rst[-4]
+    if done >= int(rc.hget(key, "total") or 0):
+        rc.hset(key, "status", "done")
+
+
+def run_job(job):
+    """执行任务，失败时延迟重试，超过最大尝试次数则放弃
+
+    :returns: True表示执行成功
+    """
+    try:
+        if job["action"] == "save":
+            _do_save(job)
+        elif job["action"] == "delete":
+            _do_delete(job)
+        elif job["action"] == "load":
+            _do_load(job)
+        else:
+            logger.warning("Unknown job action %s" % job["action"])
+    except Exception as e:
+        logger.warning(e, exc_info=True)
+        job["tries"] += 1
+        job["msg"] = str(e)
+        if job["tries"] < JOB_MAX_TRIES:
+            at = get_current_timestamp() + min(5 * 2 ** job["tries"], 600)
+            rc.zadd(JOB_DELAYED, {json.dumps(job): at})
+        elif job["action"] == "save":
+            ik = rsp("image", job["sha"])
+            if rc.exists(ik):
+                rc.hset(ik, get_replica_field(job["sender"]), "failed")
+        elif job["action"] == "load":
+            key = get_load_key(job["sha"])
+            if rc.exists(key):
+                rc.hset(key, "status", "failed")
+        return False
+    else:
+        return True
+
+
+def requeue_delayed_jobs():
+    """将到期的延迟任务放回队列"""
+    jobs = rc.zrangebyscore(JOB_DELAYED, "-inf", get_current_timestamp())
+    for job in jobs:
+        #: 多个worker同时运行时，仅移除成功的才放回
+        if rc.zrem(JOB_DELAYED, job):
+            rc.lpush(JOB_QUEUE, job)
+    return len(jobs)
+
+
+def exec_worker(app, burst=False, timeout=5):
+    """循环执行队列中的任务
+
+    :param app: flask app
+    :param bool burst: True表示队列为空时退出（延迟重试的任务留待下次执行）
+    :param int timeout: 等待任务的超时时间，秒
+    :returns: 执行的任务数
+    """
+    total = 0
+    while True:
+        requeue_delayed_jobs()
+        item = rc.brpop(JOB_QUEUE, timeout=timeout)
+        if not item:
+            if burst:
+                break
+            continue
+        job = json.loads(item[1])
+        #: 导入任务在创建时请求的站点下执行，以便生成正确的图片地址
+        with app.test_request_context(base_url=job.get("base_url")):
+            g.rc = rc
+            g.site = get_site_config()
+            g.cfg = Attribute(g.site)
+            g.hm = app.extensions["hookmanager"]
+            run_job(job)
+        total += 1
+    return total
@@ -17,10 +17,18 @@ import requests
 import smtplib
 import semver
 from uuid import uuid4
-from time import time, localtime, strftime
+from io import BytesIO
+from base64 import urlsafe_b64encode, urlsafe_b64decode, b64decode, \
+    b64encode
+from binascii import Error as BaseDecodeError
+from os import getpid
+from time import time, localtime, strftime, sleep
+from threading import Lock
+from collections import OrderedDict
 from datetime import datetime
 from random import randrange, sample, randint, choice
 from redis import from_url
+from requests.adapters import HTTPAdapter
 from email.header import Header
 from email.mime.text import MIMEText
 from email.utils import parseaddr, formataddr
@@ -29,7 +37,8 @@ from bleach import clean as bleach_clean
 from bleach.sanitizer import ALLOWED_TAGS, ALLOWED_ATTRIBUTES, ALLOWED_STYLES
 from version import __version__ as PICBED_VERSION
 from .log import Logger
-from ._compat import string_types, text_type, PY2, urlparse
+from ._compat import string_types, text_type, PY2, urlparse, \
+    DefaultCookiePolicy
 if PY2:
     from socket import error as ConnectionRefusedError
 
@@ -62,6 +71,7 @@ data_uri_pat = re.compile(r'^{}$'.format((
     r',(?P<data>.*)')),
     re.DOTALL
 )
+b64_invalid_pat = re.compile(r'[^A-Za-z0-9\+/=]')
 er_pat = re.compile(r'^(and|or|not|\s|ip|ep|origin|method|\(|\))+$')
 ir_pat = re.compile(r'^(in|not in|\s|ip|ep|origin|method|,|:)+$')
 ALLOWED_RULES = ("ip", "ep", "method", "origin")
@@ -212,6 +222,37 @@ def list_equal_split(l, n=5):
     return [l[i:i+n] for i in range(0, len(l), n)]
 
 
+def encode_cursor(*args):
+    """把多个值编码为分页游标（不透明字符串）
+
+    .. versionadded:: 1.11.0
+    """
+    return urlsafe_b64encode(
+        ":".join(map(str, args)).encode("utf-8")
+    ).decode("utf-8")
+
+
+def decode_cursor(cursor, n=2):
+    """解码分页游标，返回n个字符串值组成的list
+
+    :raises ValueError: 游标格式错误
+
+    .. versionadded:: 1.11.0
+    """
+    try:
+        if PY2 and isinstance(cursor, text_type):
+            cursor = cursor.encode("utf-8")
+        cursor = urlsafe_b64decode(cursor)
+        if not PY2 and not isinstance(cursor, text_type):
+            cursor = cursor.decode("utf-8")
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor")
+    values = cursor.split(":", n - 1)
+    if len(values) != n:
+        raise ValueError("Invalid cursor")
+    return values
+
+
 def generate_random(length=6):
     code_list = []
     for i in range(10):  # 0-9数字
@@ -330,6 +371,62 @@ def check_ip(ip_str):
     return True
 
 
+def ip_to_int(ip_str):
+    """IPv4地址转换为整数
+
+    :raises ValueError: 无效的IPv4地址
+
+    .. versionadded:: 1.11.0
+    """
+    if not check_ip(ip_str):
+        raise ValueError("Invalid IP address: %s" % ip_str)
+    a, b, c, d = [int(x) for x in ip_str.split('.')]
+    return (a << 24) | (b << 16) | (c << 8) | d
+
+
+def check_ip_network(ip_str):
+    """检查是否为IPv4地址或CIDR格式的网段，比如: 10.0.0.0/8
+
+    .. versionadded:: 1.11.0
+    """
+    if "/" not in ip_str:
+        return check_ip(ip_str)
+    addr, prefix = ip_str.split("/", 1)
+    return check_ip(addr) and prefix.isdigit() and 0 <= int(prefix) <= 32
+
+
+class IPSet(object):
+    """IPv4地址集合，元素可以是单个地址或CIDR格式的网段，
+    单个地址用集合查找，网段按掩码比较。
+
+    :param list items: IP地址或网段列表，无效的网段按普通字符串比较
+
+    .. versionadded:: 1.11.0
+    """
+
+    def __init__(self, items):
+        self.ips = set()
+        self.networks = []
+        for i in items:
+            if "/" in i and check_ip_network(i):
+                addr, prefix = i.split("/", 1)
+                mask = (0xffffffff << (32 - int(prefix))) & 0xffffffff
+                self.networks.append((ip_to_int(addr) & mask, mask))
+            else:
+                self.ips.add(i)
+
+    def __contains__(self, ip):
+        if ip in self.ips:
+            return True
+        if self.networks and check_ip(ip):
+            n = ip_to_int(ip)
+            return any(n & mask == net for net, mask in self.networks)
+        return False
+
+    def __len__(self):
+        return len(self.ips) + len(self.networks)
+
+
 def gen_uuid():
     return uuid4().hex
 
@@ -365,6 +462,53 @@ def parse_data_uri(datauri):
     ))
 
 
+def b64decode_to_file(b64str, fileobj, chunk_size=65536):
+    """分块解码base64字符串并写入文件对象，非base64字符将被忽略
+
+    :param str b64str: base64字符串
+    :param fileobj: 可写的文件对象
+    :param int chunk_size: 每次处理的字符数
+    :returns: 写入的字节数
+    :raises ValueError: 解码失败
+
+    .. versionadded:: 1.11.0
+    """
+    size = 0
+    rest = ""
+    for i in range(0, len(b64str), chunk_size):
+        chunk = rest + b64_invalid_pat.sub("", b64str[i:i + chunk_size])
+        cut = len(chunk) - len(chunk) % 4
+        chunk, rest = chunk[:cut], chunk[cut:]
+        if chunk:
+            try:
+                data = b64decode(chunk)
+            except (BaseDecodeError, TypeError) as e:
+                raise ValueError(e)
+            fileobj.write(data)
+            size += len(data)
+    if rest:
+        raise ValueError("Incorrect padding")
+    return size
+
+
+def b64decode_to_bytes(b64str):
+    """分块解码base64字符串，参考 :func:`b64decode_to_file`
+
+    .. versionadded:: 1.11.0
+    """
+    fp = BytesIO()
+    b64decode_to_file(b64str, fp)
+    return fp.getvalue()
+
+
+def b64encode_to_text(data):
+    """将二进制编码为base64字符串
+
+    .. versionadded:: 1.11.0
+    """
+    return b64encode(data).decode("utf-8")
+
+
 def gen_ua():
     """随机生成用户代理"""
     first_num = randint(55, 62)
@@ -392,8 +536,32 @@ def gen_ua():
     return ua
 
 
+#: 用户代理解析结果的LRU缓存，user_agents解析较慢而同一客户端的UA总是相同
+_ua_cache = OrderedDict()
+_ua_cache_lock = Lock()
+UA_CACHE_SIZE = 1024
+
+
 def parse_ua(user_agent):
-    """解析用户代理，获取其操作系统、设备、版本"""
+    """解析用户代理，获取其操作系统、设备、版本
+
+    .. versionchanged:: 1.11.0
+        解析结果按UA缓存在进程内
+    """
+    with _ua_cache_lock:
+        uap = _ua_cache.pop(user_agent, None)
+        if uap is not None:
+            _ua_cache[user_agent] = uap
+            return dict(uap)
+    uap = _parse_ua(user_agent)
+    with _ua_cache_lock:
+        _ua_cache[user_agent] = uap
+        if len(_ua_cache) > UA_CACHE_SIZE:
+            _ua_cache.popitem(last=False)
+    return dict(uap)
+
+
+def _parse_ua(user_agent):
     uap = user_agents_parse(user_agent)
     device, ua_os, family = str(uap).split(' / ')
     if uap.is_mobile:
@@ -424,6 +592,50 @@ def slash_join(*args):
     return '/'.join(stripped_strings)
 
 
+#: HTTP连接池：每个进程按代理配置复用requests.Session，保持长连接
+HTTP_POOL_CONNECTIONS = 10
+HTTP_POOL_MAXSIZE = 20
+#: 建立连接的超时时间，单位秒
+HTTP_CONNECT_TIMEOUT = 3.05
+#: 重试前的退避时间基数，单位秒，第n次重试等待 factor * 2 ** (n-1)
+HTTP_BACKOFF_FACTOR = 0.5
+_http_sessions = {}
+_http_sessions_lock = Lock()
+
+
+def get_http_session(proxy=None):
+    """获取当前进程中指定代理配置的requests.Session
+
+    :param dict proxy: 代理服务器，如 {"https": "http://127.0.0.1:1080"}
+
+    .. versionadded:: 1.11.0
+    """
+    key = (getpid(), tuple(sorted(proxy.items())) if proxy else None)
+    sess = _http_sessions.get(key)
+    if sess is None:
+        with _http_sessions_lock:
+            sess = _http_sessions.get(key)
+            if sess is None:
+                #: fork后的子进程不能复用父进程的连接
+                for k in [k for k in _http_sessions if k[0] != key[0]]:
+                    _http_sessions.pop(k, None)
+                sess = requests.Session()
+                #: 会话由所有用户、所有远程主机共享，不能保存cookie
+                sess.cookies.set_policy(
+                    DefaultCookiePolicy(allowed_domains=[])
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=HTTP_POOL_CONNECTIONS,
+                    pool_maxsize=HTTP_POOL_MAXSIZE,
+                )
+                sess.mount("http://", adapter)
+                sess.mount("https://", adapter)
+                if proxy:
+                    sess.proxies.update(proxy)
+                _http_sessions[key] = sess
+    return sess
+
+
 def try_request(
     url,
     params=None,
@@ -433,55 +645,43 @@ def try_request(
     method='post',
     proxy=None,
     num_retries=1,
-    _is_retry=False,
 ):
     """
     :param dict params: 请求查询参数
     :param dict data: 提交表单数据
-    :param int timeout: 超时时间，单位秒
+    :param timeout: 超时时间，单位秒，数字表示读取超时，也可以是元组
+                    (连接超时, 读取超时)
     :param str method: 请求方法，get、post、put、delete
-    :param str proxy: 设置代理服务器
+    :param dict proxy: 设置代理服务器，仅在重试时使用
     :param int num_retries: 超时重试次数
-    :param bool _is_retry: 判定为重试请求，这不应该由用户发出
+
+    .. versionchanged:: 1.11.0
+        复用连接池中的长连接，重试改为循环并按指数退避等待
     """
     headers = headers or {}
     if "User-Agent" not in headers:
         headers["User-Agent"] = "picbed/v%s" % PICBED_VERSION
     method = method.lower()
-    if method == 'get':
-        method_func = requests.get
-    elif method == 'post':
-        method_func = requests.post
-    elif method == 'put':
-        method_func = requests.put
-    elif method == 'delete':
-        method_func = requests.delete
-    else:
-        method_func = requests.post
-    try:
-        resp = method_func(
-            url, params=params, headers=headers, data=data, timeout=timeout,
-            proxies=proxy if _is_retry is True and proxy else None
-        )
-    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
-        if num_retries > 0:
-            return try_request(
-                url,
-                params=params,
-                data=data,
-                headers=headers,
+    if method not in ('get', 'post', 'put', 'delete'):
+        method = 'post'
+    if not isinstance(timeout, tuple):
+        timeout = (min(HTTP_CONNECT_TIMEOUT, timeout), timeout)
+    tries = 0
+    while True:
+        #: 首次请求直连，重试时才使用代理
+        sess = get_http_session(proxy if tries > 0 else None)
+        try:
+            return sess.request(
+                method, url, params=params, headers=headers, data=data,
                 timeout=timeout,
-                method=method,
-                proxy=proxy,
-                num_retries=num_retries-1,
-                _is_retry=True,
             )
-        else:
-            raise
-    except (requests.exceptions.RequestException, Exception):
-        raise
-    else:
-        return resp
+        except (
+            requests.exceptions.Timeout, requests.exceptions.ConnectionError
+        ):
+            if tries >= num_retries:
+                raise
+            tries += 1
+            sleep(HTTP_BACKOFF_FACTOR * 2 ** (tries - 1))
 
 
 def is_venv():
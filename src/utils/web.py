@@ -11,36 +11,61 @@
 
 import json
 import imghdr
+import atexit
+import hashlib
 from posixpath import basename, splitext
-from os.path import join as pathjoin
+from os import getpid, listdir, remove
+from os.path import join as pathjoin, isfile, isdir, getmtime
 from io import BytesIO
+from tempfile import SpooledTemporaryFile
 from functools import wraps
-from base64 import urlsafe_b64decode as b64decode, b64decode as pic64decode
-from binascii import Error as BaseDecodeError
+from base64 import urlsafe_b64decode as b64decode
 from redis.exceptions import RedisError
 from requests.exceptions import RequestException
 from flask import g, redirect, request, url_for, abort, Response, jsonify,\
     current_app, make_response, Markup
 from jinja2 import Environment, FileSystemLoader
 from sys import executable
+from time import time
+from threading import Thread, Lock, BoundedSemaphore, Event
+from collections import OrderedDict
 from functools import partial
 from subprocess import call, check_output
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer, \
     SignatureExpired, BadSignature
 from libs.storage import get_storage
+from config import GLOBAL
 from .tool import logger, get_current_timestamp, rsp, sha256, username_pat, \
     parse_valid_comma, parse_data_uri, format_apires, url_pat, ALLOWED_EXTS, \
     parse_valid_verticaline, parse_valid_colon, is_true, is_venv, gen_ua, \
     check_to_addr, is_all_fail, bleach_html, try_request, comma_pat, \
-    create_redis_engine, allowed_file
-from ._compat import PY2, text_type, urlsplit, parse_qs
+    create_redis_engine, allowed_file, b64decode_to_file, b64decode_to_bytes, \
+    parse_ua
+from ._compat import PY2, text_type, urlsplit, parse_qs, iteritems, Queue, \
+    Empty, ProcessPoolExecutor, BrokenProcessPool
 if not PY2:
     from functools import reduce
 
 rc = create_redis_engine()
 
+#: 站点配置的进程内缓存，version对应redis中的配置版本号，
+#: checked是上次检查版本号的时间戳
+_site_cache = dict(data=None, version=None, checked=0)
+
+#: 进程内已验证的登录会话(LRU)，
+#: dSid: (验证时间, 认证版本号, 过期时间, 用户名, 用户信息)
+_session_cache = OrderedDict()
+_session_lock = Lock()
+#: 缓存的会话数量上限
+SESSION_CACHE_SIZE = 1024
+#: 会话缓存的有效期（秒），期间仅检查用户的认证版本号
+SESSION_CACHE_TTL = 300
+
 no_jump_ep = ("front.login", "front.logout", "front.register")
 
+#: 上传图片数据超过此大小(字节)时转存到临时文件
+SPOOL_MAX_SIZE = 500 * 1024
+
 
 def get_referrer_url():
     """获取上一页地址"""
@@ -68,17 +93,51 @@ def get_redirect_url(endpoint="front.index"):
     return url
 
 
+def get_auth_version_key(username):
+    """用户认证版本号，密码、状态、资料变化或登出时递增
+
+    .. versionadded:: 1.11.0
+    """
+    return rsp("authversion", username)
+
+
+def bump_auth_version(username, pipe=None):
+    """递增用户认证版本号，使进程内缓存的已验证会话失效
+
+    :param pipe: redis pipeline，否则直接执行
+
+    .. versionadded:: 1.11.0
+    """
+    (pipe or rc).incr(get_auth_version_key(username))
+
+
 def default_login_auth(dSid=None):
     """默认登录解密
 
     :returns: (signin:boolean, userinfo:dict)
+
+    .. versionchanged:: 1.11.0
+        已验证的会话缓存在进程内，有效期内只需检查用户的认证版本号
     """
     sid = request.cookies.get("dSid") or dSid or ""
     signin = False
     userinfo = {}
+    now = get_current_timestamp()
+    with _session_lock:
+        cached = _session_cache.get(sid)
+        if cached:
+            _session_cache[sid] = _session_cache.pop(sid)
+    if cached and cached[0] + SESSION_CACHE_TTL > now and cached[2] > now:
+        try:
+            version = g.rc.get(get_auth_version_key(cached[3]))
+        except RedisError:
+            version = False
+        if version == cached[1]:
+            return (True, dict(cached[4]))
     try:
         if not sid:
             raise ValueError
+        raw_sid = sid
         if PY2 and isinstance(sid, text_type):
             sid = sid.encode("utf-8")
         sid = b64decode(sid)
@@ -89,24 +148,31 @@ def default_login_auth(dSid=None):
     except (TypeError, ValueError, AttributeError, Exception):
         pass
     else:
-        if expire > get_current_timestamp():
+        if expire > now:
             ak = rsp("accounts")
             pipe = g.rc.pipeline()
             pipe.sismember(ak, usr)
             pipe.hgetall(rsp("account", usr))
+            pipe.get(get_auth_version_key(usr))
             try:
                 result = pipe.execute()
             except RedisError:
                 pass
             else:
-                if isinstance(result, (tuple, list)) and len(result) == 2:
-                    has_usr, userinfo = result
+                if isinstance(result, (tuple, list)) and len(result) == 3:
+                    has_usr, userinfo, version = result
                     if has_usr and userinfo and isinstance(userinfo, dict):
                         pwd = userinfo.pop("password", None)
                         if sha256("%s:%s:%s:%s" % (
                             usr, pwd, expire, current_app.config["SECRET_KEY"]
                         )) == sha:
                             signin = True
+                            with _session_lock:
+                                _session_cache[raw_sid] = (
+                                    now, version, expire, usr, dict(userinfo)
+                                )
+                                if len(_session_cache) > SESSION_CACHE_SIZE:
+                                    _session_cache.popitem(last=False)
     if not signin:
         userinfo = {}
     return (signin, userinfo)
@@ -309,10 +375,25 @@ def change_userinfo(userinfo):
 
 
 def get_site_config():
-    """获取站点配置"""
-    s = get_storage()
-    cfg = s.get("siteconfig") or {}
-    return cfg
+    """获取站点配置
+
+    .. versionchanged:: 1.11.0
+        配置缓存在进程内，超过缓存时间才检查一次版本号，版本号变化(即
+        :func:`set_site_config` 更新)时才重新读取配置。
+    """
+    now = get_current_timestamp(True)
+    ttl = GLOBAL["SiteConfigCacheTime"]
+    if _site_cache["data"] is None or now - _site_cache["checked"] >= ttl:
+        try:
+            version = rc.get(rsp("config", "siteversion"))
+        except RedisError:
+            version = None
+        if _site_cache["data"] is None or version is None or \
+                version != _site_cache["version"]:
+            s = get_storage()
+            _site_cache.update(data=s.get("siteconfig") or {})
+        _site_cache.update(version=version, checked=now)
+    return dict(_site_cache["data"])
 
 
 def set_site_config(mapping):
@@ -345,6 +426,8 @@ def set_site_config(mapping):
         cfg = s.get("siteconfig") or {}
         cfg.update(mapping)
         s.set("siteconfig", cfg)
+        rc.incr(rsp("config", "siteversion"))
+        _site_cache.update(data=None)
 
 
 def check_username(usr):
@@ -410,13 +493,24 @@ class Base64FileStorage(object):
     def __init__(self, b64str, filename=None):
         self._filename = filename
         #: data uri scheme
-        self._b64str = self.__set_data_uri(b64str)
-        self._parse = parse_data_uri(self._b64str)
+        self._parse = parse_data_uri(self.__set_data_uri(b64str))
         if self.is_base64:
+            #: 分块解码到临时文件，不再同时持有解码后的完整数据及其副本
+            self._fp = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
             try:
-                self._parse["data"] = pic64decode(self._parse.data)
-            except (BaseDecodeError, TypeError, ValueError):
+                if len(self._parse.data) >= \
+                        GLOBAL["ProcessPoolThreshold"] * 1024:
+                    #: 较大的图片在进程池中解码
+                    self._fp.write(run_in_process(
+                        b64decode_to_bytes, self._parse.data
+                    ))
+                else:
+                    b64decode_to_file(self._parse.data, self._fp)
+            except ValueError:
                 raise ValueError("The attempt to decode the image failed")
+            finally:
+                self._parse["data"] = None
+            self._fp.seek(0)
         else:
             raise ValueError("Not found base64")
 
@@ -434,7 +528,7 @@ class Base64FileStorage(object):
     @property
     def filename(self):
         if not self._filename:
-            ext = imghdr.what(None, self._parse.data)
+            ext = imghdr.what(self._fp)
             if not ext and self.mimetype:
                 mType, sType = self.mimetype.split("/")
                 if mType == "image":
@@ -449,7 +543,27 @@ class Base64FileStorage(object):
     @property
     def stream(self):
         if self.is_base64:
-            return BytesIO(self._parse.data)
+            self._fp.seek(0)
+            return self._fp
+
+
+class ChunkedFileStorage(object):
+    """上传接口中分块上传完成后，由暂存文件组成的图片
+
+    .. versionadded:: 1.11.0
+    """
+
+    def __init__(self, filepath, filename):
+        self._fp = open(filepath, "rb")
+        self.filename = filename
+
+    @property
+    def stream(self):
+        self._fp.seek(0)
+        return self._fp
+
+    def close(self):
+        self._fp.close()
 
 
 class ImgUrlFileStorage(object):
@@ -522,6 +636,502 @@ class ImgUrlFileStorage(object):
             return self if self._imgobj else None
 
 
+def read_stream(stream):
+    """读取图片数据流的全部内容，读取后重置到开头
+
+    :param stream: 文件对象或二进制
+    :returns: bytes
+
+    .. versionadded:: 1.11.0
+    """
+    if hasattr(stream, "read"):
+        stream.seek(0)
+        data = stream.read()
+        stream.seek(0)
+        return data
+    return stream
+
+
+def make_stream(data):
+    """将二进制或文件对象转为可重复读取的文件对象
+
+    .. versionadded:: 1.11.0
+    """
+    if hasattr(data, "read"):
+        data.seek(0)
+        return data
+    fp = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    fp.write(data)
+    fp.seek(0)
+    return fp
+
+
+def delete_saved_image(sha, upload_path, filename, senders):
+    """执行各存储后端钩子的upimg_delete方法删除已保存的图片
+
+    :param list senders: 钩子保存图片时的返回结果
+
+    .. versionadded:: 1.11.0
+    """
+    hm = current_app.extensions["hookmanager"]
+    for i in senders:
+        try:
+            hm.proxy(i["sender"]).upimg_delete(
+                sha=sha,
+                upload_path=upload_path,
+                filename=filename,
+                basedir=i.get("basedir"),
+                save_result=i
+            )
+        except (ValueError, AttributeError, Exception) as e:
+            logger.warning(e, exc_info=True)
+
+
+def delete_saved_images(groups):
+    """按存储后端批量删除已保存的图片，各存储后端并发执行
+
+    钩子有upimg_delete_batch方法时一次传递该后端的所有图片（参数items，
+    列表，元素是upimg_delete的关键字参数），否则逐个执行upimg_delete。
+
+    :param dict groups: 钩子名: upimg_delete的关键字参数列表
+
+    .. versionadded:: 1.11.0
+    """
+    hm = current_app.extensions["hookmanager"]
+
+    def delete(sender, items):
+        proxy = hm.proxy(sender)
+        if proxy is None:
+            return
+        if callable(getattr(proxy, "upimg_delete_batch", None)):
+            try:
+                proxy.upimg_delete_batch(items=items)
+            except (ValueError, AttributeError, Exception) as e:
+                logger.warning(e, exc_info=True)
+            return
+        for kwargs in items:
+            try:
+                proxy.upimg_delete(**kwargs)
+            except (ValueError, AttributeError, Exception) as e:
+                logger.warning(e, exc_info=True)
+
+    threads = [
+        spawn_in_context(delete, sender, items)
+        for sender, items in iteritems(groups)
+        if items
+    ]
+    for t in threads:
+        t.join()
+
+
+#: 图片处理支持输出的格式及对应的Pillow格式名
+TRANSFORM_FORMATS = dict(
+    jpeg="JPEG", jpg="JPEG", png="PNG", webp="WEBP", gif="GIF", avif="AVIF"
+)
+
+
+def get_derivative_sizes():
+    """解析控制台设置的衍生图规则，格式是 ``名称:最大边长[:格式]`` ，
+    如 ``thumb:200,medium:800,webp:0:webp`` ，最大边长为0表示保持原图尺寸
+
+    :returns: dict，衍生图名称: (最大边长(像素), 格式或None)
+
+    .. versionadded:: 1.11.0
+    """
+    sizes = {}
+    for rule in parse_valid_comma(g.cfg.upload_derivatives or ''):
+        rule = rule.split(":")
+        if len(rule) not in (2, 3) or not rule[0]:
+            continue
+        try:
+            size = int(rule[1])
+        except (ValueError, TypeError):
+            continue
+        fmt = rule[2].lower() if len(rule) == 3 else None
+        if fmt and fmt not in TRANSFORM_FORMATS:
+            continue
+        if size > 0 or fmt:
+            sizes[rule[0]] = (size, fmt)
+    return sizes
+
+
+def make_derivatives(content, sizes):
+    """按最大边长等比缩放或转换格式生成衍生图（缩略图、中图、webp等），
+    需要安装Pillow
+
+    :param bytes content: 原图二进制
+    :param dict sizes: 衍生图名称: (最大边长, 格式)，格式为空时与原图一致
+    :returns: dict，衍生图名称: (二进制, 宽, 高, 格式)，
+              不转换格式且原图不大于边长时不生成
+
+    .. versionadded:: 1.11.0
+    """
+    if not sizes:
+        return {}
+    try:
+        from PIL import Image
+    except ImportError:
+        logger.warning("Please install Pillow to generate derivatives")
+        return {}
+    try:
+        im = Image.open(BytesIO(content))
+        im.load()
+    except (IOError, ValueError, Exception) as e:
+        logger.debug(e, exc_info=True)
+        return {}
+    result = {}
+    for label, (size, fmt) in iteritems(sizes):
+        if not fmt and max(im.size) <= size:
+            continue
+        d = im.copy()
+        if 0 < size < max(im.size):
+            d.thumbnail((size, size), Image.LANCZOS)
+        pil_fmt = TRANSFORM_FORMATS[fmt] if fmt else im.format
+        if pil_fmt == "JPEG" and d.mode not in ("RGB", "L"):
+            d = d.convert("RGB")
+        buf = BytesIO()
+        try:
+            d.save(buf, format=pil_fmt)
+        except (IOError, KeyError, ValueError) as e:
+            logger.debug(e, exc_info=True)
+            continue
+        result[label] = (buf.getvalue(), d.size[0], d.size[1], fmt)
+    return result
+
+
+def transform_image(content, width=0, height=0, fmt="png", quality=85,
+                    crop=False):
+    """缩放、裁剪图片或转换格式，需要安装Pillow
+
+    :param bytes content: 原图二进制
+    :param int width: 最大宽度，0表示不限制
+    :param int height: 最大高度，0表示不限制
+    :param str fmt: 输出格式，参考 :data:`TRANSFORM_FORMATS`
+    :param int quality: jpeg、webp的压缩质量
+    :param bool crop: 同时指定宽高时，居中裁剪成该尺寸，否则等比缩放
+    :returns: 处理后的二进制
+    :raises ImportError: 未安装Pillow
+    :raises IOError: 无法识别的图片
+
+    .. versionadded:: 1.11.0
+    """
+    from PIL import Image, ImageOps
+    im = Image.open(BytesIO(content))
+    im.load()
+    if crop and width and height:
+        im = ImageOps.fit(im, (width, height), Image.LANCZOS)
+    elif width or height:
+        im.thumbnail(
+            (width or im.size[0], height or im.size[1]), Image.LANCZOS
+        )
+    fmt = TRANSFORM_FORMATS[fmt]
+    if fmt == "JPEG" and im.mode not in ("RGB", "L"):
+        im = im.convert("RGB")
+    buf = BytesIO()
+    if fmt in ("JPEG", "WEBP"):
+        im.save(buf, format=fmt, quality=quality)
+    else:
+        im.save(buf, format=fmt)
+    return buf.getvalue()
+
+
+def recompress_image(content, jpeg_quality=0, png_optimize=True,
+                     bmp_to_png=True):
+    """重新压缩图片：无损优化png、以质量上限重新编码jpeg、bmp转为png，
+    需要安装Pillow
+
+    动图（如apng）不处理；保留icc_profile、exif、dpi及png的文本块。
+
+    :param bytes content: 原图二进制
+    :param int jpeg_quality: jpeg质量上限，0表示不重新编码
+    :returns: (新的二进制, 新的后缀)，无法压缩得更小时返回(None, None)
+
+    .. versionadded:: 1.11.0
+    """
+    from PIL import Image, PngImagePlugin
+    im = Image.open(BytesIO(content))
+    if getattr(im, "is_animated", False):
+        return None, None
+    fmt = im.format
+    buf = BytesIO()
+    if (fmt == "BMP" and bmp_to_png) or (fmt == "PNG" and png_optimize):
+        kwargs = dict(optimize=True)
+        for k in ("icc_profile", "exif", "dpi"):
+            if im.info.get(k):
+                kwargs[k] = im.info[k]
+        text = getattr(im, "text", None)
+        if text:
+            kwargs["pnginfo"] = PngImagePlugin.PngInfo()
+            for k, v in iteritems(text):
+                kwargs["pnginfo"].add_text(k, v)
+        im.save(buf, format="PNG", **kwargs)
+        if fmt == "BMP":
+            return buf.getvalue(), ".png"
+    elif fmt == "JPEG" and jpeg_quality > 0:
+        kwargs = dict(quality=jpeg_quality, optimize=True)
+        for k in ("exif", "icc_profile"):
+            if im.info.get(k):
+                kwargs[k] = im.info[k]
+        im.save(buf, format="JPEG", **kwargs)
+    else:
+        return None, None
+    data = buf.getvalue()
+    if len(data) < len(content):
+        return data, None
+    return None, None
+
+
+#: 每个进程内的进程池，fork后的子进程需要重新创建；
+#: semaphore限制同时提交(执行及排队)的任务数，超过时等待
+_process_pool = dict(pid=None, executor=None, semaphore=None)
+_process_pool_lock = Lock()
+
+
+def _get_process_pool():
+    pid = getpid()
+    if _process_pool["pid"] != pid:
+        with _process_pool_lock:
+            if _process_pool["pid"] != pid:
+                size = GLOBAL["ProcessPoolSize"]
+                _process_pool.update(
+                    pid=pid,
+                    executor=ProcessPoolExecutor(max_workers=size),
+                    semaphore=BoundedSemaphore(
+                        size + max(GLOBAL["ProcessPoolQueue"], 0)
+                    ),
+                )
+    return _process_pool
+
+
+def run_in_process(func, *args, **kwargs):
+    """在进程池中执行CPU密集的函数并等待结果，避免阻塞gevent事件循环，
+    不支持进程池（Python2未安装futures模块）或进程数配置为0时直接执行
+
+    func、参数及返回值都需要可以pickle，比如模块级的函数。
+
+    .. versionadded:: 1.11.0
+
+    .. versionchanged:: 1.11.0
+        进程数及排队数由配置项ProcessPoolSize、ProcessPoolQueue决定
+    """
+    if ProcessPoolExecutor is None or GLOBAL["ProcessPoolSize"] <= 0:
+        return func(*args, **kwargs)
+    pool = _get_process_pool()
+    with pool["semaphore"]:
+        try:
+            return pool["executor"].submit(func, *args, **kwargs).result()
+        except BrokenProcessPool as e:
+            #: 子进程异常退出，下次重新创建进程池，本次直接执行
+            logger.warning(e, exc_info=True)
+            with _process_pool_lock:
+                _process_pool.update(pid=None)
+            return func(*args, **kwargs)
+
+
+def offload(func, data, *args, **kwargs):
+    """数据较大（不小于配置项ProcessPoolThreshold）时在进程池中执行，
+    否则直接执行，小数据的序列化开销大于计算本身
+
+    :param func: 模块级的函数，第一个参数是data
+    :param data: bytes或str
+
+    .. versionadded:: 1.11.0
+    """
+    if len(data) >= GLOBAL["ProcessPoolThreshold"] * 1024:
+        return run_in_process(func, data, *args, **kwargs)
+    return func(data, *args, **kwargs)
+
+
+def read_saved_image(info):
+    """读取已保存的图片内容，优先从本地存储读取，否则下载图片地址，
+    仅下载保存此图片的已启用存储后端的地址（比如导入的任意地址不会请求）
+
+    :param dict info: 图片数据
+    :returns: bytes
+    :raises ValueError: 图片地址不属于保存此图片的存储后端
+
+    .. versionadded:: 1.11.0
+    """
+    senders = json.loads(info.get("senders") or "[]")
+    if "up2local" in [i["sender"] for i in senders]:
+        filepath = pathjoin(
+            current_app.root_path,
+            current_app.static_folder,
+            current_app.config["UPLOAD_FOLDER"],
+            info["upload_path"],
+            get_stored_filename(info),
+        )
+        if isfile(filepath):
+            with open(filepath, "rb") as fp:
+                return fp.read()
+    hosts = set([
+        urlsplit(i["src"]).netloc
+        for i in senders
+        if i.get("src") and g.hm.proxy(i["sender"])
+    ])
+    if urlsplit(info["src"]).netloc not in hosts:
+        raise ValueError("The picture is not held by a known storage backend")
+    resp = try_request(info["src"], method="get", timeout=30)
+    resp.raise_for_status()
+    return resp.content
+
+
+def save_derivatives(stream, filename, upload_path, sender):
+    """生成衍生图并使用原图的存储后端钩子保存
+
+    衍生图文件名是原图名加上衍生图名称，比如a.png的缩略图是a.thumb.png，
+    转换格式时后缀是对应格式，比如a.webp.webp
+
+    :param stream: 原图文件对象或二进制，未设置衍生图规则时不读取
+    :param str sender: 保存原图的钩子名
+    :returns: dict，衍生图名称: 保存结果（含有filename、width、height字段）
+
+    .. versionadded:: 1.11.0
+    """
+    stem, suffix = splitext(filename)
+    result = {}
+    sizes = get_derivative_sizes()
+    if not sizes:
+        return result
+    derivatives = run_in_process(make_derivatives, read_stream(stream), sizes)
+    for label, (stream, width, height, fmt) in iteritems(derivatives):
+        name = "%s.%s%s" % (stem, label, ".%s" % fmt if fmt else suffix)
+        rst = g.hm.call(
+            _funcname="upimg_save",
+            _include=[sender],
+            _kwargs=dict(
+                filename=name, stream=stream, upload_path=upload_path
+            ),
+        )
+        if rst and rst[0].get("code") == 0:
+            rst[0].update(filename=name, width=width, height=height)
+            result[label] = rst[0]
+    return result
+
+
+def get_derivative_srcs(derivatives):
+    """衍生图名称与地址的映射，用于接口返回
+
+    :param derivatives: 衍生图保存结果的json
+
+    .. versionadded:: 1.11.0
+    """
+    return {
+        label: d["src"]
+        for label, d in iteritems(json.loads(derivatives or "{}"))
+    }
+
+
+def spawn_in_context(func, *args, **kwargs):
+    """在新线程(gevent worker中是greenlet)中执行func，
+    并复制当前请求的环境和 ``flask.g`` 数据，以便钩子中使用url_for、g.cfg等。
+
+    与 :func:`flask.copy_current_request_context` 不同，新线程使用的是
+    新的请求对象，结束时不会关闭当前请求的上传文件。
+
+    .. versionadded:: 1.11.0
+    """
+    app = current_app._get_current_object()
+    environ = dict(request.environ)
+    data = dict(g.__dict__)
+
+    def wrapper():
+        with app.request_context(environ):
+            for k, v in iteritems(data):
+                setattr(g, k, v)
+            func(*args, **kwargs)
+
+    t = Thread(target=wrapper)
+    t.daemon = True
+    t.start()
+    return t
+
+
+def fanout_call(funcname, names, kwargs_for, quorum=1, timeout=30,
+                rollback=None):
+    """并发执行多个已启用钩子的同一方法，比如冗余保存图片到多个存储后端，
+    耗时取决于最慢(或最快，quorum=first时)的钩子而不是所有钩子之和。
+
+    :param str funcname: 钩子方法名
+    :param list names: 钩子名列表
+    :param kwargs_for: 函数，传递钩子名，返回调用其方法的关键字参数
+    :param quorum: first表示任一成功即返回；all表示要求全部成功；
+                   整数N表示至少N个成功
+    :param int timeout: 每个钩子的超时时间(秒)，超时视为失败
+    :param rollback: 函数，传递执行成功但结果未被采纳的钩子结果，
+                     用以删除已保存的数据，在新线程中执行
+    :returns: 钩子结果列表（按钩子名排序），未达到quorum时成功的结果也被
+              标记为失败
+
+    .. versionadded:: 1.11.0
+    """
+    hm = current_app.extensions["hookmanager"]
+    first = quorum == "first"
+    if first:
+        need = 1
+    elif quorum == "all":
+        need = len(names)
+    else:
+        try:
+            need = min(max(int(quorum), 1), len(names))
+        except (ValueError, TypeError):
+            need = 1
+    queue = Queue()
+    lock = Lock()
+    state = dict(closed=False)
+
+    def worker(name):
+        rst = hm.call(funcname, _include=[name], _kwargs=kwargs_for(name))
+        rst = rst[0] if rst else dict(code=1, msg="No result", sender=name)
+        with lock:
+            if not state["closed"]:
+                queue.put(rst)
+                return
+        #: 超时后才完成，结果未被采纳
+        if rst.get("code") == 0 and callable(rollback):
+            rollback(rst)
+
+    for name in names:
+        spawn_in_context(worker, name)
+    deadline = time() + timeout
+    results = []
+    while len(results) < len(names):
+        try:
+            rst = queue.get(timeout=max(deadline - time(), 0))
+        except Empty:
+            break
+        results.append(rst)
+        if first and rst.get("code") == 0:
+            break
+    with lock:
+        state["closed"] = True
+        while True:
+            try:
+                results.append(queue.get_nowait())
+            except Empty:
+                break
+    done = set(r["sender"] for r in results)
+    results.extend([
+        dict(code=1, msg="Timeout", sender=name)
+        for name in names
+        if name not in done
+    ])
+    success = [r for r in results if r.get("code") == 0]
+    if first and success:
+        #: 最先完成的钩子结果被采纳，其余成功的需要回滚
+        unused = success[1:]
+        results = [r for r in results if r not in unused]
+    elif len(success) < need:
+        unused = success
+    else:
+        unused = []
+    for r in unused:
+        if callable(rollback):
+            spawn_in_context(rollback, dict(r))
+        r.update(code=1, msg="Not adopted, the quorum is not reached")
+    return sorted(results, key=lambda r: r["sender"])
+
+
 def get_upload_method(class_name):
     if class_name == "FileStorage":
         return "file"
@@ -529,6 +1139,8 @@ def get_upload_method(class_name):
         return "url"
     elif class_name == "Base64FileStorage":
         return "base64"
+    elif class_name == "ChunkedFileStorage":
+        return "chunked"
     else:
         return "unknown"
 
@@ -768,6 +1380,401 @@ def has_image(sha):
     return result == [True, 1]
 
 
+def get_image_index_key(username=None):
+    """按上传时间（ctime为score）排序的图片索引（有序集合）
+
+    :param str username: 用户名，为空时返回全局索引
+    :returns: redis key
+
+    .. versionadded:: 1.11.0
+    """
+    if username:
+        return rsp("index", "ctime", "user", username)
+    return rsp("index", "ctime", "global")
+
+
+def zrange_after(key, cursor=None, limit=10, reverse=True):
+    """从有序集合中读取游标之后的limit个成员
+
+    游标成员仍存在时由其排名直接定位；已删除时在同分数的成员中二分查找
+    其位置（同分数的成员按成员名排序），因此同一秒导入的大量图片也不需要
+    从该分数开始逐页扫描。
+
+    :param str key: 有序集合
+    :param tuple cursor: 上一页最后一个成员的(score, member)，为空时从头读取
+    :param int limit: 返回数量
+    :param bool reverse: True表示按score从大到小
+    :returns: [(member, score), ...]
+
+    .. versionadded:: 1.11.0
+    """
+    start = 0
+    if cursor:
+        score, member = float(cursor[0]), cursor[1]
+        pipe = rc.pipeline(transaction=False)
+        pipe.zscore(key, member)
+        if reverse:
+            pipe.zrevrank(key, member)
+        else:
+            pipe.zrank(key, member)
+        current, rank = pipe.execute()
+        if current is not None and float(current) == score:
+            start = rank + 1
+        else:
+            start = _zrank_between(key, score, member, reverse)
+    return rc.zrange(
+        key, start, start + limit - 1, desc=reverse, withscores=True
+    )
+
+
+def _zrank_between(key, score, member, reverse):
+    """不在有序集合中的(score, member)之后第一个成员的排名"""
+    if reverse:
+        lo = rc.zcount(key, "(%r" % score, "+inf")
+    else:
+        lo = rc.zcount(key, "-inf", "(%r" % score)
+    hi = lo + rc.zcount(key, repr(score), repr(score))
+    while lo < hi:
+        mid = (lo + hi) // 2
+        m = rc.zrange(key, mid, mid, desc=reverse)[0]
+        if (m < member) if reverse else (m > member):
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+def get_album_index_key(album, username=None):
+    """相册内按上传时间排序的图片索引（有序集合）
+
+    :param str album: 相册名
+    :param str username: 用户名，为空时返回全局的相册索引
+
+    .. versionadded:: 1.11.0
+    """
+    if username:
+        return rsp("index", "album", "user", username, album)
+    return rsp("index", "album", "global", album)
+
+
+def get_album_counter_key(username=None):
+    """相册图片数量计数（哈希，字段是相册名，值是图片数）
+
+    .. versionadded:: 1.11.0
+    """
+    if username:
+        return rsp("index", "albums", "user", username)
+    return rsp("index", "albums", "global")
+
+
+#: 相册索引实际增删了图片时才修改计数，重复删除（或添加）同一图片、
+#: 与重建索引或更改相册并发时计数不会偏离
+ALBUM_INDEX_SCRIPT = """
+local changed
+if ARGV[3] == "" then
+    changed = redis.call("ZREM", KEYS[1], ARGV[2])
+else
+    changed = redis.call("ZADD", KEYS[1], ARGV[3], ARGV[2])
+end
+if changed == 1 then
+    redis.call("HINCRBY", KEYS[2], ARGV[1], ARGV[3] == "" and -1 or 1)
+end
+return changed
+"""
+
+
+def _album_index(pipe, sha, album, username=None, ctime=None):
+    keys = [get_album_index_key(album, username)]
+    keys.append(get_album_counter_key(username))
+    if type(rc).__module__.startswith("rediscluster"):
+        #: 集群的两个key可能不在同一slot，无法执行脚本，计数偏离时需要
+        #: 执行 ``flask sa reindex`` 修正
+        if ctime is None:
+            pipe.zrem(keys[0], sha)
+        else:
+            pipe.zadd(keys[0], {sha: ctime})
+        pipe.hincrby(keys[1], album, -1 if ctime is None else 1)
+    else:
+        pipe.eval(
+            ALBUM_INDEX_SCRIPT, 2, keys[0], keys[1],
+            album, sha, "" if ctime is None else ctime,
+        )
+
+
+def add_album_index(pipe, sha, ctime, album, username=None):
+    """把图片加入相册索引并计数（在pipeline中执行），相册名为空时忽略
+
+    .. versionadded:: 1.11.0
+    """
+    if album:
+        _album_index(pipe, sha, album, ctime=ctime)
+        if username:
+            _album_index(pipe, sha, album, username, ctime)
+
+
+def remove_album_index(pipe, sha, album, username=None):
+    """从相册索引中删除图片并计数（在pipeline中执行），相册名为空时忽略，
+    图片不在相册索引中时不修改计数
+
+    .. versionadded:: 1.11.0
+    """
+    if album:
+        _album_index(pipe, sha, album)
+        if username:
+            _album_index(pipe, sha, album, username)
+
+
+def get_album_counter(username=None):
+    """获取相册及其图片数量，返回dict
+
+    .. versionadded:: 1.11.0
+    """
+    return {
+        a: int(c)
+        for a, c in iteritems(rc.hgetall(get_album_counter_key(username)))
+        if a and int(c) > 0
+    }
+
+
+def get_expire_member(sha, username=None, album=""):
+    """临时图片在过期索引中的成员名，过期时据此清理图片的各个索引
+
+    .. versionadded:: 1.11.0
+    """
+    #: 相册名可能含有冒号，所以放在最后
+    return "%s:%s:%s" % (username or "", sha, album or "")
+
+
+def move_expire_index(pipe, sha, username=None, old_album="", album=""):
+    """图片更改相册时，同步更新其在过期索引中的成员（非临时图片忽略）
+
+    .. versionadded:: 1.11.0
+    """
+    ek = rsp("index", "expire")
+    old = get_expire_member(sha, username, old_album)
+    score = rc.zscore(ek, old)
+    if score is not None:
+        pipe.zrem(ek, old)
+        pipe.zadd(ek, {get_expire_member(sha, username, album): score})
+
+
+def add_image_index(pipe, sha, ctime, username=None, expire=0, album=""):
+    """把图片加入全局及用户的集合索引、时间索引、相册索引（在pipeline中执行）
+
+    :param pipe: redis pipeline
+    :param str sha: 图片唯一标识
+    :param int ctime: 上传时间
+    :param str username: 所属用户，匿名时为空
+    :param int expire: 临时图片的过期秒数，大于0时记录到过期索引
+    :param str album: 图片所属相册
+
+    .. versionadded:: 1.11.0
+    """
+    pipe.sadd(rsp("index", "global"), sha)
+    pipe.zadd(get_image_index_key(), {sha: ctime})
+    if username:
+        pipe.sadd(rsp("index", "user", username), sha)
+        pipe.zadd(get_image_index_key(username), {sha: ctime})
+    add_album_index(pipe, sha, ctime, album, username)
+    if expire > 0:
+        pipe.zadd(
+            rsp("index", "expire"),
+            {get_expire_member(sha, username, album): ctime + expire}
+        )
+
+
+def remove_image_index(pipe, sha, username=None, album=""):
+    """从全局及用户的集合索引、时间索引、相册索引中删除图片（在pipeline中执行）
+
+    .. versionadded:: 1.11.0
+    """
+    pipe.srem(rsp("index", "global"), sha)
+    pipe.zrem(get_image_index_key(), sha)
+    if username:
+        pipe.srem(rsp("index", "user", username), sha)
+        pipe.zrem(get_image_index_key(username), sha)
+    remove_album_index(pipe, sha, album, username)
+    pipe.zrem(rsp("index", "expire"), get_expire_member(sha, username, album))
+
+
+def prune_expired_images():
+    """清理已过期的临时图片的索引（图片数据由redis过期删除）
+
+    :returns: 清理的图片数量
+
+    .. versionadded:: 1.11.0
+    """
+    ek = rsp("index", "expire")
+    members = rc.zrangebyscore(ek, "-inf", get_current_timestamp())
+    if members:
+        items = [m.split(":", 2) for m in members]
+        gk = rsp("index", "global")
+        pipe = rc.pipeline()
+        for usr, sha, album in items:
+            pipe.sismember(gk, sha)
+        try:
+            #: 已被删除（如随用户删除）的图片不再处理，避免重复扣减相册计数
+            indexed = pipe.execute()
+            for (usr, sha, album), ok in zip(items, indexed):
+                if ok:
+                    remove_image_index(pipe, sha, usr, album)
+            pipe.zrem(ek, *members)
+            pipe.execute()
+        except RedisError as e:
+            logger.warning(e, exc_info=True)
+            return 0
+    return len(members)
+
+
+#: 分块上传的状态及暂存文件的保留时间（每次上传分块时刷新），秒
+CHUNKED_EXPIRE = 86400
+
+
+def get_chunked_key(upload_id):
+    """分块上传的状态(hash)：user、filename、size、received等
+
+    .. versionadded:: 1.11.0
+    """
+    return rsp("chunked", upload_id)
+
+
+def get_chunked_path(upload_id):
+    """分块上传在本地磁盘的暂存文件
+
+    .. versionadded:: 1.11.0
+    """
+    return pathjoin(GLOBAL["ChunkedUploadDir"], upload_id)
+
+
+def prune_chunked_uploads():
+    """清理超过保留时间仍未完成的分块上传暂存文件
+
+    :returns: 清理的文件数量
+
+    .. versionadded:: 1.11.0
+    """
+    basedir = GLOBAL["ChunkedUploadDir"]
+    if not isdir(basedir):
+        return 0
+    deadline = time() - CHUNKED_EXPIRE
+    total = 0
+    for name in listdir(basedir):
+        filepath = pathjoin(basedir, name)
+        try:
+            if getmtime(filepath) < deadline:
+                remove(filepath)
+                total += 1
+        except OSError:
+            continue
+    return total
+
+
+def stream_digest(stream):
+    """分块计算图片数据流的内容摘要(sha256)
+
+    :param stream: 文件对象或二进制
+
+    .. versionadded:: 1.11.0
+    """
+    if not hasattr(stream, "read"):
+        return offload(sha256, stream)
+    stream.seek(0, 2)
+    if stream.tell() >= GLOBAL["ProcessPoolThreshold"] * 1024:
+        return run_in_process(sha256, read_stream(stream))
+    h = hashlib.sha256()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(65536), b""):
+        h.update(chunk)
+    stream.seek(0)
+    return h.hexdigest()
+
+
+def get_digest_key(digest, scope):
+    """内容摘要索引，是引用同一存储对象的图片sha集合
+
+    :param str digest: 图片内容摘要
+    :param str scope: 去重范围，global或用户名
+
+    .. versionadded:: 1.11.0
+    """
+    return rsp("index", "digest", scope, digest)
+
+
+def get_stored_filename(info):
+    """图片在存储后端的文件名。内容去重的图片引用首次保存的存储对象，
+    其文件名(stored_filename)可能与上传时的文件名(filename)不同。
+
+    :param dict info: 图片数据
+
+    .. versionadded:: 1.11.0
+    """
+    return info.get("stored_filename") or info["filename"]
+
+
+def find_stored_image(digest, scope):
+    """查找内容相同且仍然存在的图片，用以引用其存储对象，顺便清理失效引用
+
+    :returns: 图片数据(dict)或None
+
+    .. versionadded:: 1.11.0
+    """
+    key = get_digest_key(digest, scope)
+    shas = list(rc.smembers(key))
+    if not shas:
+        return
+    pipe = rc.pipeline()
+    for sha in shas:
+        pipe.hgetall(rsp("image", sha))
+    stale = []
+    for sha, info in zip(shas, pipe.execute()):
+        if info and info.get("senders"):
+            if stale:
+                rc.srem(key, *stale)
+            return info
+        stale.append(sha)
+    rc.delete(key)
+
+
+def release_stored_images(images):
+    """删除图片时解除其对存储对象的引用，无论多少图片仅使用固定次数的redis请求
+
+    :param dict images: 图片唯一标识: 图片数据
+    :returns: 存储对象已无其他图片引用（可以删除）的图片唯一标识集合
+
+    .. versionadded:: 1.11.0
+    """
+    released = set()
+    keys = {}
+    for sha, info in iteritems(images):
+        digest, scope = info.get("digest"), info.get("digest_scope")
+        if digest and scope:
+            keys.setdefault(get_digest_key(digest, scope), []).append(sha)
+        else:
+            released.add(sha)
+    if not keys:
+        return released
+    keys = list(iteritems(keys))
+    pipe = rc.pipeline()
+    for key, shas in keys:
+        pipe.srem(key, *shas)
+        pipe.smembers(key)
+    others = [list(m) for m in pipe.execute()[1::2]]
+    pipe = rc.pipeline()
+    for members in others:
+        for other in members:
+            pipe.exists(rsp("image", other))
+    exists = pipe.execute() if any(others) else []
+    pipe = rc.pipeline()
+    pos = 0
+    for (key, shas), members in zip(keys, others):
+        if not any(exists[pos:pos + len(members)]):
+            pipe.delete(key)
+            released.update(shas)
+        pos += len(members)
+    pipe.execute()
+    return released
+
+
 def allowed_suffix(filename):
     """判断filename是否匹配控制台配置的上传后缀（及默认）
 
@@ -780,3 +1787,119 @@ def allowed_suffix(filename):
         allowed_file,
         suffix=parse_valid_verticaline(g.cfg.upload_exts)
     )(filename)
+
+
+#: 进程内缓冲的访问统计记录: (分类, 用户名, 记录)
+_report_buffer = []
+_report_lock = Lock()
+_report_event = Event()
+_report_thread = None
+#: 缓冲的记录数达到此值时提前写入
+REPORT_BATCH_SIZE = 500
+#: 缓冲的记录数上限（redis不可用时），超过后丢弃新记录
+REPORT_BUFFER_MAX = 50000
+
+
+def get_report_trimmed_key(classify, username):
+    """统计列表因保留上限（ReportMaxRecords）累计删除的记录数，
+    报表游标据此换算位置。
+
+    .. versionadded:: 1.11.0
+    """
+    return rsp("report", "trimmed", classify, username)
+
+
+def push_report(classify, username, record):
+    """缓冲一条访问统计记录，由后台线程(gevent worker中是greenlet)定期
+    批量写入 ``report:<classify>:<username>`` 列表。
+
+    redis不可用时记录保留在缓冲区，下次写入时重试。
+
+    :param dict record: 统计记录，有agent但没有uap字段时在写入前解析用户代理
+    :returns: 是否已缓冲（缓冲已满时丢弃）
+
+    .. versionadded:: 1.11.0
+    """
+    global _report_thread
+    with _report_lock:
+        if len(_report_buffer) >= REPORT_BUFFER_MAX:
+            return False
+        _report_buffer.append((classify, username, record))
+    if GLOBAL["ReportFlushInterval"] <= 0:
+        flush_reports()
+        return True
+    with _report_lock:
+        if len(_report_buffer) >= REPORT_BATCH_SIZE:
+            _report_event.set()
+        if _report_thread is None or not _report_thread.is_alive():
+            _report_thread = Thread(
+                target=_report_worker, name="ReportFlusher"
+            )
+            _report_thread.daemon = True
+            _report_thread.start()
+    return True
+
+
+def _report_worker():
+    while True:
+        _report_event.wait(GLOBAL["ReportFlushInterval"])
+        _report_event.clear()
+        try:
+            flush_reports()
+        except Exception as e:
+            logger.warning(e, exc_info=True)
+
+
+def flush_reports():
+    """把缓冲的访问统计按列表分组，一次pipeline写入并按保留上限截断。
+    写入失败时记录放回缓冲区头部，下次重试。
+
+    :returns: 写入的记录数
+
+    .. versionadded:: 1.11.0
+    """
+    with _report_lock:
+        items = _report_buffer[:]
+        del _report_buffer[:]
+    if not items:
+        return 0
+    groups = OrderedDict()
+    for classify, username, record in items:
+        if "agent" in record and "uap" not in record:
+            record["uap"] = parse_ua(record["agent"])
+        groups.setdefault((classify, username), []).append(json.dumps(record))
+    maxlen = GLOBAL["ReportMaxRecords"]
+    pipe = rc.pipeline()
+    for (classify, username), records in iteritems(groups):
+        key = rsp("report", classify, username)
+        #: 记录总是从表头写入，最新的在前
+        pipe.lpush(key, *records)
+        if maxlen > 0:
+            pipe.ltrim(key, 0, maxlen - 1)
+    try:
+        result = pipe.execute()
+    except RedisError as e:
+        logger.warning(e, exc_info=True)
+        #: 写入失败时放回缓冲区头部，下次重试，总数不超过缓冲上限
+        with _report_lock:
+            _report_buffer[:0] = items[
+                :max(0, REPORT_BUFFER_MAX - len(_report_buffer))
+            ]
+        return 0
+    if maxlen > 0:
+        #: 记录从表尾删除，累计删除数以便游标仍指向原来的记录
+        pipe = rc.pipeline()
+        for (classify, username), length in zip(groups, result[::2]):
+            if length > maxlen:
+                pipe.incrby(
+                    get_report_trimmed_key(classify, username),
+                    length - maxlen
+                )
+        try:
+            pipe.execute()
+        except RedisError as e:
+            logger.warning(e, exc_info=True)
+    return len(items)
+
+
+atexit.register(flush_reports)
@@ -10,29 +10,46 @@
 """
 
 import json
+from os import makedirs, remove
+from os.path import isdir
+from io import BytesIO
 from random import choice, randint
 from posixpath import join, splitext
 from base64 import urlsafe_b64encode as b64encode
 from werkzeug.utils import secure_filename
 from werkzeug.security import check_password_hash, generate_password_hash
 from flask import Blueprint, request, g, url_for, current_app, abort, \
-    make_response, jsonify, Response
+    make_response, jsonify, Response, after_this_request
 from functools import partial
+from itertools import chain
 from redis.exceptions import RedisError
-from collections import Counter
+from config import GLOBAL
 from utils.tool import allowed_file, parse_valid_comma, is_true, logger, sha1,\
     parse_valid_verticaline, get_today, gen_rnd_filename, hmac_sha256, rsp, \
     sha256, get_current_timestamp, list_equal_split, generate_random, er_pat, \
-    format_upload_src, check_origin, get_origin, check_ip, gen_uuid, ir_pat, \
-    username_pat, ALLOWED_HTTP_METHOD, is_all_fail, parse_valid_colon, \
-    check_ir, less_latest_tag, check_url
+    format_upload_src, check_origin, get_origin, check_ip_network, gen_uuid, \
+    ir_pat, username_pat, ALLOWED_HTTP_METHOD, is_all_fail, \
+    parse_valid_colon, check_ir, less_latest_tag, check_url, encode_cursor, \
+    decode_cursor
 from utils.web import dfr, admin_apilogin_required, apilogin_required, \
     set_site_config, check_username, Base64FileStorage, change_res_format, \
     ImgUrlFileStorage, get_upload_method, _pip_install, make_email_tpl, \
     generate_activate_token, check_activate_token, try_proxy_request, \
     sendmail, _pip_list, get_user_ip, has_image, guess_filename_from_url, \
-    allowed_suffix
-from utils._compat import iteritems, thread
+    allowed_suffix, get_image_index_key, add_image_index, remove_image_index, \
+    prune_expired_images, get_album_index_key, get_album_counter_key, \
+    get_album_counter, add_album_index, remove_album_index, zrange_after, \
+    read_stream, make_stream, stream_digest, get_digest_key, \
+    find_stored_image, release_stored_images, fanout_call, \
+    delete_saved_image, save_derivatives, get_derivative_srcs, \
+    delete_saved_images, \
+    ChunkedFileStorage, get_chunked_key, get_chunked_path, \
+    prune_chunked_uploads, CHUNKED_EXPIRE, spawn_in_context, \
+    bump_auth_version, get_report_trimmed_key, move_expire_index, \
+    get_stored_filename
+from utils.job import enqueue_job, get_replica_field, create_load_job, \
+    get_load_key, LOAD_CHUNK_SIZE
+from utils._compat import iteritems, thread, Queue, string_types
 from utils.exceptions import ApiError
 
 bp = Blueprint("api", "api")
@@ -188,6 +205,9 @@ def register():
                     uk = rsp("account", username)
                     pipe = g.rc.pipeline()
                     pipe.sadd(ak, username)
+                    pipe.zadd(
+                        rsp("index", "accounts"), {username: options["ctime"]}
+                    )
                     pipe.hmset(uk, options)
                     try:
                         pipe.execute()
@@ -253,9 +273,12 @@ def forgot():
                 res = check_activate_token(token)
                 if res["code"] == 0:
                     try:
-                        g.rc.hset(
+                        pipe = g.rc.pipeline()
+                        pipe.hset(
                             uk, "password", generate_password_hash(password)
                         )
+                        bump_auth_version(username, pipe)
+                        pipe.execute()
                     except RedisError:
                         res.update(
                             code=1, msg="Program data storage service error"
@@ -349,11 +372,15 @@ def user():
         sort = request.args.get("sort") or "desc"
         page = request.args.get("page") or 1
         limit = request.args.get("limit") or 10
+        #: 游标，由上一页响应的next_cursor得到，传递此参数(可为空)时忽略page
+        cursor = request.args.get("cursor")
         try:
             page = int(page) - 1
             limit = int(limit)
-            if page < 0:
+            if page < 0 or limit <= 0:
                 raise ValueError
+            if cursor:
+                cursor = decode_cursor(cursor)
         except (ValueError, TypeError):
             res.update(code=2, msg="Parameter error")
         else:
@@ -362,11 +389,23 @@ def user():
                 "is_admin", "status", "message", "email", "email_verified",
                 "status_reason", "label", "login_at", "login_ip"
             )
-            pipe = g.rc.pipeline()
-            for u in g.rc.smembers(ak):
-                pipe.hmget(rsp("account", u), *fds)
-                pipe.scard(rsp("index", "user", u))
+            #: 从按注册时间排序的用户索引中仅读取当前页的用户
+            zk = rsp("index", "accounts")
+            reverse = False if sort == "asc" else True
             try:
+                count = g.rc.zcard(zk)
+                if cursor is None:
+                    start = page * limit
+                    items = g.rc.zrange(
+                        zk, start, start + limit - 1,
+                        desc=reverse, withscores=True,
+                    )
+                else:
+                    items = zrange_after(zk, cursor, limit, reverse)
+                pipe = g.rc.pipeline()
+                for u, _ in items:
+                    pipe.hmget(rsp("account", u), *fds)
+                    pipe.scard(rsp("index", "user", u))
                 data = pipe.execute()
             except RedisError:
                 res.update(msg="Program data storage service error")
@@ -390,20 +429,15 @@ def user():
                     d["pics"] = user_pics
                     return d
                 data = [fmt(d) for d in list_equal_split(data, 2)]
-                data = sorted(
-                    data,
-                    key=lambda k: k.get('ctime', 0),
-                    reverse=False if sort == "asc" else True
-                )
-                count = len(data)
-                data = list_equal_split(data, limit)
-                pageCount = len(data)
-                if page < pageCount:
+                if data:
                     res.update(
                         code=0,
                         count=count,
-                        data=data[page],
-                        pageCount=pageCount,
+                        data=data,
+                        pageCount=(count + limit - 1) // limit,
+                        next_cursor=encode_cursor(
+                            int(items[-1][1]), items[-1][0]
+                        ) if len(items) == limit else None,
                     )
                 else:
                     res.update(code=3, msg="No data")
@@ -418,13 +452,31 @@ def user():
             if g.rc.sismember(ak, username):
                 pipe = g.rc.pipeline()
                 pipe.srem(ak, username)
+                pipe.zrem(rsp("index", "accounts"), username)
                 pipe.delete(rsp("account", username))
+                bump_auth_version(username, pipe)
                 #: 删除用户相关数据
                 # 删除图片
                 uk = rsp("index", "user", username)
+                albums = get_album_counter(username)
                 for sha in g.rc.smembers(uk):
                     pipe.delete(rsp("image", sha))
+                    remove_image_index(pipe, sha)
+                for a in albums:
+                    ashas = g.rc.zrange(
+                        get_album_index_key(a, username), 0, -1
+                    )
+                    if ashas:
+                        pipe.zrem(get_album_index_key(a), *ashas)
+                    pipe.hincrby(get_album_counter_key(), a, -albums[a])
+                    pipe.delete(get_album_index_key(a, username))
                 pipe.delete(uk)
+                pipe.delete(get_image_index_key(username))
+                pipe.delete(get_album_counter_key(username))
+                for k in g.rc.scan_iter(
+                    get_digest_key("*", username), count=1000
+                ):
+                    pipe.delete(k)
                 # 删除linktoken
                 lk = rsp("linktokens")
                 for ltid, usr in iteritems(g.rc.hgetall(lk)):
@@ -433,6 +485,7 @@ def user():
                         pipe.delete(rsp("linktoken", ltid))
                 # 删除统计
                 pipe.delete(rsp("report", "linktokens", username))
+                pipe.delete(get_report_trimmed_key("linktokens", username))
                 try:
                     pipe.execute()
                 except RedisError:
@@ -464,6 +517,7 @@ def user():
                     pipe.hset(uk, "status", s)
                     if reason:
                         pipe.hset(uk, "status_reason", reason)
+                    bump_auth_version(username, pipe)
                     try:
                         pipe.execute()
                     except RedisError:
@@ -480,8 +534,11 @@ def user():
             if username:
                 if username != g.userinfo.username and \
                         g.rc.sismember(ak, username):
+                    pipe = g.rc.pipeline()
+                    pipe.hset(rsp("account", username), "is_admin", adm)
+                    bump_auth_version(username, pipe)
                     try:
-                        g.rc.hset(rsp("account", username), "is_admin", adm)
+                        pipe.execute()
                     except RedisError:
                         res.update(msg="Program data storage service error")
                     else:
@@ -494,8 +551,11 @@ def user():
             #: 给用户贴上标签，允许置空
             if username and g.rc.sismember(ak, username):
                 label = request.form.get("label") or ""
+                pipe = g.rc.pipeline()
+                pipe.hset(rsp("account", username), "label", label)
+                bump_auth_version(username, pipe)
                 try:
-                    g.rc.hset(rsp("account", username), "label", label)
+                    pipe.execute()
                 except RedisError:
                     res.update(msg="Program data storage service error")
                 else:
@@ -704,6 +764,7 @@ def token():
                 pipe = g.rc.pipeline()
                 pipe.hset(tk, token, usr)
                 pipe.hmset(ak, dict(token=token, token_key=tkey))
+                bump_auth_version(usr, pipe)
                 pipe.execute()
             except RedisError:
                 res.update(msg="Program data storage service error")
@@ -716,6 +777,7 @@ def token():
                 pipe = g.rc.pipeline()
                 pipe.hdel(tk, token)
                 pipe.hdel(ak, "token")
+                bump_auth_version(usr, pipe)
                 pipe.execute()
             except RedisError:
                 res.update(msg="Program data storage service error")
@@ -733,6 +795,7 @@ def token():
                 pipe.hdel(tk, oldToken)
             pipe.hset(tk, token, usr)
             pipe.hmset(ak, dict(token=token, token_key=tkey))
+            bump_auth_version(usr, pipe)
             pipe.execute()
         except RedisError:
             res.update(msg="Program data storage service error")
@@ -760,8 +823,11 @@ def my():
         if is_true(g.userinfo.email_verified) and \
                 data.get("email") != g.userinfo.email:
             data["email_verified"] = 0
+        pipe = g.rc.pipeline()
+        pipe.hmset(ak, data)
+        bump_auth_version(username, pipe)
         try:
-            g.rc.hmset(ak, data)
+            pipe.execute()
         except RedisError:
             res.update(msg="Program data storage service error")
         else:
@@ -780,10 +846,13 @@ def my():
                 if passwd != repasswd:
                     res.update(msg="Confirm passwords do not match")
                 else:
+                    pipe = g.rc.pipeline()
+                    pipe.hmset(ak, dict(
+                        password=generate_password_hash(passwd),
+                    ))
+                    bump_auth_version(username, pipe)
                     try:
-                        g.rc.hmset(ak, dict(
-                            password=generate_password_hash(passwd),
-                        ))
+                        pipe.execute()
                     except RedisError:
                         res.update(msg="Program data storage service error")
                     else:
@@ -798,8 +867,11 @@ def my():
                 if not k.startswith("ucfg_"):
                     res.update(msg="The user setting must start with `ucfg_`")
                     return res
+            pipe = g.rc.pipeline()
+            pipe.hmset(ak, cfgs)
+            bump_auth_version(username, pipe)
             try:
-                g.rc.hmset(ak, cfgs)
+                pipe.execute()
             except RedisError:
                 res.update(msg="Program data storage service error")
             else:
@@ -816,6 +888,7 @@ def my():
                     return res
                 pipe.hset(ak, "status", -1)
             pipe.hset(ak, "message", message)
+            bump_auth_version(username, pipe)
             try:
                 pipe.execute()
             except RedisError:
@@ -846,6 +919,7 @@ def my():
         #: 删除用户相关数据
         pipe = g.rc.pipeline()
         pipe.srem(rsp("accounts"), username)
+        pipe.zrem(rsp("index", "accounts"), username)
         pipe.delete(ak)
         # 删除linktoken
         lk = rsp("linktokens")
@@ -855,6 +929,7 @@ def my():
                 pipe.delete(rsp("linktoken", ltid))
         # 删除统计
         pipe.delete(rsp("report", "linktokens", username))
+        pipe.delete(get_report_trimmed_key("linktokens", username))
         try:
             pipe.execute()
         except RedisError:
@@ -878,95 +953,274 @@ def waterfall():
     is_mgr = is_true(request.args.get("is_mgr"))
     #: 相册，当album不为空时，近返回此相册数据，允许逗号分隔多个
     album = request.args.get("album", request.form.get("album"))
+    #: 游标，由上一页响应的next_cursor得到，传递此参数(可为空)时忽略page
+    cursor = request.args.get("cursor")
     try:
         page = int(page) - 1
         limit = int(limit)
-        if page < 0:
+        if page < 0 or limit <= 0:
             raise ValueError
+        if cursor:
+            cursor = decode_cursor(cursor)
     except (ValueError, TypeError):
         res.update(code=2, msg="Parameter error")
     else:
         if g.userinfo.username:
-            if is_mgr and g.is_admin:
-                uk = rsp("index", "global")
+            usr = None if is_mgr and g.is_admin else g.userinfo.username
+            ask_albums = parse_valid_comma(album)
+            if ask_albums:
+                zks = [get_album_index_key(a, usr) for a in set(ask_albums)]
             else:
-                uk = rsp("index", "user", g.userinfo.username)
+                zks = [get_image_index_key(usr)]
+            prune_expired_images()
+            reverse = False if sort == "asc" else True
             pipe = g.rc.pipeline()
-            for sha in g.rc.smembers(uk):
-                pipe.hgetall(rsp("image", sha))
+            for zk in zks:
+                pipe.zcard(zk)
             try:
-                result = pipe.execute()
+                count = sum(pipe.execute())
+                albums = get_album_counter(usr)
+                if cursor is None:
+                    #: 页码模式，多个相册时合并各自的前几页
+                    start = page * limit
+                    end = start + limit - 1
+                    pipe = g.rc.pipeline()
+                    for zk in zks:
+                        if len(zks) == 1:
+                            pipe.zrange(
+                                zk, start, end, desc=reverse, withscores=True
+                            )
+                        else:
+                            pipe.zrange(
+                                zk, 0, end, desc=reverse, withscores=True
+                            )
+                    items = list(chain(*pipe.execute()))
+                    if len(zks) > 1:
+                        items = sorted(
+                            set(items),
+                            key=lambda i: (i[1], i[0]),
+                            reverse=reverse,
+                        )[start:end + 1]
+                else:
+                    #: 游标模式，从上一页最后一张图片之后读取
+                    items = sorted(
+                        set(chain(*[
+                            zrange_after(zk, cursor, limit, reverse)
+                            for zk in zks
+                        ])),
+                        key=lambda i: (i[1], i[0]),
+                        reverse=reverse,
+                    )[:limit]
             except RedisError:
                 res.update(msg="Program data storage service error")
-            else:
-                #: 最终返回的经过过滤、排序等处理后的数据
-                data = []
-                #: 该用户或管理员级别所能查看的所有相册
-                albums = []
-                ask_albums = parse_valid_comma(album)
-                if result and isinstance(result, (tuple, list)):
-                    for i in result:
-                        if not i or not isinstance(i, dict):
-                            continue
-                        albums.append(i.get("album"))
-                        i.update(
-                            senders=json.loads(i["senders"]),
-                            ctime=int(i["ctime"]),
-                        )
-                        if ask_albums:
-                            if i.get("album") in ask_albums:
-                                data.append(i)
-                        else:
-                            data.append(i)
-                data = sorted(
-                    data,
-                    key=lambda k: (k.get('ctime', 0), k.get('filename', '')),
-                    reverse=False if sort == "asc" else True
+                return res
+            shas = [sha for sha, _ in items]
+            if items and len(items) == limit:
+                res["next_cursor"] = encode_cursor(
+                    int(items[-1][1]), items[-1][0]
                 )
-                count = len(data)
-                data = list_equal_split(data, limit)
-                pageCount = len(data)
-                if page < pageCount:
-                    res.update(
-                        code=0,
-                        count=count,
-                        data=data[page],
-                        pageCount=pageCount,
-                        albums=list(set([i for i in albums if i])),
+            else:
+                res["next_cursor"] = None
+            pageCount = (count + limit - 1) // limit
+            data = []
+            if shas:
+                pipe = g.rc.pipeline()
+                for sha in shas:
+                    pipe.hgetall(rsp("image", sha))
+                try:
+                    result = pipe.execute()
+                except RedisError:
+                    res.update(msg="Program data storage service error")
+                    return res
+                for i in result:
+                    if not i or not isinstance(i, dict):
+                        continue
+                    i.update(
+                        senders=json.loads(i["senders"]),
+                        ctime=int(i["ctime"]),
+                        derivatives=get_derivative_srcs(i.get("derivatives")),
                     )
-                else:
-                    res.update(code=3, msg="No data")
+                    data.append(i)
+            if data:
+                res.update(
+                    code=0,
+                    count=count,
+                    data=data,
+                    pageCount=pageCount,
+                    albums=list(albums),
+                )
+            else:
+                res.update(code=3, msg="No data")
         else:
             res.update(msg="No valid username found")
     return res
 
 
+def get_image_detail(data):
+    """图片详情接口返回的图片数据
+
+    :param dict data: 图片数据(hash)
+
+    .. versionadded:: 1.11.0
+    """
+    n = data["filename"]
+    data.update(
+        senders=json.loads(data["senders"]) if g.is_admin else None,
+        ctime=int(data["ctime"]),
+        derivatives=get_derivative_srcs(data.get("derivatives")),
+        tpl=dict(
+            URL="%s" % get_url_with_suffix(data, "url"),
+            HTML="<img src='%s' title='%s' alt='%s'>" % (
+                get_url_with_suffix(data, "html"),
+                data.get("title", ""), n
+            ),
+            rST=".. image:: %s" % get_url_with_suffix(data, "rst"),
+            Markdown="![%s](%s)" % (
+                n, get_url_with_suffix(data, "markdown")
+            )
+        )
+    )
+    return data
+
+
+def delete_image_storage(images):
+    """删除图片（数据及索引已删除）在存储后端保存的图片及衍生图，
+    按存储后端分组并发删除；存储对象仍被内容相同的其他图片引用时不删除。
+
+    :param dict images: 图片唯一标识: 图片数据
+
+    .. versionadded:: 1.11.0
+    """
+    try:
+        released = release_stored_images(images)
+    except RedisError as e:
+        logger.warning(e, exc_info=True)
+        return
+    groups = {}
+    pipe = g.rc.pipeline()
+    for sha in released:
+        info = images[sha]
+        try:
+            senders = json.loads(info.get("senders"))
+            derivatives = json.loads(info.get("derivatives") or "{}")
+        except (TypeError, ValueError) as e:
+            logger.warning(e, exc_info=True)
+            continue
+        for i in senders:
+            #: 启用后台任务时，远程存储后端的删除由任务执行
+            if g.cfg.upload_async and i["sender"] != "up2local":
+                enqueue_job(
+                    "delete", sha, i["sender"], pipe,
+                    upload_path=info["upload_path"],
+                    filename=get_stored_filename(info),
+                    save_result=i,
+                )
+                continue
+            groups.setdefault(i["sender"], []).append(dict(
+                sha=sha,
+                upload_path=info["upload_path"],
+                filename=get_stored_filename(info),
+                basedir=i.get("basedir"),
+                save_result=i,
+            ))
+        for d in derivatives.values():
+            groups.setdefault(d["sender"], []).append(dict(
+                sha=sha,
+                upload_path=info["upload_path"],
+                filename=d["filename"],
+                basedir=d.get("basedir"),
+                save_result=d,
+            ))
+    try:
+        pipe.execute()
+    except RedisError as e:
+        logger.warning(e, exc_info=True)
+    #: 删除图片尝试执行senders的upimg_delete方法，后端钩子未禁用时才会执行
+    delete_saved_images(groups)
+
+
+#: 批量查询、删除图片时一次最多的图片数量
+SHA_BATCH_MAX = 1000
+
+
+@bp.route("/sha", methods=["POST", "DELETE"])
+def shabatch():
+    """批量图片查询(POST)、删除(DELETE)接口，所有图片在一个pipeline中查询
+
+    .. versionadded:: 1.11.0
+    """
+    res = dict(code=1, msg=None)
+    data = request.get_json(silent=True)
+    shas = data.get("sha") if isinstance(data, dict) else None
+    if not isinstance(shas, list):
+        shas = parse_valid_comma(request.form.get("sha") or "")
+    shas = list(set(sha for sha in shas if sha))
+    if not shas:
+        raise ApiError("Parameter error")
+    if len(shas) > SHA_BATCH_MAX:
+        raise ApiError("Too many shas, up to %d" % SHA_BATCH_MAX)
+    if request.method == "DELETE" and not g.signin:
+        return abort(403)
+    gk = rsp("index", "global")
+    pipe = g.rc.pipeline()
+    for sha in shas:
+        pipe.sismember(gk, sha)
+        pipe.hgetall(rsp("image", sha))
+    try:
+        result = pipe.execute()
+    except RedisError:
+        res.update(msg="Program data storage service error")
+        return res
+    images, fail = {}, {}
+    for sha, exists, info in zip(shas, result[::2], result[1::2]):
+        if not (exists and info):
+            fail[sha] = "Not Found"
+        elif request.method == "DELETE" and not (
+            g.is_admin or g.userinfo.username == info.get("user")
+        ):
+            fail[sha] = "Forbidden"
+        else:
+            images[sha] = info
+    if request.method == "POST":
+        res.update(
+            code=0,
+            data={sha: get_image_detail(i) for sha, i in iteritems(images)},
+            fail=fail,
+            count=dict(success=len(images), fail=len(fail)),
+        )
+        return res
+    if images:
+        pipe = g.rc.pipeline()
+        for sha, info in iteritems(images):
+            husr = info.get("user")
+            remove_image_index(
+                pipe, sha, None if husr == "anonymous" else husr,
+                info.get("album"),
+            )
+            pipe.delete(rsp("image", sha))
+        try:
+            pipe.execute()
+        except RedisError:
+            res.update(msg="Program data storage service error")
+            return res
+        delete_image_storage(images)
+    res.update(
+        code=0,
+        success=list(images),
+        fail=fail,
+        count=dict(success=len(images), fail=len(fail)),
+    )
+    return res
+
+
 @bp.route("/sha/<sha>", methods=["GET", "DELETE", "PUT"])
 def shamgr(sha):
     """图片查询、删除接口"""
     res = dict(code=1, msg=None)
-    gk = rsp("index", "global")
     ik = rsp("image", sha)
     if request.method == "GET":
         if has_image(sha):
-            data = g.rc.hgetall(ik)
-            n = data["filename"]
-            data.update(
-                senders=json.loads(data["senders"]) if g.is_admin else None,
-                ctime=int(data["ctime"]),
-                tpl=dict(
-                    URL="%s" % get_url_with_suffix(data, "url"),
-                    HTML="<img src='%s' title='%s' alt='%s'>" % (
-                        get_url_with_suffix(data, "html"),
-                        data.get("title", ""), n
-                    ),
-                    rST=".. image:: %s" % get_url_with_suffix(data, "rst"),
-                    Markdown="![%s](%s)" % (
-                        n, get_url_with_suffix(data, "markdown")
-                    )
-                )
-            )
-            res.update(code=0, data=data)
+            res.update(code=0, data=get_image_detail(g.rc.hgetall(ik)))
         else:
             return abort(404)
     elif request.method == "DELETE":
@@ -980,8 +1234,10 @@ def shamgr(sha):
             husr = info.get("user")
             if g.is_admin or (g.userinfo.username == husr):
                 pipe = g.rc.pipeline()
-                pipe.srem(gk, sha)
-                pipe.srem(rsp("index", "user", husr), sha)
+                remove_image_index(
+                    pipe, sha, None if husr == "anonymous" else husr,
+                    info.get("album"),
+                )
                 pipe.delete(ik)
                 try:
                     pipe.execute()
@@ -989,23 +1245,7 @@ def shamgr(sha):
                     res.update(msg="Program data storage service error")
                 else:
                     res.update(code=0)
-                    try:
-                        #: 删除图片尝试执行senders的upimg_delete方法
-                        #: 后端钩子未禁用时才会执行删除
-                        #: TODO 无论禁用与否都删除?
-                        senders = json.loads(info.get("senders"))
-                        for i in senders:
-                            g.hm.proxy(
-                                i["sender"]
-                            ).upimg_delete(
-                                sha=sha,
-                                upload_path=info["upload_path"],
-                                filename=info["filename"],
-                                basedir=i.get("basedir"),
-                                save_result=i
-                            )
-                    except (ValueError, AttributeError, Exception) as e:
-                        logger.warning(e, exc_info=True)
+                    delete_image_storage({sha: info})
             else:
                 return abort(403)
         else:
@@ -1018,11 +1258,19 @@ def shamgr(sha):
             if not has_image(sha):
                 return abort(404)
             #: 更改相册名，允许图片所属用户或管理员修改，允许置空
-            album = request.form.get("album") or ""
-            owner = g.rc.hget(ik, "user")
+            album = (request.form.get("album") or "").strip()
+            owner, old_album, ctime = g.rc.hmget(ik, "user", "album", "ctime")
             if g.userinfo.username == owner or g.is_admin:
+                if owner == "anonymous":
+                    owner = None
+                pipe = g.rc.pipeline()
+                pipe.hset(ik, "album", album)
+                if album != old_album:
+                    remove_album_index(pipe, sha, old_album, owner)
+                    add_album_index(pipe, sha, int(ctime), album, owner)
+                    move_expire_index(pipe, sha, owner, old_album, album)
                 try:
-                    g.rc.hset(ik, "album", album.strip())
+                    pipe.execute()
                 except RedisError:
                     res.update(msg="Program data storage service error")
                 else:
@@ -1034,6 +1282,574 @@ def shamgr(sha):
     return res
 
 
+def get_upload_file(picstrurl, filename=None):
+    """从上传字段值获取图片文件对象：以http://或https://开头时下载图片，
+    返回ImgUrlFileStorage类，否则尝试base64解码，返回Base64FileStorage类，
+    无效时返回None
+
+    .. versionadded:: 1.11.0
+    """
+    fp = None
+    filename = secure_filename(filename or "")
+    if picstrurl:
+        if picstrurl.startswith("http://") or \
+                picstrurl.startswith("https://"):
+            fp = ImgUrlFileStorage(picstrurl, filename).getObj
+        else:
+            try:
+                #: base64在部分场景发起http请求时，+可能会换成空格导致异常
+                fp = Base64FileStorage(picstrurl, filename)
+            except ValueError as e:
+                logger.debug(e)
+    return fp
+
+
+def save_upload(fp, allowed_suffix):
+    """上传流程中保存图片的部分：调用处理、拦截钩子，生成文件名、上传目录，
+    内容去重或保存到存储后端，生成衍生图，但不写入图片数据及索引
+    （由 :func:`index_upload` 写入pipeline，以便批量上传时一次写入）。
+
+    不读取请求参数，所以可以在 :func:`utils.web.spawn_in_context` 的线程中
+    执行。
+
+    :param fp: 上传的文件对象，有filename、stream属性
+    :param allowed_suffix: 函数，判断文件名后缀是否允许
+    :returns: dict，code不为0表示失败，否则包含sha、filename、
+              stored_filename、upload_path、digest、digest_scope、
+              data（成功的后端结果）、derivatives、method
+    :raises ApiError: 没有有效的存储后端
+
+    .. versionadded:: 1.11.0
+    """
+    res = dict(code=1, msg=None)
+    if not (fp and allowed_suffix(fp.filename)):
+        res.update(msg="No file or image format error")
+        return res
+    #: 图片数据流是文件对象（较大时在临时文件中），声明upimg_streaming的
+    #: 钩子直接接收文件对象，其他钩子接收读取的完整二进制（仅读取一次）
+    stream = make_stream(fp.stream)
+    streaming = set([
+        h["name"]
+        for h in g.hm.get_call_list("upimg_streaming", _type="bool")
+    ])
+    cache = {}
+
+    def stream_for(name):
+        if name in streaming:
+            stream.seek(0)
+            return stream
+        if "data" not in cache:
+            cache["data"] = read_stream(stream)
+        return cache["data"]
+
+    suffix = splitext(fp.filename)[-1]
+    #: 处理图片二进制的钩子
+    for h in g.hm.get_call_list(
+        "upimg_stream_processor", _type="func"
+    ):
+        rst = g.hm.proxy(h["name"]).upimg_stream_processor(
+            stream_for(h["name"]), suffix
+        )
+        if isinstance(rst, dict) and rst.get("code") == 0 and \
+                isinstance(rst.get("data"), dict) and \
+                rst["data"].get("stream"):
+            stream = make_stream(rst["data"]["stream"])
+            cache.clear()
+            #: 处理钩子转换了图片格式时，同时返回新的后缀
+            if rst["data"].get("suffix"):
+                suffix = rst["data"]["suffix"]
+    for h in g.hm.get_call_list(
+        "upimg_stream_interceptor", _type="func"
+    ):
+        rst = g.hm.call(
+            "upimg_stream_interceptor",
+            _include=[h["name"]],
+            _args=(stream_for(h["name"]), suffix),
+        )
+        if rst and rst[0].get("code") != 0:
+            res.update(
+                msg="Interceptor processing rejection, upload aborted",
+                errors={
+                    rst[0]["sender"]: rst[0].get("msg")
+                }
+            )
+            return res
+    #: 定义图片文件名
+    filename = secure_filename(fp.filename)
+    if "." not in filename:
+        filename = "%s%s" % (generate_random(8), suffix)
+    elif splitext(filename)[-1] != suffix:
+        filename = "%s%s" % (splitext(filename)[0], suffix)
+    #: 根据文件名规则重定义图片名
+    upload_file_rule = (
+        g.userinfo.ucfg_upload_file_rule or g.cfg.upload_file_rule
+    ) if is_true(g.cfg.upload_rule_overridden) else g.cfg.upload_file_rule
+    if upload_file_rule in ("time1", "time2", "time3"):
+        filename = "%s%s" % (gen_rnd_filename(upload_file_rule), suffix)
+    #: 上传文件位置前缀规则
+    upload_path_rule = (
+        g.userinfo.ucfg_upload_path_rule or g.cfg.upload_path_rule
+    ) if is_true(g.cfg.upload_rule_overridden) else g.cfg.upload_path_rule
+    if upload_path_rule == 'date1':
+        upload_path = get_today("%Y/%m/%d")
+    elif upload_path_rule == 'date2':
+        upload_path = get_today("%Y%m%d")
+    else:
+        upload_path = ''
+    upload_path = join(g.userinfo.username or 'anonymous', upload_path)
+    #: 图片内容摘要，参与生成唯一索引并用于去重
+    digest = stream_digest(stream)
+    #: 定义文件名唯一索引
+    sha = "sha1.%s.%s" % (
+        get_current_timestamp(True), sha1("%s.%s" % (filename, digest))
+    )
+    #: 内容去重：同一用户(或全局)再次上传相同内容时直接引用已存储的图片
+    dedup = g.cfg.upload_dedup or "user"
+    digest_scope = stored = None
+    if dedup in ("user", "global"):
+        digest_scope = "global" if dedup == "global" else (
+            g.userinfo.username or "anonymous"
+        )
+        try:
+            stored = find_stored_image(digest, digest_scope)
+        except RedisError as e:
+            logger.warning(e, exc_info=True)
+    #: 存储对象的文件名，去重时引用已存储的图片，上传的文件名不变
+    stored_filename = filename
+    if stored:
+        stored_filename = get_stored_filename(stored)
+        upload_path = stored["upload_path"]
+        data = json.loads(stored["senders"])
+        derivatives = json.loads(stored.get("derivatives") or "{}")
+    else:
+        #: 定义保存图片时仅使用某些钩子，如: up2local
+        includes = parse_valid_comma(g.cfg.upload_includes or 'up2local')
+        if len(includes) > 1:
+            includes = [choice(includes)]
+        #: 冗余存储，并发保存到多个后端钩子
+        fanout = parse_valid_comma(g.cfg.upload_fanout or '')
+        if len(fanout) > 1:
+            includes = fanout
+        #: 当用户有标签且定义了用户上传分组则尝试覆盖默认includes
+        up_grp = g.cfg.upload_group
+        usr_label = g.userinfo.label if g.signin else "anonymous"
+        if up_grp and usr_label:
+            up_grp_rule = parse_valid_colon(up_grp) or {}
+            if usr_label in up_grp_rule:
+                includes = [up_grp_rule[usr_label]]
+        #: TODO 定义保存图片时排除某些钩子，如: up2local, up2other
+        #: excludes = parse_valid_comma(g.cfg.upload_excludes or '')
+        #: 调用钩子中upimg_save方法
+        names = [
+            h["name"] for h in g.hm.get_call_list(
+                "upimg_save", _include=includes, _type="func"
+            )
+        ]
+        if len(names) > 1:
+            #: 并发保存时各钩子共享一次读取的二进制
+            content = read_stream(stream)
+
+            def save_kwargs(name):
+                return dict(
+                    filename=filename,
+                    stream=BytesIO(content) if name in streaming
+                    else content,
+                    upload_path=upload_path,
+                )
+
+            def rollback(result):
+                delete_saved_image(sha, upload_path, filename, [result])
+
+            try:
+                timeout = int(g.cfg.upload_timeout or 30)
+            except (ValueError, TypeError):
+                timeout = 30
+            data = fanout_call(
+                "upimg_save", names, save_kwargs,
+                quorum=g.cfg.upload_quorum or 1,
+                timeout=timeout,
+                rollback=rollback,
+            )
+        else:
+            data = []
+            for name in names:
+                data.extend(g.hm.call(
+                    _funcname="upimg_save",
+                    _include=[name],
+                    _kwargs=dict(
+                        filename=filename,
+                        stream=stream_for(name),
+                        upload_path=upload_path,
+                    )
+                ))
+    #: 判定后端存储全部失败时，上传失败
+    if not data:
+        raise ApiError("No valid backend storage service")
+    if is_all_fail(data):
+        res.update(
+            code=1,
+            msg="All backend storage services failed to save pictures",
+            errors={
+                i["sender"]: i["msg"]
+                for i in data
+                if i.get("code") != 0
+            },
+        )
+        return res
+    #: 存储数据（仅保存成功的后端）
+    data = [i for i in data if i.get("code") == 0]
+    #: 生成缩略图等衍生图，使用原图的存储后端保存
+    if not stored:
+        derivatives = save_derivatives(
+            cache.get("data") or stream, filename, upload_path,
+            data[0]["sender"]
+        )
+    res.update(
+        code=0,
+        sha=sha,
+        filename=filename,
+        stored_filename=stored_filename,
+        upload_path=upload_path,
+        digest=digest,
+        digest_scope=digest_scope,
+        data=data,
+        derivatives=derivatives,
+        method=get_upload_method(fp.__class__.__name__),
+    )
+    return res
+
+
+def index_upload(pipe, saved, album, expire=0, title="", origin=""):
+    """在pipeline中写入 :func:`save_upload` 保存的图片数据及索引，
+    并添加异步复制任务
+
+    .. versionadded:: 1.11.0
+    """
+    sha = saved["sha"]
+    data = saved["data"]
+    ctime = get_current_timestamp()
+    add_image_index(
+        pipe, sha, ctime,
+        g.userinfo.username if g.signin else None,
+        expire, album,
+    )
+    pipe.hmset(rsp("image", sha), dict(
+        sha=sha,
+        album=album,
+        filename=saved["filename"],
+        stored_filename=saved["stored_filename"],
+        upload_path=saved["upload_path"],
+        user=g.userinfo.username if g.signin else 'anonymous',
+        ctime=ctime,
+        status='enabled',  # deleted
+        src=data[0]["src"],
+        sender=data[0]["sender"],
+        senders=json.dumps(data),
+        origin=origin,
+        method=saved["method"],
+        title=title,
+        digest=saved["digest"],
+    ))
+    if saved["digest_scope"]:
+        pipe.hset(rsp("image", sha), "digest_scope", saved["digest_scope"])
+        pipe.sadd(get_digest_key(saved["digest"], saved["digest_scope"]), sha)
+    if saved["derivatives"]:
+        pipe.hset(
+            rsp("image", sha), "derivatives", json.dumps(saved["derivatives"])
+        )
+    #: 异步复制到远程存储后端（由后台任务执行）
+    senders = [i["sender"] for i in data]
+    for name in parse_valid_comma(g.cfg.upload_async or ''):
+        if name not in senders and g.hm.proxy(name):
+            pipe.hset(rsp("image", sha), get_replica_field(name), "pending")
+            enqueue_job("save", sha, name, pipe)
+    if expire > 0:
+        pipe.expire(rsp("image", sha), expire)
+
+
+def upload_result(saved, fmt=None):
+    """上传成功的响应数据
+
+    :param str fmt: 指定图片地址的显示字段，默认src，可以用点号指定，
+                    比如data.src，那么返回格式{code, filename..., data:{src}, ...}
+                    比如imgUrl，那么返回格式{code, filename..., imgUrl(=src), ...}
+
+    .. versionadded:: 1.11.0
+    """
+    data = saved["data"]
+    filename = saved["filename"]
+    res = dict(
+        code=0,
+        filename=filename,
+        sender=data[0]["sender"],
+        api=url_for("api.shamgr", sha=saved["sha"], _external=True),
+        sha=saved["sha"],
+        derivatives={
+            k: v["src"] for k, v in iteritems(saved["derivatives"])
+        },
+        tpl=dict(
+            URL="%s" % get_url_with_suffix(data[0], "url"),
+            HTML="<img src='%s' title='%s' alt='%s'>" % (
+                get_url_with_suffix(data[0], "html"),
+                data[0].get("title", ""), filename
+            ),
+            rST=".. image:: %s" % get_url_with_suffix(data[0], "rst"),
+            Markdown="![%s](%s)" % (
+                filename, get_url_with_suffix(data[0], "markdown")
+            )
+        ),
+    )
+    res.update(format_upload_src(fmt, data[0]["src"]))
+    return res
+
+
+#: 分块上传时建议的分块大小（不超过MaxUpload）
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def get_chunked_upload(upload_id):
+    """获取当前用户的分块上传状态，不存在或非本人时抛出ApiError"""
+    if not upload_id or len(upload_id) != 32 or not upload_id.isalnum():
+        raise ApiError("Invalid upload_id")
+    try:
+        info = g.rc.hgetall(get_chunked_key(upload_id))
+    except RedisError:
+        raise ApiError("Program data storage service error")
+    if not info or info.get("user") != (g.userinfo.username or "anonymous"):
+        raise ApiError("Chunked upload not found or expired")
+    info.update(size=int(info["size"]), received=int(info["received"]))
+    return info
+
+
+def remove_chunked_upload(upload_id):
+    try:
+        remove(get_chunked_path(upload_id))
+    except OSError:
+        pass
+    try:
+        g.rc.delete(get_chunked_key(upload_id))
+    except RedisError as e:
+        logger.warning(e, exc_info=True)
+
+
+def chunked_upload(Action, allowed_suffix):
+    """分块上传（除chunkComplete外）的各个动作：
+
+    - chunkInit: 提交filename、size，创建上传并返回upload_id、chunk_size
+    - chunkPut: 请求体为分块数据，查询参数upload_id、offset为其在图片中的位置
+    - chunkStatus: 查询已接收的字节数，用于断点续传
+    - chunkAbort: 取消上传并删除暂存数据
+
+    .. versionadded:: 1.11.0
+    """
+    res = dict(code=1, msg=None)
+    if Action == "chunkInit":
+        filename = secure_filename(request.form.get("filename") or "")
+        try:
+            size = int(request.form.get("size"))
+            if size <= 0:
+                raise ValueError
+        except (ValueError, TypeError):
+            raise ApiError("Invalid size param")
+        if not allowed_suffix(filename):
+            raise ApiError("No file or image format error")
+        if size > GLOBAL["MaxChunkedUpload"] * 1024 * 1024:
+            raise ApiError("The picture is too large")
+        upload_id = gen_uuid()
+        basedir = GLOBAL["ChunkedUploadDir"]
+        if not isdir(basedir):
+            makedirs(basedir)
+        prune_chunked_uploads()
+        open(get_chunked_path(upload_id), "wb").close()
+        key = get_chunked_key(upload_id)
+        pipe = g.rc.pipeline()
+        pipe.hmset(key, dict(
+            user=g.userinfo.username or "anonymous",
+            filename=filename,
+            size=size,
+            received=0,
+            ctime=get_current_timestamp(),
+        ))
+        pipe.expire(key, CHUNKED_EXPIRE)
+        try:
+            pipe.execute()
+        except RedisError:
+            res.update(msg="Program data storage service error")
+        else:
+            res.update(
+                code=0,
+                upload_id=upload_id,
+                chunk_size=min(
+                    CHUNK_SIZE, current_app.config["MAX_CONTENT_LENGTH"]
+                ),
+            )
+    elif Action == "chunkPut":
+        upload_id = request.args.get("upload_id")
+        info = get_chunked_upload(upload_id)
+        try:
+            offset = int(request.args.get("offset"))
+            if offset < 0 or offset > info["received"]:
+                raise ValueError
+        except (ValueError, TypeError):
+            raise ApiError("Invalid offset param")
+        #: 写入暂存文件（分段读取请求体，不整体载入内存）
+        written = 0
+        try:
+            with open(get_chunked_path(upload_id), "r+b") as f:
+                f.seek(offset)
+                while True:
+                    block = request.stream.read(65536)
+                    if not block:
+                        break
+                    written += len(block)
+                    if offset + written > info["size"]:
+                        raise ApiError("The chunk exceeds the picture size")
+                    f.write(block)
+        except (IOError, OSError):
+            raise ApiError("Chunked upload not found or expired")
+        received = max(info["received"], offset + written)
+        key = get_chunked_key(upload_id)
+        pipe = g.rc.pipeline()
+        pipe.hset(key, "received", received)
+        pipe.expire(key, CHUNKED_EXPIRE)
+        try:
+            pipe.execute()
+        except RedisError:
+            res.update(msg="Program data storage service error")
+        else:
+            res.update(code=0, received=received, size=info["size"])
+    elif Action == "chunkStatus":
+        info = get_chunked_upload(request.args.get("upload_id"))
+        res.update(code=0, received=info["received"], size=info["size"])
+    elif Action == "chunkAbort":
+        upload_id = request.args.get("upload_id")
+        get_chunked_upload(upload_id)
+        remove_chunked_upload(upload_id)
+        res.update(code=0)
+    else:
+        res.update(msg="Unsupported Action")
+    return res
+
+
+def batch_upload(field_name, allowed_suffix, album, expire):
+    """批量上传，一次请求上传多张图片，并发保存，图片数据及索引在一个
+    pipeline中写入，响应中data是按顺序的每张图片的上传结果。
+
+    - multipart表单：文件域字段可以有多个文件，album、title、expire等表单
+      字段作用于所有图片
+    - NDJSON(Content-Type: application/x-ndjson)：每行一个JSON对象，包含
+      picbed(图片链接或base64)、filename，可以有album、title、expire字段，
+      按行流式读取处理
+
+    .. versionadded:: 1.11.0
+    """
+    res = dict(code=1, msg=None)
+    try:
+        concurrency = max(1, int(g.cfg.upload_batch_concurrency or 4))
+    except (ValueError, TypeError):
+        concurrency = 4
+    title = request.form.get("title") or ""
+    origin = request.form.get(
+        "origin", "UA: %s" % request.headers.get('User-Agent', '')
+    )
+    if request.mimetype == "application/x-ndjson":
+        def items():
+            for line in request.stream:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    item = json.loads(line.decode("utf-8"))
+                    if not isinstance(item, dict):
+                        raise ValueError
+                except ValueError:
+                    item = dict(error="Invalid JSON line")
+                yield item
+        items = items()
+    else:
+        items = (dict(fp=fp) for fp in request.files.getlist(field_name))
+    #: 有界队列，读取请求体的速度不会超过处理的速度
+    todo = Queue(maxsize=concurrency * 2)
+    results = {}
+
+    def worker():
+        while True:
+            i, item = todo.get()
+            if item is None:
+                return
+            try:
+                if item.get("error"):
+                    raise ApiError(item["error"])
+                #: NDJSON中的字段类型需要在保存图片前校验
+                for k in ("filename", "album", "title"):
+                    if item.get(k) is not None and \
+                            not isinstance(item[k], string_types):
+                        raise ApiError("Parameter error")
+                try:
+                    item["expire"] = int(item.get("expire", expire))
+                    if item["expire"] < 0:
+                        raise ValueError
+                except (ValueError, TypeError):
+                    raise ApiError("Invalid expire param")
+                fp = item.pop("fp", None) or get_upload_file(
+                    item.pop("picbed", None), item.get("filename")
+                )
+                saved = save_upload(fp, allowed_suffix)
+            except ApiError as e:
+                saved = dict(code=1, msg=e.message)
+            except Exception as e:
+                logger.warning(e, exc_info=True)
+                saved = dict(code=1, msg="Upload failed")
+            results[i] = (item, saved)
+
+    threads = [spawn_in_context(worker) for _ in range(concurrency)]
+    total = 0
+    try:
+        for item in items:
+            todo.put((total, item))
+            total += 1
+    finally:
+        for _ in threads:
+            todo.put((None, None))
+        for t in threads:
+            t.join()
+    if total == 0:
+        res.update(msg="No file or image format error")
+        return res
+    results = [
+        results.get(i) or ({}, dict(code=1, msg="Not processed"))
+        for i in range(total)
+    ]
+    pipe = g.rc.pipeline()
+    success = 0
+    for item, saved in results:
+        if saved["code"] == 0:
+            index_upload(
+                pipe, saved,
+                ((item.get("album") or album) if g.signin else album).strip(),
+                item["expire"],
+                title=item.get("title") or title,
+                origin=origin,
+            )
+            success += 1
+    try:
+        pipe.execute()
+    except RedisError as e:
+        logger.error(e, exc_info=True)
+        res.update(code=3, msg="Program data storage service error")
+    else:
+        fmt = request.form.get("format", request.args.get("format"))
+        res.update(
+            code=0,
+            data=[
+                upload_result(saved, fmt) if saved["code"] == 0 else saved
+                for _, saved in results
+            ],
+            count=dict(success=success, fail=total - success),
+        )
+    return res
+
+
 @bp.route("/upload", methods=["POST"])
 def upload():
     """上传逻辑：
@@ -1051,6 +1867,10 @@ def upload():
     4. 此时保存图片成功，持久化存储到全局索引、用户索引
     5. 返回响应：{code:0, data={src=?, sender=success_saved_hook_name}}
         - 允许使用一些参数调整响应数据、格式
+
+    .. versionchanged:: 1.11.0
+        查询参数Action支持分块上传，chunkComplete时以暂存文件作为图片继续
+        上述流程，参考 :func:`chunked_upload`
     """
     res = dict(code=1, msg=None)
     #: 文件域或base64上传字段
@@ -1084,164 +1904,55 @@ def upload():
             raise ValueError
     except (ValueError, TypeError):
         raise ApiError("Invalid expire param")
+    Action = request.args.get("Action")
+    #: 批量上传
+    if Action == "batch":
+        return batch_upload(FIELD_NAME, allowed_suffix, album, expire)
+    #: 分块上传
+    if Action and Action != "chunkComplete":
+        return chunked_upload(Action, allowed_suffix)
     #: 尝试读取上传数据
-    fp = request.files.get(FIELD_NAME)
+    if Action == "chunkComplete":
+        upload_id = request.args.get("upload_id")
+        info = get_chunked_upload(upload_id)
+        if info["received"] != info["size"]:
+            raise ApiError("Chunked upload is incomplete")
+        fp = ChunkedFileStorage(get_chunked_path(upload_id), info["filename"])
+
+        @after_this_request
+        def cleanup_chunked(response):
+            fp.close()
+            if res.get("code") == 0:
+                remove_chunked_upload(upload_id)
+            return response
+    else:
+        fp = request.files.get(FIELD_NAME)
     #: 当fp无效时尝试读取base64或url
     if not fp:
-        picstrurl = request.form.get(FIELD_NAME)
-        filename = secure_filename(request.form.get("filename") or "")
-        if picstrurl:
-            if picstrurl.startswith("http://") or \
-                    picstrurl.startswith("https://"):
-                fp = ImgUrlFileStorage(picstrurl, filename).getObj
-            else:
-                try:
-                    #: base64在部分场景发起http请求时，+可能会换成空格导致异常
-                    fp = Base64FileStorage(picstrurl, filename)
-                except ValueError as e:
-                    logger.debug(e)
-    if fp and allowed_suffix(fp.filename):
-        stream = fp.stream.read()
-        suffix = splitext(fp.filename)[-1]
-        #: 处理图片二进制的钩子
-        for h in g.hm.get_call_list(
-            "upimg_stream_processor", _type="func"
-        ):
-            rst = g.hm.proxy(h["name"]).upimg_stream_processor(stream, suffix)
-            if isinstance(rst, dict) and rst.get("code") == 0 and \
-                    isinstance(rst.get("data"), dict) and \
-                    rst["data"].get("stream"):
-                stream = rst["data"]["stream"]
-        for h in g.hm.call(
-            "upimg_stream_interceptor",
-            _args=(stream, suffix),
-            _mode="any_false",
-        ):
-            if h.get("code") != 0:
-                res.update(
-                    msg="Interceptor processing rejection, upload aborted",
-                    errors={
-                        h["sender"]: h.get("msg")
-                    }
-                )
-                return res
-        #: 定义图片文件名
-        filename = secure_filename(fp.filename)
-        if "." not in filename:
-            filename = "%s%s" % (generate_random(8), suffix)
-        #: 根据文件名规则重定义图片名
-        upload_file_rule = (
-            g.userinfo.ucfg_upload_file_rule or g.cfg.upload_file_rule
-        ) if is_true(g.cfg.upload_rule_overridden) else g.cfg.upload_file_rule
-        if upload_file_rule in ("time1", "time2", "time3"):
-            filename = "%s%s" % (gen_rnd_filename(upload_file_rule), suffix)
-        #: 上传文件位置前缀规则
-        upload_path_rule = (
-            g.userinfo.ucfg_upload_path_rule or g.cfg.upload_path_rule
-        ) if is_true(g.cfg.upload_rule_overridden) else g.cfg.upload_path_rule
-        if upload_path_rule == 'date1':
-            upload_path = get_today("%Y/%m/%d")
-        elif upload_path_rule == 'date2':
-            upload_path = get_today("%Y%m%d")
-        else:
-            upload_path = ''
-        upload_path = join(g.userinfo.username or 'anonymous', upload_path)
-        #: 定义文件名唯一索引
-        sha = "sha1.%s.%s" % (get_current_timestamp(True), sha1(filename))
-        #: 定义保存图片时仅使用某些钩子，如: up2local
-        #: TODO 目前版本仅允许设置了一个，后续聚合
-        includes = parse_valid_comma(g.cfg.upload_includes or 'up2local')
-        if len(includes) > 1:
-            includes = [choice(includes)]
-        #: 当用户有标签且定义了用户上传分组则尝试覆盖默认includes
-        up_grp = g.cfg.upload_group
-        usr_label = g.userinfo.label if g.signin else "anonymous"
-        if up_grp and usr_label:
-            up_grp_rule = parse_valid_colon(up_grp) or {}
-            if usr_label in up_grp_rule:
-                includes = [up_grp_rule[usr_label]]
-        #: TODO 定义保存图片时排除某些钩子，如: up2local, up2other
-        #: excludes = parse_valid_comma(g.cfg.upload_excludes or '')
-        #: 调用钩子中upimg_save方法（目前版本最终结果中应该最多只有1条数据）
-        data = g.hm.call(
-            _funcname="upimg_save",
-            _include=includes,
-            _kwargs=dict(
-                filename=filename,
-                stream=stream,
-                upload_path=upload_path,
-            )
+        fp = get_upload_file(
+            request.form.get(FIELD_NAME), request.form.get("filename")
         )
-        #: 判定后端存储全部失败时，上传失败
-        if not data:
-            raise ApiError("No valid backend storage service")
-        if is_all_fail(data):
-            res.update(
-                code=1,
-                msg="All backend storage services failed to save pictures",
-                errors={
-                    i["sender"]: i["msg"]
-                    for i in data
-                    if i.get("code") != 0
-                },
-            )
-            return res
-        #: 存储数据
-        defaultSrc = data[0]["src"]
-        pipe = g.rc.pipeline()
-        pipe.sadd(rsp("index", "global"), sha)
-        if g.signin and g.userinfo.username:
-            pipe.sadd(rsp("index", "user", g.userinfo.username), sha)
-        pipe.hmset(rsp("image", sha), dict(
-            sha=sha,
-            album=album.strip(),
-            filename=filename,
-            upload_path=upload_path,
-            user=g.userinfo.username if g.signin else 'anonymous',
-            ctime=get_current_timestamp(),
-            status='enabled',  # deleted
-            src=defaultSrc,
-            sender=data[0]["sender"],
-            senders=json.dumps(data),
-            origin=request.form.get(
-                "origin", "UA: %s" % request.headers.get('User-Agent', '')
-            ),
-            method=get_upload_method(fp.__class__.__name__),
-            title=request.form.get("title") or "",
-        ))
-        if expire > 0:
-            pipe.expire(rsp("image", sha), expire)
-        try:
-            pipe.execute()
-        except RedisError as e:
-            logger.error(e, exc_info=True)
-            res.update(code=3, msg="Program data storage service error")
-        else:
-            res.update(
-                code=0,
-                filename=filename,
-                sender=data[0]["sender"],
-                api=url_for("api.shamgr", sha=sha, _external=True),
-                sha=sha,
-                tpl=dict(
-                    URL="%s" % get_url_with_suffix(data[0], "url"),
-                    HTML="<img src='%s' title='%s' alt='%s'>" % (
-                        get_url_with_suffix(data[0], "html"),
-                        data[0].get("title", ""), filename
-                    ),
-                    rST=".. image:: %s" % get_url_with_suffix(data[0], "rst"),
-                    Markdown="![%s](%s)" % (
-                        filename, get_url_with_suffix(data[0], "markdown")
-                    )
-                ),
-            )
-            #: format指定图片地址的显示字段，默认src，可以用点号指定
-            #: 比如data.src，那么返回格式{code, filename..., data:{src}, ...}
-            #: 比如imgUrl，那么返回格式{code, filename..., imgUrl(=src), ...}
-            fmt = request.form.get("format", request.args.get("format"))
-            res.update(format_upload_src(fmt, defaultSrc))
+    saved = save_upload(fp, allowed_suffix)
+    if saved["code"] != 0:
+        res.update(saved)
+        return res
+    pipe = g.rc.pipeline()
+    index_upload(
+        pipe, saved, album.strip(), expire,
+        title=request.form.get("title") or "",
+        origin=request.form.get(
+            "origin", "UA: %s" % request.headers.get('User-Agent', '')
+        ),
+    )
+    try:
+        pipe.execute()
+    except RedisError as e:
+        logger.error(e, exc_info=True)
+        res.update(code=3, msg="Program data storage service error")
     else:
-        res.update(msg="No file or image format error")
+        res.update(upload_result(
+            saved, request.form.get("format", request.args.get("format"))
+        ))
     return res
 
 
@@ -1264,24 +1975,14 @@ def album():
     #: 管理员账号查询所有相册
     is_mgr = is_true(request.args.get("is_mgr"))
     if g.userinfo.username:
-        if is_mgr and g.is_admin:
-            uk = rsp("index", "global")
-        else:
-            uk = rsp("index", "user", g.userinfo.username)
-        pipe = g.rc.pipeline()
-        for sha in g.rc.smembers(uk):
-            pipe.hget(rsp("image", sha), "album")
         try:
-            result = pipe.execute()
+            counter = get_album_counter(
+                None if is_mgr and g.is_admin else g.userinfo.username
+            )
         except RedisError:
             res.update(msg="Program data storage service error")
         else:
-            albums = [i for i in result if i]
-            res.update(
-                code=0,
-                data=list(set(albums)),
-                counter=Counter(albums)
-            )
+            res.update(code=0, data=list(counter), counter=counter)
     else:
         res.update(msg="No valid username found")
     return res
@@ -1314,7 +2015,7 @@ def link():
             if not ips or not isinstance(ips, (tuple, list)):
                 return "Invalid IP address"
             for ip in ips:
-                if ip and not check_ip(ip):
+                if ip and not check_ip_network(ip):
                     return "Invalid IP address"
         if allow_ep:
             eps = parse_valid_comma(allow_ep)
@@ -1513,34 +2214,76 @@ def report(classify):
     page = request.args.get("page")
     limit = request.args.get("limit")
     sort = (request.args.get("sort") or "asc").upper()
+    #: 游标，由上一页响应的next_cursor得到，传递此参数(可为空)时忽略其他范围参数
+    cursor = request.args.get("cursor")
+    #: 游标模式下上一页最后一条记录距表尾的位置（记录总是从表头写入，所以它不变）
+    pos = None
+    #: 因保留上限从表尾删除的记录数，游标中的位置包含这部分
+    trimmed = None
     if classify in ("linktokens",):
-        try:
-            #: start、end可正可负
-            start = int(start)
-            end = int(end)
-        except (ValueError, TypeError):
+        trimmed_key = get_report_trimmed_key(classify, g.userinfo.username)
+        if cursor is not None:
             try:
-                page = int(page)
                 limit = int(limit or 10)
-                if page - 1 < 0:
+                if limit <= 0:
                     raise ValueError
+                if cursor:
+                    pos = int(decode_cursor(cursor, 1)[0])
             except (ValueError, TypeError):
                 res.update(msg="Parameter error")
                 return res
+            if pos is not None:
+                try:
+                    trimmed = int(g.rc.get(trimmed_key) or 0)
+                except RedisError:
+                    res.update(msg="Program data storage service error")
+                    return res
+                pos -= trimmed
+            if pos is None:
+                start = 0
+                end = limit - 1
+            elif pos > 0:
+                start = -pos
+                end = -max(0, pos - limit) - 1
             else:
-                start = (page-1) * limit
-                end = start + limit - 1
+                res.update(code=0, data=[], count=0, next_cursor=None)
+                return res
+        else:
+            try:
+                #: start、end可正可负
+                start = int(start)
+                end = int(end)
+            except (ValueError, TypeError):
+                try:
+                    page = int(page)
+                    limit = int(limit or 10)
+                    if page - 1 < 0:
+                        raise ValueError
+                except (ValueError, TypeError):
+                    res.update(msg="Parameter error")
+                    return res
+                else:
+                    start = (page-1) * limit
+                    end = start + limit - 1
         if isinstance(start, int) and isinstance(end, int):
             key = rsp("report", classify, g.userinfo.username)
             try:
                 pipe = g.rc.pipeline()
                 pipe.llen(key)
                 pipe.lrange(key, start, end)
+                pipe.get(trimmed_key)
                 result = pipe.execute()
             except RedisError:
                 res.update(msg="Program data storage service error")
             else:
-                count, data = result
+                count, data, _trimmed = result
+                if cursor is not None:
+                    if trimmed is None:
+                        trimmed = int(_trimmed or 0)
+                    last = (count if pos is None else pos) - len(data)
+                    res["next_cursor"] = encode_cursor(last + trimmed) if (
+                        data and last > 0
+                    ) else None
                 if sort == "DESC":
                     data.reverse()
                 res.update(
@@ -1579,40 +2322,66 @@ def load():
                     todo.append(img)
                     continue
             fail.append(img)
-        #: 处理
-        pipe = g.rc.pipeline()
+        origin = request.form.get(
+            "origin", "UA: %s" % request.headers.get('User-Agent', '')
+        )
+        #: 由后台任务下载图片并保存到存储后端，通过任务ID查询进度及结果
+        if is_true(request.args.get("fetch")):
+            try:
+                jobid = create_load_job(
+                    todo, g.userinfo.username, origin, request.url_root
+                )
+            except RedisError as e:
+                logger.error(e, exc_info=True)
+                res.update(code=3, msg="Program data storage service error")
+            else:
+                res.update(
+                    code=0, jobid=jobid, fail=fail,
+                    api=url_for("api.load_job", jobid=jobid, _external=True),
+                    count=dict(todo=len(todo), fail=len(fail)),
+                )
+            return res
+        #: 处理，分批在pipeline中写入
         success = []
-        for img in todo:
-            filename = img["filename"]
-            #: 定义文件名唯一索引
-            sha = "sha1.%s.%s" % (get_current_timestamp(True), sha1(filename))
-            #: 入库
-            pipe.sadd(rsp("index", "global"), sha)
-            pipe.sadd(rsp("index", "user", g.userinfo.username), sha)
-            pipe.hmset(rsp("image", sha), dict(
-                sha=sha,
-                album=img.get("album") or "",
-                filename=filename,
-                upload_path=g.userinfo.username + "/",
-                user=g.userinfo.username,
-                ctime=get_current_timestamp(),
-                status='enabled',
-                src=img["url"],
-                sender="load",
-                senders=json.dumps([]),
-                origin=request.form.get(
-                    "origin", "UA: %s" % request.headers.get('User-Agent', '')
-                ),
-                method="load",
-                title=img.get("title") or "",
-            ))
+        for i in range(0, len(todo), LOAD_CHUNK_SIZE):
+            chunk = todo[i:i + LOAD_CHUNK_SIZE]
+            pipe = g.rc.pipeline()
+            for img in chunk:
+                filename = img["filename"]
+                #: 定义文件名唯一索引
+                sha = "sha1.%s.%s" % (
+                    get_current_timestamp(True), sha1(filename)
+                )
+                ctime = get_current_timestamp()
+                album = (img.get("album") or "").strip()
+                #: 入库
+                add_image_index(
+                    pipe, sha, ctime, g.userinfo.username, album=album
+                )
+                pipe.hmset(rsp("image", sha), dict(
+                    sha=sha,
+                    album=album,
+                    filename=filename,
+                    upload_path=g.userinfo.username + "/",
+                    user=g.userinfo.username,
+                    ctime=ctime,
+                    status='enabled',
+                    src=img["url"],
+                    sender="load",
+                    senders=json.dumps([]),
+                    origin=origin,
+                    method="load",
+                    title=img.get("title") or "",
+                ))
+                img["sha"] = sha
             try:
                 pipe.execute()
             except RedisError:
-                fail.append(img)
+                for img in chunk:
+                    img.pop("sha", None)
+                fail.extend(chunk)
             else:
-                img["sha"] = sha
-                success.append(img)
+                success.extend(chunk)
         res.update(
             code=0, success=success, fail=fail,
             count=dict(success=len(success), fail=len(fail))
@@ -1620,3 +2389,43 @@ def load():
     else:
         res.update(msg="Parameter error")
     return res
+
+
+@bp.route("/load/<jobid>")
+@apilogin_required
+def load_job(jobid):
+    """查询导入任务的进度及结果
+
+    .. versionadded:: 1.11.0
+    """
+    res = dict(code=1, msg=None)
+    try:
+        offset = int(request.args.get("offset") or 0)
+        limit = int(request.args.get("limit") or 100)
+        if offset < 0 or limit <= 0:
+            raise ValueError
+    except (ValueError, TypeError):
+        res.update(code=2, msg="Parameter error")
+        return res
+    try:
+        info = g.rc.hgetall(get_load_key(jobid))
+        if not info or (
+            not g.is_admin and info.get("user") != g.userinfo.username
+        ):
+            res.update(msg="Not found the job")
+            return res
+        data = g.rc.lrange(
+            get_load_key(jobid, "results"), offset, offset + limit - 1
+        )
+    except RedisError as e:
+        logger.error(e, exc_info=True)
+        res.update(code=3, msg="Program data storage service error")
+    else:
+        for k in ("total", "done", "success", "fail"):
+            info[k] = int(info.get(k) or 0)
+        res.update(
+            code=0, data=info,
+            results=[json.loads(i) for i in data],
+            next_offset=offset + len(data),
+        )
+    return res
@@ -9,14 +9,29 @@
     :license: BSD 3-Clause, see LICENSE for more details.
 """
 
+from posixpath import splitext
+from redis.exceptions import RedisError
 from flask import Blueprint, render_template, make_response, redirect, \
-    url_for, current_app, Response, g, abort
+    url_for, current_app, Response, g, abort, request, send_file
 from utils.web import admin_apilogin_required, anonymous_required, \
-    login_required, check_activate_token, dfr
-from utils.tool import is_true, rsp, string_types
+    login_required, check_activate_token, dfr, get_image_index_key, \
+    has_image, read_saved_image, transform_image, TRANSFORM_FORMATS, \
+    run_in_process, bump_auth_version
+from utils.tool import is_true, rsp, string_types, sha1, logger
 from utils._compat import PY2, text_type
+from libs.cache import DiskCache
+from config import GLOBAL
 
 bp = Blueprint("front", "front")
+#: 图片处理结果的本地缓存
+image_cache = DiskCache(
+    GLOBAL["ImageCacheDir"], GLOBAL["ImageCacheSize"] * 1024 * 1024
+)
+#: 图片处理允许的最大宽高，超过时按最大值处理
+TRANSFORM_MAX_SIZE = 4096
+#: 宽高向上取整到此步长，质量取整到5的倍数，限制不同参数组合（处理结果）的数量
+TRANSFORM_SIZE_STEP = 10
+TRANSFORM_QUALITY_STEP = 5
 
 
 @bp.route("/")
@@ -45,6 +60,11 @@ def logout():
             result = so.logout_handler()
             if result and isinstance(result, Response):
                 return result
+    #: 使进程内缓存的已验证会话失效
+    try:
+        bump_auth_version(g.userinfo.username)
+    except RedisError as e:
+        logger.warning(e, exc_info=True)
     res = make_response(redirect(url_for("front.index")))
     res.set_cookie(key='dSid',  value='', expires=0)
     return res
@@ -96,7 +116,10 @@ def activate(token):
             success = False
             url = url_for("front.my") if g.signin else url_for("front.login")
             if checkmail == usermail:
-                g.rc.hset(uk, "email_verified", 1)
+                pipe = g.rc.pipeline()
+                pipe.hset(uk, "email_verified", 1)
+                bump_auth_version(username, pipe)
+                pipe.execute()
                 success = True
             return render_template("public/go.html", url=url, success=success)
 
@@ -142,17 +165,84 @@ def ep(hook_name, route_name):
 @login_required
 def feed():
     pipe = g.rc.pipeline()
-    uk = rsp("index", "user", g.userinfo.username)
+    zk = get_image_index_key(g.userinfo.username)
     fields = ["title", "filename", "ctime", "user", "src"]
-    for sha in g.rc.smembers(uk):
+    for sha in g.rc.zrevrange(zk, 0, 9):
         pipe.hmget(rsp("image", sha), *fields)
     result = pipe.execute()
-    data = [dict(zip(fields, i)) for i in result if i]
-    xml = render_template('public/feed.xml', items=sorted(
-        data,
-        key=lambda k: int(k.get('ctime')),
-        reverse=True
-    )[:10])
+    data = [dict(zip(fields, i)) for i in result if i and i[2]]
+    xml = render_template('public/feed.xml', items=data)
     response = make_response(xml)
     response.headers['Content-Type'] = 'application/xml'
     return response
+
+
+@bp.route("/img/<sha>")
+def transform(sha):
+    """图片处理：缩放、裁剪、转换格式，结果缓存在本地磁盘
+
+    查询参数：w、h(最大宽高)，fmt(输出格式)，q(压缩质量)，crop(居中裁剪)
+
+    .. versionadded:: 1.11.0
+    """
+    try:
+        width = int(request.args.get("w") or 0)
+        height = int(request.args.get("h") or 0)
+        quality = int(request.args.get("q") or 85)
+        if width < 0 or height < 0 or quality < 1:
+            raise ValueError
+    except (ValueError, TypeError):
+        return abort(400)
+    width = min(-(-width // TRANSFORM_SIZE_STEP) * TRANSFORM_SIZE_STEP,
+                TRANSFORM_MAX_SIZE)
+    height = min(-(-height // TRANSFORM_SIZE_STEP) * TRANSFORM_SIZE_STEP,
+                 TRANSFORM_MAX_SIZE)
+    quality = min(
+        max(quality // TRANSFORM_QUALITY_STEP, 1) * TRANSFORM_QUALITY_STEP,
+        100
+    )
+    fmt = (request.args.get("fmt") or "").lower()
+    if fmt and fmt not in TRANSFORM_FORMATS:
+        return abort(400)
+    crop = is_true(request.args.get("crop"))
+    if not has_image(sha):
+        return abort(404)
+    info = g.rc.hgetall(rsp("image", sha))
+    if not fmt:
+        #: 默认保持原图格式，不支持的格式转为png
+        fmt = splitext(info["filename"])[-1].lstrip(".").lower()
+        if fmt not in TRANSFORM_FORMATS:
+            fmt = "png"
+    if fmt == "jpg":
+        fmt = "jpeg"
+    key = "%s:%s:%s:%s:%s:%s" % (sha, width, height, fmt, quality, crop)
+    etag = sha1(key)
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        f = image_cache.get(key)
+        if f is None:
+            try:
+                #: 在进程池中处理，避免阻塞其他请求
+                data = run_in_process(
+                    transform_image, read_saved_image(info),
+                    width, height, fmt, quality, crop
+                )
+            except ImportError:
+                logger.warning("Please install Pillow to transform images")
+                return abort(501)
+            except (IOError, ValueError, Exception) as e:
+                logger.warning(e, exc_info=True)
+                return abort(404)
+            try:
+                image_cache.set(key, data)
+            except (IOError, OSError) as e:
+                logger.warning(e, exc_info=True)
+            resp = make_response(data)
+            resp.mimetype = "image/%s" % fmt
+        else:
+            resp = send_file(f, mimetype="image/%s" % fmt)
+    resp.set_etag(etag)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = 2592000
+    return resp